@@ -0,0 +1,283 @@
+"""
+A helper that runs on the target host as one long-lived python3 process per
+session and answers JSON-lines requests over a single channel: stat, hash,
+read, write, packages, and run. Each query is then an in-process call
+instead of a channel, a shell, and output to parse. The output of run is
+streamed in frames ahead of its response, so it's never held whole in a
+single line.
+
+The helper is uploaded the first time it's used, and cached on the target by
+the hash of its source, so a new version is uploaded once.
+"""
+
+import base64
+import hashlib
+import json
+import shlex
+from typing import (
+    Any,
+    Dict,
+    Optional,
+    Tuple,
+)
+
+from .pathstat import PathStat
+
+AGENT_SOURCE = r"""
+import base64
+import grp
+import hashlib
+import json
+import os
+import pwd
+import select
+import stat
+import subprocess
+import sys
+import types
+
+CHUNK_SIZE = 1 << 16
+
+
+def _b64(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def _name(lookup, id_):
+    try:
+        return lookup(id_)[0]
+    except KeyError:
+        return "UNKNOWN"
+
+
+_FILE_TYPES = [
+    (stat.S_ISDIR, "directory"),
+    (stat.S_ISLNK, "symbolic link"),
+    (stat.S_ISCHR, "character special file"),
+    (stat.S_ISBLK, "block special file"),
+    (stat.S_ISFIFO, "fifo"),
+    (stat.S_ISSOCK, "socket"),
+]
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
+def do_stat(paths, digest=False):
+    stats = {}
+    for path in paths:
+        try:
+            st = os.lstat(path)
+        except OSError:
+            stats[path] = None
+            continue
+        if stat.S_ISREG(st.st_mode):
+            file_type = "regular file" if st.st_size else "regular empty file"
+        else:
+            file_type = next(
+                (name for test, name in _FILE_TYPES if test(st.st_mode)), "unknown"
+            )
+        stats[path] = [
+            file_type,
+            _name(pwd.getpwuid, st.st_uid),
+            _name(grp.getgrgid, st.st_gid),
+            stat.S_IMODE(st.st_mode),
+            st.st_size,
+            _sha256(path) if digest and stat.S_ISREG(st.st_mode) else None,
+        ]
+    return stats
+
+
+def do_hash(paths):
+    return {path: _sha256(path) for path in paths}
+
+
+def do_read(path):
+    try:
+        with open(path, "rb") as f:
+            return _b64(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def do_write(path, data, mode=None):
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(base64.b64decode(data))
+    if mode is not None:
+        os.chmod(tmp, mode)
+    os.rename(tmp, path)
+
+
+def do_packages(manager):
+    if manager == "apt":
+        out = subprocess.check_output(
+            ["dpkg-query", "-W", "-f", "${db:Status-Abbrev}\t${Package}\t${Version}\n"]
+        )
+        packages = {}
+        for line in out.decode("utf-8", "replace").splitlines():
+            parts = line.split("\t")
+            if len(parts) == 3 and parts[0].startswith("ii"):
+                packages[parts[1]] = parts[2]
+        return packages
+    elif manager == "pip3":
+        out = subprocess.check_output(
+            ["pip3", "list", "--format=json", "--disable-pip-version-check"]
+        )
+        return {p["name"]: p["version"] for p in json.loads(out.decode("utf-8"))}
+    raise ValueError("Unknown package manager: %r" % manager)
+
+
+# Yields the output of cmd in frames of at most CHUNK_SIZE bytes as it's
+# produced, so that neither side holds it all in a single line, then returns
+# its exit status.
+def do_run(cmd):
+    proc = subprocess.Popen(
+        [os.environ.get("SHELL") or "/bin/sh", "-c", cmd],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    streams = {proc.stdout.fileno(): "stdout", proc.stderr.fileno(): "stderr"}
+    while streams:
+        for fd in select.select(list(streams), [], [])[0]:
+            data = os.read(fd, CHUNK_SIZE)
+            if data:
+                yield {streams[fd]: _b64(data)}
+            else:
+                del streams[fd]
+    exit_status = proc.wait()
+    if exit_status < 0:
+        exit_status = 128 - exit_status
+    return {"exit_status": exit_status}
+
+
+METHODS = {
+    "stat": do_stat,
+    "hash": do_hash,
+    "read": do_read,
+    "write": do_write,
+    "packages": do_packages,
+    "run": do_run,
+}
+
+
+# Writes each frame that gen yields, and returns what gen returns.
+def write_frames(gen, out):
+    while True:
+        try:
+            frame = next(gen)
+        except StopIteration as e:
+            return e.value
+        out.write(json.dumps(frame) + "\n")
+        out.flush()
+
+
+def main():
+    out = sys.stdout
+    out.write(json.dumps({"ready": True}) + "\n")
+    out.flush()
+    for line in sys.stdin.buffer:
+        req = json.loads(line.decode("utf-8"))
+        try:
+            if req["method"] not in METHODS:
+                raise ValueError("Unknown method: %r" % req["method"])
+            result = METHODS[req["method"]](**req["params"])
+            if isinstance(result, types.GeneratorType):
+                result = write_frames(result, out)
+            resp = {"result": result}
+        except Exception as e:
+            resp = {"error": "%s: %s" % (type(e).__name__, e)}
+        out.write(json.dumps(resp) + "\n")
+        out.flush()
+
+
+main()
+"""
+
+AGENT_HASH = hashlib.sha256(AGENT_SOURCE.encode("utf-8")).hexdigest()[:16]
+
+# Where the helper is cached, relative to the login user's home folder.
+AGENT_PATH = ".marchitect/agent-{}.py".format(AGENT_HASH)
+
+# Runs the cached helper. If there's none, it asks for the source with an
+# "upload" line, then reads its length and the source from stdin.
+_BOOTSTRAP = r"""
+import hashlib, os, sys
+path = os.path.join(os.path.expanduser("~"), sys.argv[1])
+if not os.path.exists(path):
+    sys.stdout.write("upload\n")
+    sys.stdout.flush()
+    source = sys.stdin.buffer.read(int(sys.stdin.buffer.readline()))
+    if hashlib.sha256(source).hexdigest()[:16] != sys.argv[2]:
+        sys.exit("Bad agent upload")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(source)
+    os.rename(tmp, path)
+with open(path, "rb") as f:
+    code = compile(f.read(), path, "exec")
+exec(code, {"__name__": "__main__"})
+"""
+
+AGENT_UPLOAD_REQUEST = b"upload\n"
+
+
+def agent_start_cmd() -> str:
+    """Returns the command that starts the helper in a channel."""
+    return "exec python3 -c {} {} {}".format(
+        shlex.quote(_BOOTSTRAP), shlex.quote(AGENT_PATH), AGENT_HASH
+    )
+
+
+def agent_upload() -> bytes:
+    """Returns what to write to the helper when it asks for its source."""
+    source = AGENT_SOURCE.encode("utf-8")
+    return b"%d\n" % len(source) + source
+
+
+def is_agent_ready(line: bytes) -> bool:
+    """Whether line is the one that the helper prints once it's ready."""
+    try:
+        return bool(json.loads(line.decode("utf-8")) == {"ready": True})
+    except ValueError:
+        return False
+
+
+def encode_request(method: str, params: Dict[str, Any]) -> bytes:
+    return (json.dumps({"method": method, "params": params}) + "\n").encode("utf-8")
+
+
+def decode_response(line: bytes) -> Tuple[Any, Optional[str]]:
+    """Returns the result of a request, and its error if it failed."""
+    resp = json.loads(line.decode("utf-8"))
+    return resp.get("result"), resp.get("error")
+
+
+def parse_output_frame(line: bytes) -> Optional[Tuple[str, bytes]]:
+    """
+    Parses a line that a streaming request (i.e. run) sends ahead of its
+    response into the name of the stream and its output. Returns None if
+    line is the response.
+    """
+    frame = json.loads(line.decode("utf-8"))
+    for stream in ("stdout", "stderr"):
+        if stream in frame:
+            return stream, base64.b64decode(frame[stream])
+    return None
+
+
+def parse_agent_stats(result: Dict[str, Any]) -> Dict[str, Optional[PathStat]]:
+    """Parses the result of a stat request."""
+    return {
+        path: None if stat is None else PathStat(*stat) for path, stat in result.items()
+    }
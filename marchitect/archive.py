@@ -0,0 +1,141 @@
+"""
+Streams a local directory tree as a compressed tar archive, chunk by chunk,
+without staging the archive in memory or on disk.
+"""
+
+import bz2
+import lzma
+import os
+from pathlib import Path
+import tarfile
+from typing import (
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Protocol,
+)
+import zlib
+
+
+class _Compressor(Protocol):
+    def compress(self, data: bytes) -> bytes: ...
+
+    def flush(self) -> bytes: ...
+
+
+class _NoCompressor:
+    @staticmethod
+    def compress(data: bytes) -> bytes:
+        return data
+
+    @staticmethod
+    def flush() -> bytes:
+        return b""
+
+
+# Compression -> flag that makes GNU tar decompress the archive.
+TAR_FLAGS: Dict[Optional[str], str] = {
+    None: "",
+    "gzip": "z",
+    "bzip2": "j",
+    "xz": "J",
+}
+
+
+def _mk_compressor(compression: Optional[str], level: Optional[int]) -> _Compressor:
+    if compression is None:
+        return _NoCompressor()
+    elif compression == "gzip":
+        # wbits of 16 + 15 adds the gzip header and trailer.
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31)
+    elif compression == "bzip2":
+        return bz2.BZ2Compressor(9 if level is None else level)
+    elif compression == "xz":
+        return lzma.LZMACompressor(preset=level)
+    else:
+        raise ValueError("Unknown compression: %r" % compression)
+
+
+def _tar_infos(root: Path) -> Iterator[tarfile.TarInfo]:
+    """
+    Yields an entry for every folder, file, and symlink under root, parents
+    first. Ownership is left blank so that extracted files belong to the
+    extracting user.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            info = tarfile.TarInfo(Path(path).relative_to(root).as_posix())
+            info.mode = st.st_mode & 0o7777
+            info.mtime = int(st.st_mtime)
+            if os.path.islink(path):
+                info.type = tarfile.SYMTYPE
+                info.linkname = os.readlink(path)
+            elif os.path.isdir(path):
+                info.type = tarfile.DIRTYPE
+            elif os.path.isfile(path):
+                info.size = st.st_size
+            else:
+                # Sockets, fifos, devices
+                continue
+            yield info
+
+
+def tar_chunks(
+    root: Path,
+    compression: Optional[str] = "gzip",
+    level: Optional[int] = None,
+    chunk_size: int = 256 * 1024,
+) -> Iterator[bytes]:
+    """
+    Yields a tar archive of the contents of root.
+
+    Args:
+        compression: "gzip", "bzip2", "xz", or None.
+        level: Compression level. If None, uses the compressor's default.
+        chunk_size: Compressed output is gathered into chunks of about this
+            size before being yielded.
+    """
+    compressor = _mk_compressor(compression, level)
+    parts: List[bytes] = []
+    size = 0
+
+    def add(data: bytes) -> Iterator[bytes]:
+        nonlocal parts, size
+        out = compressor.compress(data)
+        if out:
+            parts.append(out)
+            size += len(out)
+            if size >= chunk_size:
+                yield b"".join(parts)
+                parts = []
+                size = 0
+
+    offset = 0
+    for info in _tar_infos(root):
+        header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        yield from add(header)
+        offset += len(header)
+        if info.isreg():
+            remaining = info.size
+            with open(root / info.name, "rb") as f:
+                # The size in the header is authoritative, so a file that
+                # changes while being read is truncated or zero-padded.
+                while remaining > 0:
+                    block = f.read(min(chunk_size, remaining))
+                    if not block:
+                        block = bytes(min(chunk_size, remaining))
+                    yield from add(block)
+                    remaining -= len(block)
+            padding = -info.size % tarfile.BLOCKSIZE
+            yield from add(bytes(padding))
+            offset += info.size + padding
+    # End-of-archive marker, padded to a full record like tarfile does.
+    trailer = 2 * tarfile.BLOCKSIZE
+    trailer += -(offset + trailer) % tarfile.RECORDSIZE
+    yield from add(bytes(trailer))
+    parts.append(compressor.flush())
+    yield b"".join(parts)
@@ -0,0 +1,98 @@
+"""
+Many commands run as one remote script, in a single channel, with each
+command's stdout, stderr, and exit status framed by markers so that they can
+be told apart afterwards.
+"""
+
+import re
+import shlex
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+import uuid
+
+# The shell that runs the script itself. Each command is run by the login
+# shell, as it would be by exec().
+BATCH_SHELL = "/bin/sh -s"
+
+
+def batch_marker() -> bytes:
+    """
+    A marker that's new for each batch, so that a command's output can't be
+    mistaken for one.
+    """
+    return "@@marchitect-batch-{}@@".format(uuid.uuid4().hex).encode("ascii")
+
+
+def batch_script(cmds: List[str], marker: bytes, stop_on_error: bool) -> bytes:
+    """
+    Returns a script for :data:`BATCH_SHELL` that runs cmds in order. Each
+    command's output is preceded by "<marker> <i>" and followed by
+    "<marker> <i> <exit status>", each on a line of its own, on both stdout
+    and stderr.
+
+    Args:
+        stop_on_error: If true, commands after the first one that fails
+            aren't run.
+    """
+    mark = shlex.quote(marker.decode("ascii"))
+    lines = []
+    for i, cmd in enumerate(cmds):
+        lines.append(
+            "printf '\\n%s %d\\n' {mark} {i}; printf '\\n%s %d\\n' {mark} {i} >&2".format(
+                mark=mark, i=i
+            )
+        )
+        # Commands get their own shell, like with exec(), so that one can't
+        # change the environment or the working dir of the next, and a
+        # syntax error is limited to the command it's in.
+        lines.append('"${{SHELL:-/bin/sh}}" -c {} < /dev/null'.format(shlex.quote(cmd)))
+        lines.append(
+            "s=$?; printf '\\n%s %d %d\\n' {mark} {i} $s; "
+            "printf '\\n%s %d %d\\n' {mark} {i} $s >&2".format(mark=mark, i=i)
+        )
+        if stop_on_error:
+            lines.append('[ "$s" -eq 0 ] || exit "$s"')
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def _split_frames(
+    marker: bytes, data: bytes
+) -> Tuple[Dict[int, bytes], Dict[int, int]]:
+    """Returns command index -> output, and command index -> exit status."""
+    parts = re.split(b"\n" + re.escape(marker) + b" (\\d+)(?: (\\d+))?\n", data)
+    outputs: Dict[int, bytes] = {}
+    exit_statuses: Dict[int, int] = {}
+    # parts is [before, i, status, output, i, status, output, ...], where
+    # status is None for the marker that opens a command's output.
+    for i_raw, status_raw, output in zip(parts[1::3], parts[2::3], parts[3::3]):
+        if status_raw is None:
+            outputs[int(i_raw)] = output
+        else:
+            exit_statuses[int(i_raw)] = int(status_raw)
+    return outputs, exit_statuses
+
+
+def parse_batch(
+    marker: bytes, count: int, stdout: bytes, stderr: bytes
+) -> List[Tuple[int, bytes, bytes]]:
+    """
+    Parses the output of the script from :func:`batch_script` for count
+    commands.
+
+    Returns:
+        (exit status, stdout, stderr) of each command that finished, in
+        order. Commands that didn't run or didn't finish are left out.
+    """
+    stdouts, exit_statuses = _split_frames(marker, stdout)
+    stderrs, _ = _split_frames(marker, stderr)
+    results = []
+    for i in range(count):
+        exit_status: Optional[int] = exit_statuses.get(i)
+        if exit_status is None:
+            break
+        results.append((exit_status, stdouts.get(i, b""), stderrs.get(i, b"")))
+    return results
@@ -0,0 +1,412 @@
+"""
+Facts about target hosts (kernel, distro, memory, installed packages, ...),
+gathered with a single remote command and cached per host.
+"""
+
+import contextlib
+import contextvars
+import hashlib
+import json
+import os
+from pathlib import Path
+import re
+import shlex
+import tempfile
+import threading
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+)
+from urllib.parse import quote
+
+
+class FactProvider:
+    """
+    Subclass to gather a new kind of fact. The command runs remotely as part
+    of one shell command shared by all providers, and its stdout is handed to
+    parse(). A command that fails should still leave parse() something it can
+    make sense of (usually empty output).
+    """
+
+    # Key that the fact is stored under, e.g. _target["memory"].
+    name = ""
+
+    # Shell command that prints the fact. Its stderr is discarded.
+    cmd = ""
+
+    # Bump when parse() changes so that cached facts are gathered again.
+    # Changes to cmd are picked up automatically.
+    version = 1
+
+    def parse(self, output: str) -> Any:
+        raise NotImplementedError
+
+    @property
+    def cache_version(self) -> str:
+        return hashlib.sha256(
+            "{}\0{}".format(self.version, self.cmd).encode("utf-8")
+        ).hexdigest()[:16]
+
+
+class BaseFacts(FactProvider):
+    """The facts that have always been available as cfg["_target"]."""
+
+    name = "base"
+    cmd = (
+        "uname -r && "
+        "lsb_release -sir && "
+        "hostname && "
+        "hostname -f && "
+        "cat /proc/cpuinfo | grep processor | wc -l"
+    )
+
+    def parse(self, output: str) -> Dict[str, Any]:
+        vals = output.splitlines()
+        if len(vals) < 6:
+            raise ValueError("Could not gather base facts from: %r" % output)
+        return dict(
+            kernel=vals[0],
+            distro=vals[1].lower(),
+            distro_version=vals[2],
+            hostname=vals[3],
+            fqdn=vals[4],
+            cpu_count=int(vals[5]),
+        )
+
+
+class ArchFacts(FactProvider):
+    """Machine hardware name, e.g. "x86_64"."""
+
+    name = "arch"
+    cmd = "uname -m"
+
+    def parse(self, output: str) -> str:
+        return output.strip()
+
+
+class MemoryFacts(FactProvider):
+    """Memory and swap in KiB: total_kb, available_kb, and swap_total_kb."""
+
+    name = "memory"
+    cmd = "cat /proc/meminfo"
+
+    _fields = {
+        "MemTotal": "total_kb",
+        "MemAvailable": "available_kb",
+        "SwapTotal": "swap_total_kb",
+    }
+
+    def parse(self, output: str) -> Dict[str, int]:
+        memory = {}
+        for line in output.splitlines():
+            key, _, rest = line.partition(":")
+            if key in self._fields:
+                memory[self._fields[key]] = int(rest.split()[0])
+        return memory
+
+
+class DisksFacts(FactProvider):
+    """
+    Mounted filesystems, each a dict with device, mount, size_kb, used_kb, and
+    available_kb.
+    """
+
+    name = "disks"
+    cmd = "df -P -k"
+
+    def parse(self, output: str) -> List[Dict[str, Any]]:
+        disks = []
+        for line in output.splitlines()[1:]:
+            parts = line.split(None, 5)
+            if len(parts) < 6:
+                continue
+            disks.append(
+                dict(
+                    device=parts[0],
+                    mount=parts[5],
+                    size_kb=int(parts[1]),
+                    used_kb=int(parts[2]),
+                    available_kb=int(parts[3]),
+                )
+            )
+        return disks
+
+
+class PackagesFacts(FactProvider):
+    """Installed Debian packages, as a dict of name -> version."""
+
+    name = "packages"
+    cmd = r"dpkg-query -W -f '${db:Status-Abbrev}\t${Package}\t${Version}\n'"
+
+    def parse(self, output: str) -> Dict[str, str]:
+        packages = {}
+        for line in output.splitlines():
+            parts = line.split("\t")
+            if len(parts) == 3 and parts[0].startswith("ii"):
+                packages[parts[1]] = parts[2]
+        return packages
+
+
+DEFAULT_FACT_PROVIDERS: List[FactProvider] = [
+    BaseFacts(),
+    ArchFacts(),
+    MemoryFacts(),
+    DisksFacts(),
+    PackagesFacts(),
+]
+
+# Printed before each provider's output. Provider names can't contain
+# whitespace, so a line of output can't be mistaken for one.
+_MARKER = "@@marchitect-fact@@"
+
+
+def gather_cmd(providers: Iterable[FactProvider]) -> str:
+    """Returns a shell command that gathers every fact in one round trip."""
+    return "; ".join(
+        "printf '\\n%s %s\\n' {} {}; {{ {}; }} 2>/dev/null".format(
+            _MARKER, shlex.quote(provider.name), provider.cmd
+        )
+        for provider in providers
+    )
+
+
+def parse_gathered(providers: Iterable[FactProvider], stdout: bytes) -> Dict[str, Any]:
+    """
+    Parses the output of the command from :func:`gather_cmd`.
+
+    Returns:
+        Provider name -> fact.
+    """
+    parts = re.split(
+        r"\n{} (\S+)\n".format(re.escape(_MARKER)),
+        stdout.decode("utf-8", "replace"),
+    )
+    outputs = dict(zip(parts[1::2], parts[2::2]))
+    return {
+        provider.name: provider.parse(outputs.get(provider.name, ""))
+        for provider in providers
+    }
+
+
+class FactsNeeded(Exception):
+    """
+    Raised by Facts for a fact that hasn't been gathered yet, while gathering
+    is deferred (see :func:`defer_gathering`), so that the caller can gather
+    it without blocking and try again.
+    """
+
+    def __init__(self, facts: "Facts", names: List[str]):
+        super().__init__(names)
+        self.facts = facts
+        self.names = names
+
+
+_gathering_deferred: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "gathering_deferred", default=False
+)
+
+
+@contextlib.contextmanager
+def defer_gathering() -> Iterator[None]:
+    """
+    Within the block, looking up a fact that hasn't been gathered raises
+    FactsNeeded instead of gathering it then and there. Used where blocking
+    isn't allowed, e.g. while rendering a template in the middle of an op.
+    """
+    token = _gathering_deferred.set(True)
+    try:
+        yield
+    finally:
+        _gathering_deferred.reset(token)
+
+
+class Facts(Dict[str, Any]):
+    """
+    Facts about a target host, available to whiteprints as cfg["_target"].
+
+    The base facts (user, host, kernel, distro, distro_version, hostname,
+    fqdn, cpu_count) are top-level keys. Other facts are found under their
+    provider's name, e.g. cfg["_target"]["memory"]["total_kb"], or
+    {{ _target.memory.total_kb }} in a template.
+
+    A fact that wasn't gathered up front is gathered the first time it's
+    looked up with [], which costs a round trip to the target host. Until
+    then, it's left out of keys() and the like. Templates that whiteprints
+    upload gather facts without blocking; other lookups block until the fact
+    is gathered, so async whiteprints should declare the facts that they
+    look up themselves (see Whiteprint.facts).
+    """
+
+    def __init__(
+        self,
+        facts: Dict[str, Any],
+        names: Iterable[str],
+        fetch: Callable[[List[str]], Dict[str, Any]],
+        fetch_op: Optional[
+            Callable[[Any, Any, List[str]], Generator[Any, None, Dict[str, Any]]]
+        ] = None,
+    ):
+        """
+        Args:
+            facts: The facts gathered so far.
+            names: Names of the facts that can be gathered later.
+            fetch: Gathers facts by name.
+            fetch_op: Returns an op (see marchitect.whiteprint.Op) that
+                gathers facts by name over the given session and reactor.
+        """
+        super().__init__(facts)
+        self._names = set(names)
+        self._fetch = fetch
+        self._fetch_op = fetch_op
+
+    def __missing__(self, key: str) -> Any:
+        if key not in self._names:
+            raise KeyError(key)
+        if _gathering_deferred.get():
+            raise FactsNeeded(self, [key])
+        self.update(self._fetch([key]))
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key: object) -> bool:
+        return dict.__contains__(self, key) or key in self._names
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def gather_op(
+        self, session: Any, reactor: Any, names: List[str]
+    ) -> Generator[Any, None, None]:
+        """An op that gathers facts by name over session."""
+        if self._fetch_op is None:
+            self.update(self._fetch(names))
+            return
+        gathered = yield from self._fetch_op(session, reactor, names)
+        self.update(gathered)
+
+
+class FactCache:
+    """
+    Keeps gathered facts so that they aren't gathered again on every run.
+
+    Facts expire after ttl seconds, or as soon as the provider that gathered
+    them changes. Optionally, facts are also stored on disk, one JSON file per
+    host, so that new processes can skip gathering too.
+
+    A cache is safe to share between threads, e.g. by the site plans of a
+    fleet.
+    """
+
+    # Bumped when the layout of cache files changes.
+    format_version = 1
+
+    def __init__(self, cache_dir: Optional[Path] = None, ttl: float = 3600.0):
+        """
+        Args:
+            cache_dir: If set, a folder to store facts in.
+            ttl: Seconds that a gathered fact is considered fresh.
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        # Host key -> fact name -> entry with the fact's value, cache version,
+        # and the (wall-clock) time it was gathered.
+        self._hosts: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, host_key: str) -> Path:
+        assert self.cache_dir is not None
+        return self.cache_dir / (quote(host_key, safe="@.-_") + ".json")
+
+    def _load(self, host_key: str) -> Dict[str, Dict[str, Any]]:
+        entries = self._hosts.get(host_key)
+        if entries is not None:
+            return entries
+        entries = {}
+        if self.cache_dir is not None:
+            try:
+                with open(self._path(host_key), encoding="utf-8") as f:
+                    contents = json.load(f)
+                if contents.get("format") == self.format_version:
+                    entries = contents["facts"]
+            except (OSError, ValueError, KeyError):
+                pass
+        self._hosts[host_key] = entries
+        return entries
+
+    def get(self, host_key: str, providers: Iterable[FactProvider]) -> Dict[str, Any]:
+        """
+        Args:
+            host_key: Identifies the host, e.g. "user@hostname".
+
+        Returns:
+            The fresh facts gathered by providers, by name. Facts that are
+            missing or stale are left out.
+        """
+        now = time.time()
+        facts = {}
+        with self._lock:
+            entries = self._load(host_key)
+            for provider in providers:
+                entry = entries.get(provider.name)
+                if (
+                    entry is not None
+                    and entry["version"] == provider.cache_version
+                    and now - entry["time"] < self.ttl
+                ):
+                    facts[provider.name] = entry["value"]
+        return facts
+
+    def put(
+        self,
+        host_key: str,
+        providers: Iterable[FactProvider],
+        facts: Dict[str, Any],
+    ) -> None:
+        """
+        Args:
+            facts: Provider name -> fact, for each of providers.
+        """
+        now = time.time()
+        with self._lock:
+            entries = self._load(host_key)
+            for provider in providers:
+                entries[provider.name] = {
+                    "version": provider.cache_version,
+                    "time": now,
+                    "value": facts[provider.name],
+                }
+            if self.cache_dir is not None:
+                self._write(host_key, entries)
+
+    def invalidate(self, host_key: str) -> None:
+        """Forgets every fact about a host."""
+        with self._lock:
+            self._hosts.pop(host_key, None)
+            if self.cache_dir is not None:
+                try:
+                    os.remove(self._path(host_key))
+                except FileNotFoundError:
+                    pass
+
+    def _write(self, host_key: str, entries: Dict[str, Dict[str, Any]]) -> None:
+        assert self.cache_dir is not None
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Written to a temp file and renamed so that readers in other
+        # processes never see a partial file.
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.cache_dir), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"format": self.format_version, "facts": entries}, f)
+            os.replace(tmp_path, self._path(host_key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
@@ -0,0 +1,339 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import logging
+import math
+from pathlib import Path
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Type,
+    Union,
+)
+
+from .facts import FactCache
+from .site_plan import SitePlan
+from .whiteprint import Whiteprint, WhiteprintError
+
+logger = logging.getLogger("marchitect.fleet")
+
+
+class HostResult:
+    """The outcome of running a site plan mode on one host."""
+
+    def __init__(
+        self,
+        hostname: str,
+        ok: bool,
+        duration: float,
+        error: Optional[str] = None,
+        skipped: bool = False,
+    ):
+        """
+        Args:
+            ok: Whether the mode completed without error (or validation found
+                no problems).
+            duration: Wall-clock seconds spent on the host.
+            error: Description of the failure, if any.
+            skipped: Whether the host was never attempted because an earlier
+                failure stopped the run.
+        """
+        self.hostname = hostname
+        self.ok = ok
+        self.duration = duration
+        self.error = error
+        self.skipped = skipped
+
+    @property
+    def status(self) -> str:
+        if self.skipped:
+            return "skipped"
+        return "ok" if self.ok else "failed"
+
+    def __repr__(self) -> str:
+        return "HostResult({!r}, {}, {:.2f}s)".format(
+            self.hostname, self.status, self.duration
+        )
+
+
+class Fleet:
+    """
+    Runs the same site plan against many hosts concurrently.
+
+    Hosts are processed in rolling batches. Within a batch, up to concurrency
+    hosts run at once, each on its own thread and SSH session. A batch must
+    finish before the next one starts.
+
+    A host's SSH sessions are disconnected as soon as it's done, so that a
+    large fleet doesn't hold a connection open per host between runs.
+    """
+
+    def __init__(self, site_plans: List[SitePlan], keep_sessions: bool = False):
+        """
+        Args:
+            site_plans: One site plan per target host.
+            keep_sessions: If true, each host's sessions are kept in its site
+                plan's session pool after a run, to be reused by the next
+                one, until :meth:`close` is called.
+        """
+        self.site_plans = site_plans
+        self.keep_sessions = keep_sessions
+
+    def __enter__(self) -> "Fleet":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Closes every site plan, disconnecting their pooled sessions."""
+        for site_plan in self.site_plans:
+            site_plan.close()
+
+    @classmethod
+    def from_private_key(
+        cls,
+        site_plan_cls: Type[SitePlan],
+        hostnames: List[str],
+        port: int,
+        user: str,
+        private_key: str,
+        private_key_password: Optional[str],
+        cfg: Dict[Union[str, Type[Whiteprint]], Dict[str, Any]],
+        rsrc_paths: List[Path],
+        fact_cache: Optional[FactCache] = None,
+        keep_sessions: bool = False,
+    ) -> "Fleet":
+        """
+        Creates a Fleet that connects to each host via a private key.
+
+        See :meth:`SitePlan.from_private_key` and :meth:`__init__` for args.
+        The site plans share fact_cache.
+        """
+        return cls(
+            [
+                site_plan_cls.from_private_key(
+                    hostname,
+                    port,
+                    user,
+                    private_key,
+                    private_key_password,
+                    cfg,
+                    rsrc_paths,
+                    fact_cache=fact_cache,
+                )
+                for hostname in hostnames
+            ],
+            keep_sessions,
+        )
+
+    @classmethod
+    def from_password(
+        cls,
+        site_plan_cls: Type[SitePlan],
+        hostnames: List[str],
+        port: int,
+        user: str,
+        password: str,
+        cfg: Dict[Union[str, Type[Whiteprint]], Dict[str, Any]],
+        rsrc_paths: List[Path],
+        fact_cache: Optional[FactCache] = None,
+        keep_sessions: bool = False,
+    ) -> "Fleet":
+        """
+        Creates a Fleet that connects to each host via a user & pass.
+
+        See :meth:`SitePlan.from_password` and :meth:`__init__` for args. The
+        site plans share fact_cache.
+        """
+        return cls(
+            [
+                site_plan_cls.from_password(
+                    hostname,
+                    port,
+                    user,
+                    password,
+                    cfg,
+                    rsrc_paths,
+                    fact_cache=fact_cache,
+                )
+                for hostname in hostnames
+            ],
+            keep_sessions,
+        )
+
+    def _batches(self, batch_size: Union[int, float, None]) -> List[List[SitePlan]]:
+        if batch_size is None:
+            size = len(self.site_plans)
+        elif isinstance(batch_size, float):
+            assert 0 < batch_size <= 1, "Fractional batch_size must be in (0, 1]"
+            size = math.ceil(len(self.site_plans) * batch_size)
+        else:
+            assert batch_size > 0
+            size = batch_size
+        size = max(1, size)
+        return [
+            self.site_plans[i : i + size] for i in range(0, len(self.site_plans), size)
+        ]
+
+    def _run(
+        self,
+        label: str,
+        run_host: Callable[[SitePlan], Optional[str]],
+        concurrency: int,
+        batch_size: Union[int, float, None],
+        fail_fast: bool,
+    ) -> List[HostResult]:
+        """
+        Args:
+            run_host: Runs on one host and returns an error message on failure.
+                Exceptions are also treated as failures.
+        """
+        assert concurrency > 0
+        results: Dict[int, HostResult] = {}
+        index = {id(site_plan): i for i, site_plan in enumerate(self.site_plans)}
+
+        def timed_run(site_plan: SitePlan) -> HostResult:
+            start = time.perf_counter()
+            try:
+                err = run_host(site_plan)
+            except WhiteprintError as e:
+                err = e.log_msg()
+            except Exception as e:  # pylint: disable=W0703
+                err = "{}: {}".format(e.__class__.__name__, e)
+            finally:
+                if not self.keep_sessions:
+                    site_plan.drop_idle_sessions()
+            duration = time.perf_counter() - start
+            return HostResult(site_plan.hostname, err is None, duration, err)
+
+        failed = False
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for batch in self._batches(batch_size):
+                if failed and fail_fast:
+                    break
+                todo = list(batch)
+                running: Dict[Future[HostResult], SitePlan] = {}
+                while todo or running:
+                    while todo and len(running) < concurrency:
+                        if failed and fail_fast:
+                            todo.clear()
+                            break
+                        site_plan = todo.pop(0)
+                        logger.info("%s %s", label, site_plan.hostname)
+                        running[executor.submit(timed_run, site_plan)] = site_plan
+                    if not running:
+                        break
+                    done: Set[Future[HostResult]] = wait(
+                        running, return_when=FIRST_COMPLETED
+                    ).done
+                    for future in done:
+                        site_plan = running.pop(future)
+                        result = future.result()
+                        results[index[id(site_plan)]] = result
+                        if not result.ok:
+                            failed = True
+                            logger.error(
+                                "%s failed on %s: %s",
+                                label,
+                                site_plan.hostname,
+                                result.error,
+                            )
+        for i, site_plan in enumerate(self.site_plans):
+            if i not in results:
+                results[i] = HostResult(site_plan.hostname, False, 0.0, skipped=True)
+        return [results[i] for i in range(len(self.site_plans))]
+
+    def execute(
+        self,
+        mode: str,
+        concurrency: int = 10,
+        batch_size: Union[int, float, None] = None,
+        fail_fast: bool = False,
+        force: bool = False,
+    ) -> List[HostResult]:
+        """
+        Executes mode on every host.
+
+        Args:
+            concurrency: Maximum number of hosts running at once.
+            batch_size: Number of hosts per rolling batch, or a float in (0, 1]
+                for a fraction of the fleet. If None, the whole fleet is one
+                batch.
+            fail_fast: If true, no new hosts are started once any host fails.
+                Hosts already running are allowed to finish. Otherwise, every
+                host is attempted.
+            force: If true, steps are executed even if the site plans skip
+                unchanged steps. See :meth:`SitePlan.execute`.
+
+        Returns:
+            A result per host in the same order as the fleet's site plans.
+        """
+
+        def run_host(site_plan: SitePlan) -> Optional[str]:
+            site_plan.execute(mode, force)
+            return None
+
+        return self._run(
+            "Executing ({})".format(mode), run_host, concurrency, batch_size, fail_fast
+        )
+
+    def validate(
+        self,
+        mode: str,
+        concurrency: int = 10,
+        batch_size: Union[int, float, None] = None,
+        fail_fast: bool = False,
+    ) -> List[HostResult]:
+        """
+        Validates mode on every host. See :meth:`execute` for args.
+        """
+        return self._run(
+            "Validating ({})".format(mode),
+            lambda site_plan: site_plan.validate(mode),
+            concurrency,
+            batch_size,
+            fail_fast,
+        )
+
+    def gather_facts(
+        self, names: Optional[Iterable[str]] = None, concurrency: int = 10
+    ) -> List[HostResult]:
+        """
+        Gathers facts from every host at once, e.g. to fill the site plans'
+        fact caches before a run. Hosts whose facts are cached and fresh
+        aren't contacted.
+
+        Args:
+            names: Names of the facts to gather besides the base ones. If
+                None, every fact is gathered.
+            concurrency: Maximum number of hosts gathering at once.
+        """
+        names = list(names) if names is not None else None
+
+        def run_host(site_plan: SitePlan) -> Optional[str]:
+            site_plan.gather_facts(names)
+            return None
+
+        return self._run("Gathering facts", run_host, concurrency, None, False)
+
+    @staticmethod
+    def format_results(results: List[HostResult]) -> str:
+        """Formats results as a plain-text table, one host per line."""
+        width = max([len("host")] + [len(r.hostname) for r in results])
+        lines = [
+            "{:<{w}}  {:<7}  {:>9}  {}".format(
+                "host", "status", "time", "error", w=width
+            )
+        ]
+        for r in results:
+            lines.append(
+                "{:<{w}}  {:<7}  {:>8.2f}s  {}".format(
+                    r.hostname, r.status, r.duration, r.error or "", w=width
+                )
+            )
+        return "\n".join(lines)
@@ -0,0 +1,330 @@
+"""
+A journal kept on the target host of the steps that site plans applied, so
+that steps that haven't changed since they were last applied can be skipped.
+"""
+
+import datetime
+import functools
+import hashlib
+import inspect
+import json
+import os
+from pathlib import Path
+import posixpath
+import shlex
+from typing import (
+    Any,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    TYPE_CHECKING,
+)
+
+import jinja2
+import jinja2.meta
+
+from .manifest import local_sha256
+
+if TYPE_CHECKING:
+    from .whiteprint import Whiteprint
+
+
+def _class_source(cls: type) -> str:
+    """The source of a class, or its name if the source isn't available."""
+    try:
+        return inspect.getsource(cls)
+    except (OSError, TypeError):
+        return "{}.{}".format(cls.__module__, cls.__qualname__)
+
+
+def _class_sources(cls: type) -> List[str]:
+    """
+    The sources of cls and of the classes it inherits from (e.g. a shared
+    base whiteprint or a mixin), except for Whiteprint and AsyncWhiteprint
+    themselves.
+    """
+    return [
+        _class_source(base)
+        for base in cls.__mro__
+        if base is not object and base.__module__ != "marchitect.whiteprint"
+    ]
+
+
+def _stable_repr(obj: Any) -> str:
+    """
+    Raises:
+        - TypeError: If obj's repr is object's default, which has its address
+          and so differs from run to run.
+    """
+    repr_method: Any = type(obj).__repr__
+    if repr_method is object.__repr__:
+        raise TypeError("No deterministic repr: {}".format(type(obj).__name__))
+    return repr(obj)
+
+
+def _json_default(obj: Any) -> Any:
+    """
+    Serializes what json can't by itself, or raises TypeError so that the
+    step gets no fingerprint.
+    """
+    if isinstance(obj, (set, frozenset)):
+        return sorted(_stable_repr(item) for item in obj)
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    return _stable_repr(obj)
+
+
+# The facts that are part of a step's fingerprint. They're gathered up front
+# and don't change from run to run, unlike e.g. memory.available_kb, and
+# facts that are gathered lazily would otherwise be in the fingerprint
+# depending on whether an earlier step happened to use them.
+_FINGERPRINTED_FACTS = [
+    "user",
+    "host",
+    "hostname",
+    "fqdn",
+    "distro",
+    "distro_version",
+    "cpu_count",
+]
+
+
+def _fingerprinted_cfg(cfg: Optional[Mapping[str, Any]]) -> Any:
+    """cfg with its target host facts narrowed to _FINGERPRINTED_FACTS."""
+    if cfg is None:
+        return None
+    plain = {key: cfg[key] for key in cfg if key != "_target"}
+    if "_target" in cfg:
+        target = cfg["_target"]
+        plain["_target"] = {
+            key: target[key] for key in _FINGERPRINTED_FACTS if key in target
+        }
+    return plain
+
+
+@functools.lru_cache(maxsize=8192)
+def _referenced_templates(
+    env: jinja2.Environment, path: str, digest: str
+) -> Optional[Tuple[str, ...]]:
+    """
+    Names of the templates that the file at path includes, imports, or
+    extends, or None if some are named by expressions. A file that isn't a
+    template (e.g. binary) references none. The digest of the file is part
+    of the cache key so that a modified file is parsed again.
+    """
+    # pylint: disable=W0613
+    try:
+        with open(path, encoding="utf-8") as f:
+            ast = env.parse(f.read())
+    except (UnicodeDecodeError, jinja2.TemplateSyntaxError):
+        return ()
+    found = list(jinja2.meta.find_referenced_templates(ast))
+    if None in found:
+        return None
+    return tuple(name for name in found if name)
+
+
+class _Inputs:
+    """
+    The local files that a step reads, and their digests, by names that
+    don't depend on where the resource folders are.
+    """
+
+    def __init__(self, env: jinja2.Environment):
+        self.env = env
+        self.files: Dict[str, str] = {}
+        self.seen: Set[str] = set()
+        # Whether some template names another with an expression, so the
+        # files it may read can't all be listed.
+        self.unlisted = False
+
+    def add_file(self, path: str, name: str, template: bool) -> None:
+        if path in self.seen:
+            return
+        self.seen.add(path)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+        digest = local_sha256(path, st.st_size, st.st_mtime_ns, st.st_ino)
+        self.files[name] = digest
+        if not template:
+            return
+        refs = _referenced_templates(self.env, path, digest)
+        if refs is None:
+            self.unlisted = True
+            return
+        loader = self.env.loader
+        for ref in refs:
+            try:
+                assert loader is not None
+                _, ref_path, _ = loader.get_source(self.env, ref)
+            except (AssertionError, jinja2.TemplateNotFound):
+                # It can't be rendered either.
+                continue
+            assert ref_path is not None
+            self.add_file(ref_path, "template:" + ref, True)
+
+    def add_tree(self, root: str, name: str, templates: bool) -> None:
+        if not os.path.isdir(root):
+            self.add_file(root, name, templates)
+            return
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                self.add_file(
+                    path, posixpath.join(name, os.path.relpath(path, root)), templates
+                )
+
+
+def step_fingerprint(whiteprint: "Whiteprint") -> Optional[str]:
+    """
+    Fingerprints what a whiteprint would do: the source of its class and of
+    its prefabs' classes (recursively), with the classes they inherit from,
+    their configs (with only the target host facts that don't change from
+    run to run), and the contents of the local files they read: the
+    resource folder, the resources named by their rsrc_cfg_keys, and the
+    templates these include.
+
+    Whiteprints that run others with use_execute() or use_validate() can't
+    be fingerprinted up front, so the site plan records no fingerprint for
+    them once they've run (see Whiteprint.delegated).
+
+    Returns:
+        A hex digest, or None if a config can't be serialized
+        deterministically, or if a template includes others by an
+        expression.
+    """
+    h = hashlib.sha256()
+    wps = list(whiteprint.prefab_whiteprints())
+    try:
+        cfgs = json.dumps(
+            [_fingerprinted_cfg(wp.cfg) for wp in wps],
+            sort_keys=True,
+            default=_json_default,
+        )
+    except TypeError:
+        # e.g. keys of mixed types that can't be sorted
+        return None
+    h.update(cfgs.encode("utf-8"))
+    for wp in wps:
+        for source in _class_sources(type(wp)):
+            h.update(b"\0")
+            h.update(source.encode("utf-8"))
+    inputs = _Inputs(whiteprint.template_cache.env)
+    rsrc_path = whiteprint.rsrc_path
+    if rsrc_path is not None:
+        inputs.add_tree(str(rsrc_path), "", True)
+    for wp in wps:
+        for key in wp.rsrc_cfg_keys:
+            raw_path = wp.cfg.get(key)
+            if raw_path is None:
+                continue
+            path = Path(raw_path)
+            if not path.is_absolute():
+                if rsrc_path is None:
+                    continue
+                path = rsrc_path / path
+            # Resources given as folders are copied, not rendered.
+            inputs.add_tree(str(path), "rsrc:" + str(raw_path), not path.is_dir())
+    if inputs.unlisted:
+        return None
+    for name, digest in sorted(inputs.files.items()):
+        h.update("\0{}\0{}".format(name, digest).encode("utf-8"))
+    return h.hexdigest()
+
+
+class Journal:
+    """
+    The steps applied to a target host, by site plan, step, and mode.
+
+    Running a step in one mode invalidates its records for other modes, e.g.
+    after clean, install must run again.
+    """
+
+    format_version = 1
+
+    def __init__(self, site_plans: Optional[Dict[str, Any]] = None):
+        self.site_plans: Dict[str, Any] = site_plans if site_plans is not None else {}
+        # Whether there are records that haven't been written back.
+        self.changed = False
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Journal":
+        """
+        Parses a journal written by :meth:`to_bytes`. Anything else (e.g. no
+        journal yet) is treated as an empty journal.
+        """
+        try:
+            contents = json.loads(data.decode("utf-8"))
+        except ValueError:
+            return cls()
+        if (
+            not isinstance(contents, dict)
+            or contents.get("format") != cls.format_version
+        ):
+            return cls()
+        return cls(contents["site_plans"])
+
+    def to_bytes(self) -> bytes:
+        return json.dumps(
+            {"format": self.format_version, "site_plans": self.site_plans},
+            indent=1,
+            sort_keys=True,
+        ).encode("utf-8")
+
+    def _steps(self, site_plan: str) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        steps: Dict[str, Dict[str, Dict[str, Any]]] = self.site_plans.setdefault(
+            site_plan, {}
+        ).setdefault("steps", {})
+        return steps
+
+    def fingerprint(self, site_plan: str, step: str, mode: str) -> Optional[str]:
+        """The fingerprint the step had when last applied in mode, if any."""
+        record = self.site_plans.get(site_plan, {}).get("steps", {}).get(step, {})
+        fingerprint: Optional[str] = record.get(mode, {}).get("fingerprint")
+        return fingerprint
+
+    def record(
+        self,
+        site_plan: str,
+        step: str,
+        mode: str,
+        whiteprint_cls: type,
+        fingerprint: Optional[str],
+    ) -> None:
+        """Records that step was applied in mode."""
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self._steps(site_plan)[step] = {
+            mode: {
+                "whiteprint": "{}.{}".format(
+                    whiteprint_cls.__module__, whiteprint_cls.__qualname__
+                ),
+                "fingerprint": fingerprint,
+                "applied_at": now,
+            }
+        }
+        self.site_plans[site_plan]["last_applied"] = {"mode": mode, "at": now}
+        self.changed = True
+
+
+def read_journal_cmd(path: str) -> str:
+    """Returns a shell command that prints the journal at path, if any."""
+    return "cat -- {} 2>/dev/null || true".format(shlex.quote(path))
+
+
+def write_journal_cmd(path: str) -> str:
+    """
+    Returns a shell command that replaces the journal at path with its stdin.
+    """
+    # The temp file is named after the shell's pid so that concurrent
+    # writers don't clobber each other's; the last rename wins.
+    return "mkdir -p -- {dir} && cat > {tmp} && mv -- {tmp} {path}".format(
+        dir=shlex.quote(posixpath.dirname(path) or "."),
+        tmp=shlex.quote(path) + ".$$.tmp",
+        path=shlex.quote(path),
+    )
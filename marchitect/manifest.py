@@ -0,0 +1,244 @@
+"""
+Manifests of directory trees, used to sync a local tree to a remote one
+without transferring files that are already up to date.
+"""
+
+import functools
+import hashlib
+import os
+from pathlib import Path
+import posixpath
+import shlex
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Set,
+)
+
+
+class FileEntry:
+    """A regular file in a manifest."""
+
+    def __init__(self, size: int, mtime: float, mode: int, sha256: Optional[str]):
+        """
+        Args:
+            mode: Permission bits.
+            sha256: Hex digest of the contents, or None if it couldn't be
+                computed (the file is then always considered changed).
+        """
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+        self.sha256 = sha256
+
+    def __repr__(self) -> str:
+        return "FileEntry({}, {}, {:o}, {})".format(
+            self.size, self.mtime, self.mode, self.sha256
+        )
+
+
+class Manifest:
+    """
+    The contents of a directory tree. Paths are relative to the root of the
+    tree and use "/" as the separator.
+    """
+
+    def __init__(
+        self,
+        files: Dict[str, FileEntry],
+        dirs: Set[str],
+        others: Optional[Set[str]] = None,
+    ):
+        """
+        Args:
+            files: Regular files.
+            dirs: Directories, excluding the root.
+            others: Anything that's neither (symlinks, sockets, ...).
+        """
+        self.files = files
+        self.dirs = dirs
+        self.others = others or set()
+
+    @classmethod
+    def from_local(cls, root: Path) -> "Manifest":
+        """
+        Walks a local directory. Symlinks to files are followed; symlinks to
+        directories are skipped.
+        """
+        files: Dict[str, FileEntry] = {}
+        dirs: Set[str] = set()
+        for dirpath, dirnames, filenames in os.walk(root):
+            rel_dir = Path(dirpath).relative_to(root).as_posix()
+            for dirname in dirnames:
+                if not os.path.islink(os.path.join(dirpath, dirname)):
+                    dirs.add(posixpath.normpath(posixpath.join(rel_dir, dirname)))
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    # Broken symlink
+                    continue
+                if not os.path.isfile(path):
+                    continue
+                rel_path = posixpath.normpath(posixpath.join(rel_dir, filename))
+                files[rel_path] = FileEntry(
+                    st.st_size,
+                    st.st_mtime,
+                    st.st_mode & 0o777,
+                    local_sha256(path, st.st_size, st.st_mtime_ns, st.st_ino),
+                )
+        return cls(files, dirs)
+
+    @classmethod
+    def from_remote_output(cls, output: bytes) -> "Manifest":
+        """Parses the output of the command from :func:`remote_manifest_cmd`."""
+        files: Dict[str, FileEntry] = {}
+        dirs: Set[str] = set()
+        others: Set[str] = set()
+        digests: Dict[str, str] = {}
+        for record in output.split(b"\0"):
+            if not record:
+                continue
+            if record[1:2] != b" ":
+                # sha256sum output: "<digest>  ./<path>"
+                digest, path = record.split(b"  ./", 1)
+                digests[os.fsdecode(path)] = digest.decode("ascii")
+            elif record[:1] == b"f":
+                size, mtime, mode, path = record[2:].split(b" ", 3)
+                files[os.fsdecode(path)] = FileEntry(
+                    int(size), float(mtime), int(mode, base=8), None
+                )
+            elif record[:1] == b"d":
+                dirs.add(os.fsdecode(record[2:]))
+            else:
+                others.add(os.fsdecode(record[2:]))
+        for rel_path, entry in files.items():
+            entry.sha256 = digests.get(rel_path)
+        return cls(files, dirs, others)
+
+
+@functools.lru_cache(maxsize=8192)
+def local_sha256(path: str, size: int, mtime_ns: int, ino: int) -> str:
+    """
+    Hashes a local file. The stat fields are part of the cache key so that a
+    modified file is hashed again.
+    """
+    # pylint: disable=W0613
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def remote_manifest_cmd(remote_dir: str) -> str:
+    """
+    Returns a shell command that prints the manifest of remote_dir in a single
+    round trip. A missing directory has an empty manifest.
+    """
+    return (
+        "cd -- {} 2>/dev/null || exit 0; "
+        "find . -mindepth 1 "
+        "\\( -type d -printf 'd %P\\0' \\) -o "
+        "\\( -type f -printf 'f %s %T@ %m %P\\0' \\) -o "
+        "-printf 'o %P\\0'; "
+        "find . -type f -exec sha256sum -z -- {{}} +"
+    ).format(shlex.quote(remote_dir))
+
+
+class TreeDiff:
+    """The changes needed to make a remote tree match a local one."""
+
+    def __init__(self) -> None:
+        # Remote paths to remove: extras (if deleting) and paths whose type
+        # differs from the local one. Only the topmost of nested paths.
+        self.removals: List[str] = []
+        # Remote directories to create.
+        self.mkdirs: List[str] = []
+        # Files whose contents are new or changed.
+        self.uploads: List[str] = []
+        # Existing remote files whose mode differs from the local mode.
+        self.chmods: Dict[str, int] = {}
+        # Number of files that are already up to date.
+        self.unchanged = 0
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.removals or self.mkdirs or self.uploads or self.chmods)
+
+    def summary(self) -> str:
+        return "{} to upload, {} to chmod, {} dirs to create, {} to remove".format(
+            len(self.uploads), len(self.chmods), len(self.mkdirs), len(self.removals)
+        )
+
+    def prepare_cmd(self, remote_dir: str) -> Optional[str]:
+        """
+        Returns a shell command that makes every change except uploads, or
+        None if there are none. It creates remote_dir if it doesn't exist.
+        """
+        if not (self.removals or self.mkdirs or self.chmods):
+            return None
+        quoted_dir = shlex.quote(remote_dir)
+        cmds = ["mkdir -p -- {0} && cd -- {0}".format(quoted_dir)]
+        if self.removals:
+            cmds.append("rm -rf -- " + _quote_paths(self.removals))
+        if self.mkdirs:
+            cmds.append("mkdir -p -- " + _quote_paths(self.mkdirs))
+        by_mode: Dict[int, List[str]] = {}
+        for path, mode in sorted(self.chmods.items()):
+            by_mode.setdefault(mode, []).append(path)
+        for mode, paths in sorted(by_mode.items()):
+            cmds.append("chmod {:o} -- {}".format(mode, _quote_paths(paths)))
+        return " && ".join(cmds)
+
+
+def _quote_paths(paths: List[str]) -> str:
+    # "./" keeps paths that start with "-" from being read as options.
+    return " ".join(shlex.quote("./" + path) for path in paths)
+
+
+def diff_manifests(local: Manifest, remote: Manifest, delete: bool) -> TreeDiff:
+    """
+    Args:
+        delete: Whether remote paths that aren't in the local tree should be
+            removed.
+    """
+    diff = TreeDiff()
+    removals: Set[str] = set()
+    for path in sorted(local.dirs):
+        if path in remote.dirs:
+            continue
+        if path in remote.files or path in remote.others:
+            removals.add(path)
+        diff.mkdirs.append(path)
+    for path, entry in sorted(local.files.items()):
+        remote_entry = remote.files.get(path)
+        if remote_entry is None:
+            if path in remote.dirs or path in remote.others:
+                removals.add(path)
+            diff.uploads.append(path)
+            continue
+        if remote_entry.size != entry.size or remote_entry.sha256 != entry.sha256:
+            diff.uploads.append(path)
+        else:
+            diff.unchanged += 1
+        if remote_entry.mode != entry.mode:
+            diff.chmods[path] = entry.mode
+    if delete:
+        removals.update(remote.files.keys() - local.files.keys())
+        removals.update(remote.others - local.files.keys())
+        removals.update(remote.dirs - local.dirs)
+    # Removing a directory removes everything under it.
+    diff.removals = [
+        path
+        for path in sorted(removals)
+        if not any(parent in removals for parent in _parents(path))
+    ]
+    return diff
+
+
+def _parents(path: str) -> List[str]:
+    parts = path.split("/")
+    return ["/".join(parts[:i]) for i in range(1, len(parts))]
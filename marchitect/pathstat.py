@@ -0,0 +1,133 @@
+"""
+The state of many remote paths (type, owner, group, mode, size, and
+optionally a digest), read with a single command.
+"""
+
+import shlex
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+)
+
+
+class PathStat:
+    """The state of a remote path, as reported by stat without following links."""
+
+    def __init__(
+        self,
+        file_type: str,
+        owner: str,
+        group: str,
+        mode: int,
+        size: int,
+        sha256: Optional[str] = None,
+    ):
+        """
+        Args:
+            file_type: As described by stat's %F, e.g. "directory",
+                "regular file", "regular empty file", or "symbolic link".
+            mode: Permission bits, including setuid, setgid, and sticky.
+            sha256: Hex digest of the contents of a regular file, if asked
+                for and readable.
+        """
+        self.file_type = file_type
+        self.owner = owner
+        self.group = group
+        self.mode = mode
+        self.size = size
+        self.sha256 = sha256
+
+    @property
+    def is_dir(self) -> bool:
+        return self.file_type == "directory"
+
+    @property
+    def is_file(self) -> bool:
+        return self.file_type in ("regular file", "regular empty file")
+
+    @property
+    def is_symlink(self) -> bool:
+        return self.file_type == "symbolic link"
+
+    def __repr__(self) -> str:
+        return "PathStat({!r}, {!r}, {!r}, {:o}, {}, {})".format(
+            self.file_type, self.owner, self.group, self.mode, self.size, self.sha256
+        )
+
+
+def stat_many_cmd(paths: Iterable[str], digest: bool = False) -> str:
+    """
+    Returns a shell command that prints one NUL-terminated record per path,
+    in order: the path's state, tab-separated, or "-" if it doesn't exist.
+    No field can hold a NUL, whatever characters the path or the names of
+    its owner and group have.
+    """
+    digest_cmd = (
+        'case "$s" in regular*) d=$(sha256sum < "$p" 2>/dev/null | cut -c1-64);; esac; '
+        if digest
+        else ""
+    )
+    return (
+        "for p in {paths}; do "
+        "if s=$(stat --printf '%F\\t%U\\t%G\\t%a\\t%s' -- \"$p\" 2>/dev/null); then "
+        "d=; {digest_cmd}"
+        'printf \'%s\\t%s\\0\' "$s" "$d"; '
+        "else printf '%s\\0' -; fi; "
+        "done"
+    ).format(
+        paths=" ".join(shlex.quote(path) for path in paths),
+        digest_cmd=digest_cmd,
+    )
+
+
+def parse_stat_many(paths: List[str], stdout: bytes) -> Dict[str, Optional[PathStat]]:
+    """
+    Parses the output of the command from :func:`stat_many_cmd`.
+
+    Returns:
+        Path -> its state, or None if it doesn't exist.
+    """
+    records = stdout.decode("utf-8", "replace").split("\0")
+    if len(records) != len(paths) + 1 or records[-1]:
+        raise ValueError(
+            "Expected {} stat results, got: {!r}".format(len(paths), stdout)
+        )
+    stats: Dict[str, Optional[PathStat]] = {}
+    for path, record in zip(paths, records):
+        if record == "-":
+            stats[path] = None
+            continue
+        file_type, owner, group, mode, size, sha256 = record.split("\t")
+        stats[path] = PathStat(
+            file_type, owner, group, int(mode, 8), int(size), sha256 or None
+        )
+    return stats
+
+
+def set_attrs_cmd(
+    path: str,
+    owner: Optional[str] = None,
+    group: Optional[str] = None,
+    mode: Optional[int] = None,
+) -> Optional[str]:
+    """
+    Returns a shell command that changes the owner, group, and mode of path
+    where they differ, or None if there's nothing to set.
+    """
+    quoted_path = shlex.quote(path)
+    cmds = []
+    for value, fmt, change in [
+        (owner, "%U", "chown"),
+        (group, "%G", "chgrp"),
+        (None if mode is None else "{:o}".format(mode), "%a", "chmod"),
+    ]:
+        if value is not None:
+            cmds.append(
+                '{{ [ "$(stat -c {fmt} -- {path})" = {value} ] || '
+                "{change} {value} -- {path}; }}".format(
+                    fmt=fmt, path=quoted_path, value=shlex.quote(value), change=change
+                )
+            )
+    return " && ".join(cmds) if cmds else None
@@ -1,86 +1,339 @@
+import json
+import re
 import shlex
+import threading
 from typing import (
     Dict,
+    Iterable,
+    Iterator,
     List,
     Optional,
 )
 
 import schema  # type: ignore
 
-from .whiteprint import Config, Prefab, Whiteprint
+from .facts import PackagesFacts
+from .pathstat import PathStat, set_attrs_cmd
+from .whiteprint import Config, Prefab, Whiteprint, WhiteprintError
 
+# Package name -> pinned version, or None if any version will do.
+PackageMap = Dict[str, Optional[str]]
 
-class Apt(Whiteprint):
-    cfg_schema = {
-        "packages": [schema.And(str, schema.Use(str.lower))],
-    }
+
+class PackageConflictError(WhiteprintError):
+    """Raised when a package is pinned to different versions in one run."""
+
+    def __init__(self, msg: str):
+        self.msg = msg
+        super().__init__(msg)
+
+    def log_msg(self) -> str:
+        return self.msg
+
+
+def merge_packages(manager: str, package_maps: Iterable[PackageMap]) -> PackageMap:
+    """
+    Merges package maps, in order of first appearance. A pinned version
+    takes precedence over an unpinned one.
+
+    Raises:
+        - PackageConflictError: If a package is pinned to different versions.
+    """
+    merged: PackageMap = {}
+    conflicts: Dict[str, List[str]] = {}
+    for package_map in package_maps:
+        for name, version in package_map.items():
+            cur_version = merged.get(name)
+            if cur_version is None:
+                merged[name] = version
+            elif version is not None and version != cur_version:
+                versions = conflicts.setdefault(name, [cur_version])
+                if version not in versions:
+                    versions.append(version)
+    if conflicts:
+        raise PackageConflictError(
+            "Conflicting {} package versions: {}".format(
+                manager,
+                "; ".join(
+                    "{} ({})".format(name, ", ".join(versions))
+                    for name, versions in conflicts.items()
+                ),
+            )
+        )
+    return merged
+
+
+class PackageRegistry:
+    """
+    The packages installed during a site plan's run, by package manager, so
+    that each package is installed at most once per run. Also caches what
+    the target host has installed, so that every installer of a run shares
+    one query per package manager.
+
+    Safe to share between steps running in parallel. Installs by the same
+    package manager are serialized, as dpkg would do anyway.
+    """
+
+    def __init__(self) -> None:
+        self.installed: Dict[str, PackageMap] = {}
+        # Package manager -> the packages installed on the target host, by
+        # name -> version. Dropped after each install.
+        self.state: Dict[str, Dict[str, str]] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+
+    def lock(self, manager: str) -> threading.Lock:
+        return self._locks.setdefault(manager, threading.Lock())
+
+    def missing(self, manager: str, package_map: PackageMap) -> PackageMap:
+        """
+        Returns:
+            The packages in package_map that haven't been installed yet.
+
+        Raises:
+            - PackageConflictError: If a package was installed pinned to a
+              different version.
+        """
+        installed = self.installed.get(manager, {})
+        merge_packages(manager, [installed, package_map])
+        return {
+            name: version
+            for name, version in package_map.items()
+            if name not in installed
+            or (version is not None and installed[name] is None)
+        }
+
+    def add(self, manager: str, package_map: PackageMap) -> None:
+        installed = self.installed.setdefault(manager, {})
+        installed.update(merge_packages(manager, [installed, package_map]))
+
+
+class PackageInstaller(Whiteprint):
+    """
+    Base for whiteprints that install packages listed in cfg["packages"].
+
+    Packages that the target host already has are skipped. When run by a
+    site plan, what the host has is queried once per run and shared by
+    every installer until one of them installs something, and packages
+    that were installed earlier in the run are skipped without a query. See
+    SitePlan.aggregate_packages for installing the packages of a whole plan
+    at once.
+    """
+
+    # Packages are deduplicated across installers with the same manager.
+    manager = ""
+
+    # Shell command that lists the installed packages.
+    state_cmd = ""
+
+    @staticmethod
+    def _mk_package_map(packages: List[str]) -> PackageMap:
+        raise NotImplementedError
+
+    @staticmethod
+    def _format_package(name: str, version: Optional[str]) -> str:
+        raise NotImplementedError
+
+    @staticmethod
+    def _parse_state(stdout: bytes) -> Dict[str, str]:
+        """Parses the output of state_cmd into name -> version."""
+        raise NotImplementedError
+
+    @staticmethod
+    def _normalize_name(name: str) -> str:
+        return name
+
+    def _install_cmd(self, packages: List[str]) -> str:
+        raise NotImplementedError
+
+    def package_map(self) -> PackageMap:
+        return self._mk_package_map(self.cfg["packages"])
+
+    def installed_packages(self) -> Dict[str, str]:
+        """
+        Returns:
+            The packages installed on the target host, by normalized name
+            -> version.
+        """
+        registry = self.site_plan.packages if self.site_plan is not None else None
+        if registry is not None:
+            state = registry.state.get(self.manager)
+            if state is not None:
+                return state
+        used, packages = self._try_agent("packages", manager=self.manager)
+        if used:
+            state = {
+                self._normalize_name(name): version
+                for name, version in packages.items()
+            }
+        else:
+            state = self._parse_state(self.exec(self.state_cmd).stdout)
+        if registry is not None:
+            registry.state[self.manager] = state
+        return state
+
+    def _not_installed(self, package_map: PackageMap) -> PackageMap:
+        installed = self.installed_packages()
+        return {
+            name: version
+            for name, version in package_map.items()
+            if self._normalize_name(name) not in installed
+            or (
+                version is not None and version != installed[self._normalize_name(name)]
+            )
+        }
+
+    def install_packages(self, package_map: PackageMap) -> None:
+        """
+        Installs the packages that the target host doesn't have, and that
+        this run hasn't installed yet.
+        """
+        if self.site_plan is None:
+            missing = self._not_installed(package_map)
+            if missing:
+                self.exec(self._install_cmd(self.format_packages(missing)))
+            return
+        registry = self.site_plan.packages
+        with registry.lock(self.manager):
+            missing = registry.missing(self.manager, package_map)
+            if not missing:
+                return
+            not_installed = self._not_installed(missing)
+            if not_installed:
+                self.exec(self._install_cmd(self.format_packages(not_installed)))
+                registry.state.pop(self.manager, None)
+            registry.add(self.manager, missing)
+
+    @classmethod
+    def format_packages(cls, package_map: PackageMap) -> List[str]:
+        """Returns the packages in the notation of cfg["packages"]."""
+        return [
+            cls._format_package(name, version) for name, version in package_map.items()
+        ]
 
     def _execute(self, mode: str) -> None:
         if mode == "install":
-            self.exec(
-                "DEBIAN_FRONTEND=noninteractive "
-                "apt install -y %s" % " ".join(self.cfg["packages"])
-            )
+            self.install_packages(self.package_map())
 
     def _validate(self, mode: str) -> Optional[str]:
-        if mode == "install":
-            res = self.exec("apt -qq list %s" % " ".join(self.cfg["packages"]))
-            installed_packages = set()
-            for line in res.stdout.decode("utf-8").splitlines():
-                installed_package, _ = line.split("/", 1)
-                installed_packages.add(installed_package.lower())
-            for package in self.cfg["packages"]:
-                if package not in installed_packages:
-                    return "Apt package %r missing." % package
-            return None
-        else:
+        if mode != "install":
             return None
+        installed = self.installed_packages()
+        label = self.manager.capitalize()
+        for name, version in self.package_map().items():
+            installed_version = installed.get(self._normalize_name(name))
+            if installed_version is None:
+                return "%s package %r missing." % (label, name)
+            elif version is not None and version != installed_version:
+                return "%s package %r wrong version: %r != %r" % (
+                    label,
+                    name,
+                    version,
+                    installed_version,
+                )
+        return None
 
 
-class Pip3(Whiteprint):
+def find_package_installers(whiteprint: Whiteprint) -> Iterator[PackageInstaller]:
+    """
+    Yields whiteprint and the prefabs it's made of, recursively, that are
+    package installers. Whiteprints nested with use_execute() can't be found
+    before they run.
+    """
+    for wp in whiteprint.prefab_whiteprints():
+        if isinstance(wp, PackageInstaller):
+            yield wp
+
+
+class Apt(PackageInstaller):
+    cfg_schema = {
+        # Pin version using '=X.Y.Z' notation.
+        "packages": [schema.And(str, schema.Use(str.lower))],
+    }
+
+    manager = "apt"
+
+    state_cmd = PackagesFacts.cmd
+
+    @staticmethod
+    def _mk_package_map(packages: List[str]) -> PackageMap:
+        """Returns dict mapping package to version."""
+        package_map: PackageMap = {}
+        for package in packages:
+            package_name, *version = package.split("=", 1)
+            package_map[package_name] = version[0] if version else None
+        return package_map
+
+    @staticmethod
+    def _format_package(name: str, version: Optional[str]) -> str:
+        return name if version is None else "{}={}".format(name, version)
+
+    @staticmethod
+    def _parse_state(stdout: bytes) -> Dict[str, str]:
+        return PackagesFacts().parse(stdout.decode("utf-8", "replace"))
+
+    def _install_cmd(self, packages: List[str]) -> str:
+        return "DEBIAN_FRONTEND=noninteractive apt install -y %s" % " ".join(packages)
+
+
+class Pip3(PackageInstaller):
     cfg_schema = {
         # Pin version using '==X.Y.Z' notation.
         "packages": [schema.And(str, schema.Use(str.lower))],
     }
 
+    manager = "pip3"
+
+    state_cmd = "pip3 list --format=json --disable-pip-version-check"
+
     @staticmethod
-    def _mk_package_map(packages: List[str]) -> Dict[str, Optional[str]]:
+    def _mk_package_map(packages: List[str]) -> PackageMap:
         """Returns dict mapping package to version."""
-        package_map: Dict[str, Optional[str]] = {}
+        package_map: PackageMap = {}
         for package in packages:
             package_name, *version = package.split("==", 1)
             package_map[package_name] = version[0] if version else None
         return package_map
 
-    def _execute(self, mode: str) -> None:
-        if mode == "install":
-            self.exec("pip3 install %s" % " ".join(self.cfg["packages"]))
+    @staticmethod
+    def _format_package(name: str, version: Optional[str]) -> str:
+        return name if version is None else "{}=={}".format(name, version)
 
-    def _validate(self, mode: str) -> Optional[str]:
-        package_map = Pip3._mk_package_map(self.cfg["packages"])
-        if mode == "install":
-            res = self.exec("pip3 show %s" % " ".join(package_map.keys()))
-            installed_packages: Dict[str, str] = {}
-            for line in res.stdout.decode("utf-8").splitlines():
-                # Assumes consistency in presence and order: Version must
-                # always exist after Name.
-                if line.startswith("Name: "):
-                    installed_package = line.split(maxsplit=1)[1]
-                elif line.startswith("Version: "):
-                    installed_version = line.split(maxsplit=1)[1]
-                    installed_packages[installed_package] = installed_version
-            for req_package, req_version in package_map.items():
-                if req_package not in installed_packages:
-                    return "Pip3 package %r missing." % req_package
-                elif req_version and req_version != installed_packages[req_package]:
-                    return "Pip3 package %r wrong version: %r != %r" % (
-                        req_package,
-                        req_version,
-                        installed_packages[req_package],
-                    )
-            return None
-        else:
-            return None
+    @staticmethod
+    def _parse_state(stdout: bytes) -> Dict[str, str]:
+        return {
+            Pip3._normalize_name(package["name"]): package["version"]
+            for package in json.loads(stdout.decode("utf-8"))
+        }
+
+    @staticmethod
+    def _normalize_name(name: str) -> str:
+        # Per PEP 503, e.g. "Foo_Bar" and "foo-bar" are the same package.
+        return re.sub(r"[-_.]+", "-", name).lower()
+
+    def _install_cmd(self, packages: List[str]) -> str:
+        return "pip3 install %s" % " ".join(packages)
+
+
+def _attrs_error(cfg: Config, quoted_path: str, stat: PathStat) -> Optional[str]:
+    """Describes how stat differs from the owner, group, and mode in cfg."""
+    if cfg.get("owner") is not None and stat.owner != cfg["owner"]:
+        return "expected %r to have owner %r, got %r" % (
+            quoted_path,
+            cfg["owner"],
+            stat.owner,
+        )
+    elif cfg.get("group") is not None and stat.group != cfg["group"]:
+        return "expected %r to have group %r, got %r" % (
+            quoted_path,
+            cfg["group"],
+            stat.group,
+        )
+    elif cfg.get("mode") is not None and stat.mode != cfg["mode"]:
+        return "expected {!r} to have mode {:o}, got {:o}.".format(
+            quoted_path, cfg["mode"], stat.mode
+        )
+    else:
+        return None
 
 
 class Folder(Whiteprint):
@@ -99,58 +352,40 @@ class Folder(Whiteprint):
     def _execute(self, mode: str) -> None:
         quoted_path = shlex.quote(self.cfg["path"])
         if mode == "install":
+            # Creating the folder and fixing up its attributes is a single
+            # round trip.
             cmd = "mkdir -p "
             if self.cfg.get("mode") is not None:
-                cmd += " -m {:o} ".format(self.cfg["mode"])
-            cmd += self.cfg["path"]
+                cmd += "-m {:o} ".format(self.cfg["mode"])
+            cmd += "-- " + quoted_path
+            attrs_cmd = set_attrs_cmd(
+                self.cfg["path"],
+                self.cfg.get("owner"),
+                self.cfg.get("group"),
+                self.cfg.get("mode"),
+            )
+            if attrs_cmd is not None:
+                cmd += " && " + attrs_cmd
             self.exec(cmd)
-            if self.cfg.get("owner") is not None:
-                self.exec("chown {} {}".format(self.cfg["owner"], quoted_path))
-            if self.cfg.get("group") is not None:
-                self.exec("chgrp {} {}".format(self.cfg["group"], quoted_path))
-            if self.cfg.get("mode") is not None:
-                self.exec("chmod {:o} {}".format(self.cfg["mode"], quoted_path))
         elif mode == "clean":
             if self.cfg["remove_on_clean"]:
                 self.exec("rm -rf {}".format(quoted_path))
 
+    def stat_paths(self, mode: str) -> List[str]:
+        return [self.cfg["path"]] if mode in ("install", "clean") else []
+
     def _validate(self, mode: str) -> Optional[str]:
         quoted_path = shlex.quote(self.cfg["path"])
         if mode == "install":
-            res = self.exec(
-                'stat -c "%F %U %G %a" {!r}'.format(quoted_path), error_ok=True
-            )
-            if res.exit_status == 1:
+            stat = self.stat_many([self.cfg["path"]])[self.cfg["path"]]
+            if stat is None:
                 return "%r does not exist." % quoted_path
-            # Use rsplit because %F can return "directory" or a multi-word like
-            # "regular empty file"
-            file_type, owner, group, file_mode_raw = (
-                res.stdout.decode("utf-8").strip().rsplit(maxsplit=3)
-            )
-            file_mode = int(file_mode_raw, base=8)
-            if file_type != "directory":
+            elif not stat.is_dir:
                 return "%r is not a directory." % quoted_path
-            elif self.cfg.get("owner") is not None and owner != self.cfg["owner"]:
-                return "expected %r to have owner %r, got %r" % (
-                    quoted_path,
-                    self.cfg["owner"],
-                    owner,
-                )
-            elif self.cfg.get("group") is not None and group != self.cfg["group"]:
-                return "expected %r to have group %r, got %r" % (
-                    quoted_path,
-                    self.cfg["group"],
-                    group,
-                )
-            elif self.cfg.get("mode") is not None and file_mode != self.cfg["mode"]:
-                return "expected {!r} to have mode {:o}, got {:o}.".format(
-                    quoted_path, self.cfg["mode"], file_mode
-                )
             else:
-                return None
+                return _attrs_error(self.cfg, quoted_path, stat)
         elif mode == "clean":
-            res = self.exec("stat {!r}".format(quoted_path), error_ok=True)
-            if res.exit_status != 1:
+            if self.stat_many([self.cfg["path"]])[self.cfg["path"]] is not None:
                 return "expected %r to not exist." % quoted_path
             else:
                 return None
@@ -158,24 +393,14 @@ class Folder(Whiteprint):
             return None
 
 
-class FileFromString(Whiteprint):
-    """
-    Creates a file from a template represented as a string.
+class _TemplatedFile(Whiteprint):
     """
+    Base for whiteprints that create a remote file from a template.
 
-    cfg_schema = {
-        "contents": str,
-        schema.Optional("cfg"): object,
-        "dest_path": str,
-        schema.Optional("owner"): str,
-        schema.Optional("group"): str,
-        schema.Optional("mode"): int,
-        "remove_on_clean": bool,
-    }
-
-    default_cfg = {
-        "remove_on_clean": True,
-    }
+    Uploads are skipped when the remote file's contents already match the
+    rendered template. Owner, group, and mode are reconciled separately so
+    they're corrected even when the contents are unchanged.
+    """
 
     @classmethod
     def _compute_prefabs_tail(cls, cfg: Config) -> List[Prefab]:
@@ -188,19 +413,25 @@ class FileFromString(Whiteprint):
             prefab_cfg["mode"] = cfg["mode"]
         return [Prefab(FileExistsValidator, prefab_cfg)]
 
+    def _upload(self) -> bool:
+        """Uploads the file unless unchanged. Returns whether it uploaded."""
+        raise NotImplementedError
+
+    def _reconcile_attrs(self) -> None:
+        cmd = set_attrs_cmd(
+            self.cfg["dest_path"],
+            self.cfg.get("owner"),
+            self.cfg.get("group"),
+            self.cfg.get("mode"),
+        )
+        if cmd is not None:
+            self.exec(cmd)
+
     def _execute(self, mode: str) -> None:
         quoted_path = shlex.quote(self.cfg["dest_path"])
         if mode in {"install", "update"}:
-            self.scp_up_template_from_str(
-                self.cfg["contents"],
-                self.cfg["dest_path"],
-                self.cfg.get("mode", 0o664),
-                self.cfg.get("cfg"),
-            )
-            if self.cfg.get("owner") is not None:
-                self.exec("chown {} {}".format(self.cfg["owner"], quoted_path))
-            if self.cfg.get("group") is not None:
-                self.exec("chgrp {} {}".format(self.cfg["group"], quoted_path))
+            self._upload()
+            self._reconcile_attrs()
         elif mode == "clean":
             if self.cfg["remove_on_clean"]:
                 self.exec("rm -rf {}".format(quoted_path))
@@ -209,7 +440,36 @@ class FileFromString(Whiteprint):
         return None
 
 
-class FileFromPath(Whiteprint):
+class FileFromString(_TemplatedFile):
+    """
+    Creates a file from a template represented as a string.
+    """
+
+    cfg_schema = {
+        "contents": str,
+        schema.Optional("cfg"): object,
+        "dest_path": str,
+        schema.Optional("owner"): str,
+        schema.Optional("group"): str,
+        schema.Optional("mode"): int,
+        "remove_on_clean": bool,
+    }
+
+    default_cfg = {
+        "remove_on_clean": True,
+    }
+
+    def _upload(self) -> bool:
+        return self.scp_up_template_from_str(
+            self.cfg["contents"],
+            self.cfg["dest_path"],
+            self.cfg.get("mode", 0o664),
+            self.cfg.get("cfg"),
+            skip_unchanged=True,
+        )
+
+
+class FileFromPath(_TemplatedFile):
     """
     Creates a file from a local resource template.
     """
@@ -224,39 +484,61 @@ class FileFromPath(Whiteprint):
         "remove_on_clean": bool,
     }
 
+    rsrc_cfg_keys = ["src_path"]
+
     default_cfg = {
         "remove_on_clean": True,
     }
 
-    @classmethod
-    def _compute_prefabs_tail(cls, cfg: Config) -> List[Prefab]:
-        prefab_cfg = {"path": cfg["dest_path"]}
-        if cfg.get("owner"):
-            prefab_cfg["owner"] = cfg["owner"]
-        if cfg.get("group"):
-            prefab_cfg["group"] = cfg["group"]
-        if cfg.get("mode"):
-            prefab_cfg["mode"] = cfg["mode"]
-        return [Prefab(FileExistsValidator, prefab_cfg)]
+    def _upload(self) -> bool:
+        return self.scp_up_template(
+            self.cfg["src_path"],
+            self.cfg["dest_path"],
+            self.cfg.get("mode"),
+            self.cfg.get("cfg"),
+            skip_unchanged=True,
+        )
+
+
+class DirectoryFromPath(Whiteprint):
+    """
+    Syncs a local directory tree to the target host. Only files that were
+    added or changed are uploaded.
+    """
+
+    cfg_schema = {
+        "src_path": str,
+        "dest_path": str,
+        "delete": bool,
+        "remove_on_clean": bool,
+    }
+
+    rsrc_cfg_keys = ["src_path"]
+
+    default_cfg = {
+        "delete": False,
+        "remove_on_clean": True,
+    }
 
     def _execute(self, mode: str) -> None:
-        quoted_path = shlex.quote(self.cfg["dest_path"])
         if mode in {"install", "update"}:
-            self.scp_up_template(
-                self.cfg["src_path"],
-                self.cfg["dest_path"],
-                self.cfg.get("mode"),
-                self.cfg.get("cfg"),
+            self.sync_tree(
+                self.cfg["src_path"], self.cfg["dest_path"], self.cfg["delete"]
             )
-            if self.cfg.get("owner") is not None:
-                self.exec("chown {} {}".format(self.cfg["owner"], quoted_path))
-            if self.cfg.get("group") is not None:
-                self.exec("chgrp {} {}".format(self.cfg["group"], quoted_path))
         elif mode == "clean":
             if self.cfg["remove_on_clean"]:
-                self.exec("rm -rf {}".format(quoted_path))
+                self.exec("rm -rf {}".format(shlex.quote(self.cfg["dest_path"])))
 
     def _validate(self, mode: str) -> Optional[str]:
+        if mode == "install":
+            diff = self.diff_tree(
+                self.cfg["src_path"], self.cfg["dest_path"], self.cfg["delete"]
+            )
+            if diff.changed:
+                return "%r is out of sync: %s." % (
+                    self.cfg["dest_path"],
+                    diff.summary(),
+                )
         return None
 
 
@@ -284,14 +566,16 @@ class Symlink(Whiteprint):
             if self.cfg["remove_on_clean"]:
                 self.exec(f"rm -rf {dest_path}")
 
+    def stat_paths(self, mode: str) -> List[str]:
+        return [self.cfg["dest_path"]] if mode == "install" else []
+
     def _validate(self, mode: str) -> Optional[str]:
         dest_path = shlex.quote(self.cfg["dest_path"])
         if mode == "install":
-            res = self.exec(f'stat -c "%F" {dest_path}', error_ok=True)
-            if res.exit_status == 1:
+            stat = self.stat_many([self.cfg["dest_path"]])[self.cfg["dest_path"]]
+            if stat is None:
                 return f"{dest_path} does not exist."
-            file_type = res.stdout.decode("utf-8").strip()
-            if file_type != "symbolic link":
+            if not stat.is_symlink:
                 return f"{dest_path} is not a symbolic link."
         return None
 
@@ -367,43 +651,21 @@ class FileExistsValidator(Whiteprint):
     def _execute(self, mode: str) -> None:
         return None
 
+    def stat_paths(self, mode: str) -> List[str]:
+        return [self.cfg["path"]] if mode in ("install", "clean") else []
+
     def _validate(self, mode: str) -> Optional[str]:
         quoted_path = shlex.quote(self.cfg["path"])
-        if mode in "install":
-            res = self.exec(
-                'stat -c "%F %U %G %a" {!r}'.format(quoted_path), error_ok=True
-            )
-            if res.exit_status == 1:
+        if mode == "install":
+            stat = self.stat_many([self.cfg["path"]])[self.cfg["path"]]
+            if stat is None:
                 return "%r does not exist." % quoted_path
-            # Use rsplit because %F can return "directory" or a multi-word like
-            # "regular empty file"
-            file_type, owner, group, file_mode_raw = (
-                res.stdout.decode("utf-8").strip().rsplit(maxsplit=3)
-            )
-            file_mode = int(file_mode_raw, base=8)
-            if file_type != "regular file":
+            elif not stat.is_file:
                 return "%r is not a file." % quoted_path
-            elif self.cfg.get("owner") is not None and owner != self.cfg["owner"]:
-                return "expected %r to have owner %r, got %r" % (
-                    quoted_path,
-                    self.cfg["owner"],
-                    owner,
-                )
-            elif self.cfg.get("group") is not None and group != self.cfg["group"]:
-                return "expected %r to have group %r, got %r" % (
-                    quoted_path,
-                    self.cfg["group"],
-                    group,
-                )
-            elif self.cfg.get("mode") is not None and file_mode != self.cfg["mode"]:
-                return "expected {!r} to have mode {:o}, got {:o}.".format(
-                    quoted_path, self.cfg["mode"], file_mode
-                )
             else:
-                return None
+                return _attrs_error(self.cfg, quoted_path, stat)
         elif mode == "clean":
-            res = self.exec("stat {!r}".format(quoted_path), error_ok=True)
-            if res.exit_status != 1:
+            if self.stat_many([self.cfg["path"]])[self.cfg["path"]] is not None:
                 return "expected %r to not exist." % quoted_path
             else:
                 return None
@@ -0,0 +1,182 @@
+import logging
+import select
+import socket
+import threading
+import time
+from typing import (
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from ssh2.exceptions import SSH2Error  # type: ignore  # pylint: disable=E0611
+from ssh2.session import Session  # type: ignore  # pylint: disable=E0611
+
+logger = logging.getLogger("marchitect.session_pool")
+
+
+class SessionPool:
+    """
+    Keeps authenticated SSH sessions open so they can be reused instead of
+    paying for a TCP connect, key exchange, and auth on every use.
+
+    Sessions are checked out with :meth:`acquire` and handed back with
+    :meth:`release` (or :meth:`discard` if they may be in a bad state). Idle
+    sessions are health checked before being handed out again and are
+    disconnected once they've been idle for longer than idle_timeout.
+
+    A pool is safe to share between threads and between site plans; sessions
+    are keyed so that only sessions for the same target are reused.
+    """
+
+    def __init__(self, idle_timeout: float = 300.0, keepalive_interval: int = 30):
+        """
+        Args:
+            idle_timeout: Seconds a session may sit unused in the pool before
+                it's disconnected.
+            keepalive_interval: Seconds between keepalive messages sent on
+                pooled sessions. Keepalives are only sent when the pool is
+                used, see :meth:`maintain`. If 0, keepalives are disabled.
+        """
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        # Number of acquires served by a pooled session.
+        self.hits = 0
+        # Number of acquires that had to connect.
+        self.misses = 0
+        self._idle: Dict[Hashable, List[Tuple[Session, float]]] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self) -> "SessionPool":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def acquire(self, key: Hashable, connect_func: Callable[[], Session]) -> Session:
+        """
+        Returns a healthy idle session for key, or a new one from connect_func.
+
+        Args:
+            key: Identifies the target, e.g. (user, hostname). Only sessions
+                released under the same key are reused.
+            connect_func: Called to connect when no pooled session is usable.
+        """
+        assert not self._closed, "Session pool is closed."
+        self.maintain()
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    self.misses += 1
+                    break
+                # Most recently used first: it's the least likely to be stale.
+                session, _ = idle.pop()
+            if self._is_healthy(session):
+                with self._lock:
+                    self.hits += 1
+                return session
+            logger.info("Dropping unhealthy pooled session for %r", key)
+            self._disconnect(session)
+        session = connect_func()
+        if self.keepalive_interval > 0:
+            session.keepalive_config(False, self.keepalive_interval)
+        return session
+
+    def release(self, key: Hashable, session: Session) -> None:
+        """Returns a session acquired for key to the pool for reuse."""
+        with self._lock:
+            if not self._closed:
+                self._idle.setdefault(key, []).append((session, time.monotonic()))
+                return
+        self._disconnect(session)
+
+    def discard(self, session: Session) -> None:
+        """Disconnects an acquired session rather than returning it."""
+        self._disconnect(session)
+
+    def maintain(self) -> None:
+        """
+        Disconnects sessions that have exceeded the idle timeout and sends
+        keepalives on the rest.
+
+        Called on every :meth:`acquire`. Programs that leave a pool unused for
+        long stretches may call this periodically to keep sessions open.
+        """
+        expired = []
+        now = time.monotonic()
+        with self._lock:
+            for key, idle in self._idle.items():
+                keep = []
+                for session, idle_since in idle:
+                    if now - idle_since > self.idle_timeout:
+                        expired.append(session)
+                    else:
+                        keep.append((session, idle_since))
+                self._idle[key] = keep
+            alive = [session for idle in self._idle.values() for session, _ in idle]
+        for session in expired:
+            self._disconnect(session)
+        if self.keepalive_interval > 0:
+            for session in alive:
+                try:
+                    session.keepalive_send()
+                except SSH2Error:
+                    # Caught by the health check when it's next acquired.
+                    pass
+
+    def drop_idle(self, key: Optional[Hashable] = None) -> None:
+        """
+        Disconnects the idle sessions for key, or all of them if key is None.
+        Unlike :meth:`close`, the pool can still be used.
+        """
+        with self._lock:
+            if key is None:
+                sessions = [
+                    session for idle in self._idle.values() for session, _ in idle
+                ]
+                self._idle.clear()
+            else:
+                sessions = [session for session, _ in self._idle.pop(key, [])]
+        for session in sessions:
+            self._disconnect(session)
+
+    @property
+    def idle_count(self) -> int:
+        """Number of idle sessions in the pool."""
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
+
+    def close(self) -> None:
+        """Disconnects all idle sessions. Released sessions are disconnected."""
+        with self._lock:
+            self._closed = True
+            sessions = [session for idle in self._idle.values() for session, _ in idle]
+            self._idle.clear()
+        for session in sessions:
+            self._disconnect(session)
+
+    @staticmethod
+    def _is_healthy(session: Session) -> bool:
+        sock = session.sock
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            # A readable socket with nothing to read has been closed by the
+            # peer.
+            if readable and not sock.recv(1, socket.MSG_PEEK):
+                return False
+            session.keepalive_send()
+        except (OSError, ValueError, SSH2Error):
+            return False
+        return True
+
+    @staticmethod
+    def _disconnect(session: Session) -> None:
+        try:
+            session.disconnect()
+        except (OSError, SSH2Error):
+            pass
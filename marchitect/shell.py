@@ -0,0 +1,87 @@
+"""
+A long-lived remote shell that runs commands one after another over a single
+channel, with each command's output followed by a marker so that the end of
+the output (and the exit status) can be told apart from the next command's.
+"""
+
+import shlex
+from typing import (
+    Optional,
+    Tuple,
+)
+import uuid
+
+# Started in the shell's channel. The login shell is used, as it is for
+# exec(), so commands are interpreted the same way. It must be compatible
+# with POSIX sh.
+SHELL_START_CMD = 'exec "${SHELL:-/bin/sh}" -s'
+
+
+def shell_marker() -> bytes:
+    """
+    A marker that's new for each shell, so that a command's output can't be
+    mistaken for one.
+    """
+    return "@@marchitect-shell-{}@@".format(uuid.uuid4().hex).encode("ascii")
+
+
+# The exit status reported for a command whose output couldn't be spooled,
+# e.g. because $TMPDIR is full or read-only. The command may have run.
+SPOOL_ERROR_STATUS = 255
+
+
+def shell_cmd_line(cmd: str, marker: bytes) -> bytes:
+    """
+    Returns what to write to the shell to run cmd. The shell replies on its
+    stdout with cmd's stdout, "<marker> <exit status>" and a newline, cmd's
+    stderr, and "<marker>" and a newline.
+
+    If cmd's output can't be spooled, the reply has no output, the status
+    SPOOL_ERROR_STATUS, and an error message in place of cmd's stderr.
+    """
+    # cmd runs in a subshell, without stdin, so that it can't change the
+    # environment or the working dir of the next one, exit the shell, or
+    # read the commands that follow it.
+    #
+    # The reply is assembled in a file and written with one cat: sshd doesn't
+    # disable Nagle's algorithm for non-interactive sessions, so a reply
+    # split across writes or streams can be held back until the first part
+    # is acknowledged, which delayed ACKs stretch to tens of milliseconds.
+    #
+    # If any step of assembling the reply fails, a reply is written directly
+    # instead so that the controller isn't left waiting for the marker, and
+    # the spool is dropped so that the next command makes a new one.
+    return (
+        '[ -n "$_mshell" ] || '
+        '{{ _mshell=$(mktemp -d "${{TMPDIR:-/tmp}}/marchitect-shell.XXXXXX") && trap \'rm -rf "$_mshell"\' EXIT || exit 1; }}; '
+        "{{ ( unset _mshell; eval {cmd} ) < /dev/null "
+        '> "$_mshell/out" 2> "$_mshell/err"; '
+        "printf '%s %d\\n' {mark} $? >> \"$_mshell/out\" && "
+        '{{ [ ! -s "$_mshell/err" ] || cat "$_mshell/err" >> "$_mshell/out"; }} && '
+        "printf '%s\\n' {mark} >> \"$_mshell/out\" && "
+        'cat "$_mshell/out"; }} 2> /dev/null || '
+        "{{ printf '%s %d\\n%s\\n%s\\n' {mark} {status} "
+        "'marchitect: the output of the command could not be spooled' {mark}; "
+        'rm -rf "$_mshell"; _mshell=; }}\n'.format(
+            cmd=shlex.quote(cmd),
+            mark=shlex.quote(marker.decode("ascii")),
+            status=SPOOL_ERROR_STATUS,
+        )
+    ).encode("utf-8")
+
+
+def split_reply(buf: bytearray, marker: bytes) -> Optional[Tuple[int, bytes, bytes]]:
+    """
+    Returns the exit status, stdout, and stderr of a command if buf holds the
+    shell's whole reply, or None if there's more to read.
+    """
+    suffix = marker + b"\n"
+    if not buf.endswith(suffix):
+        return None
+    start = buf.find(marker + b" ")
+    end = buf.index(b"\n", start)
+    return (
+        int(buf[start + len(marker) + 1 : end]),
+        bytes(buf[:start]),
+        bytes(buf[end + 1 : -len(suffix)]),
+    )
@@ -1,28 +1,62 @@
-import copy
+import asyncio
+import collections
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import contextlib
 import logging
 from pathlib import Path
 import socket
+import threading
 from typing import (
     Any,
+    AsyncIterator,
     Callable,
+    Counter,
     Dict,
+    Iterable,
+    Iterator,
     List,
     Optional,
+    Set,
+    Tuple,
     Type,
     Union,
 )
 
 from ssh2.session import Session  # type: ignore  # pylint: disable=E0611
 
-from .util import dict_deep_update
+from .facts import (
+    DEFAULT_FACT_PROVIDERS,
+    BaseFacts,
+    FactCache,
+    FactProvider,
+    Facts,
+    gather_cmd,
+    parse_gathered,
+)
+from .journal import Journal, read_journal_cmd, step_fingerprint, write_journal_cmd
+from .pathstat import PathStat
+from .prefab import (
+    PackageInstaller,
+    PackageMap,
+    PackageRegistry,
+    find_package_installers,
+    merge_packages,
+)
+from .session_pool import SessionPool
+from .tasks import TaskRegistry
+from .template import TemplateCache, get_template_cache
+from .util import LayeredConfig
 from .whiteprint import (
+    AsyncWhiteprint,
     ExecOutput,
+    Op,
+    Reactor,
+    Stdin,
     ValidationError,
     Whiteprint,
     WhiteprintError,
 )
 
-
 logger = logging.getLogger("marchitect.site_plan")
 
 
@@ -32,10 +66,21 @@ class Step:
         whiteprint_cls: Type[Whiteprint],
         cfg: Optional[Dict[str, Any]] = None,
         alias: Optional[str] = None,
+        depends_on: Optional[Iterable[Union[str, Type[Whiteprint]]]] = None,
     ):
+        """
+        Args:
+            depends_on: Steps that must be executed before this one, by alias
+                or by whiteprint class (which matches every step of that
+                class). If None, the step depends on the step before it in
+                the plan. Pass an empty list for a step that can run first.
+        """
         self.whiteprint_cls = whiteprint_cls
         self.cfg: Dict[str, Any] = cfg or {}
         self.alias = alias
+        self.depends_on: Optional[List[Union[str, Type[Whiteprint]]]] = (
+            list(depends_on) if depends_on is not None else None
+        )
 
 
 class SitePlan:
@@ -48,6 +93,41 @@ class SitePlan:
 
     default_cfg: Dict[str, Any] = {}
 
+    # Providers of the facts available to whiteprints as cfg["_target"]. Must
+    # include a BaseFacts.
+    fact_providers: List[FactProvider] = DEFAULT_FACT_PROVIDERS
+
+    # If true, a journal of the steps applied is kept on the target host, and
+    # steps are skipped in journaled_modes if they haven't changed since they
+    # were last applied in that mode.
+    skip_unchanged_steps = False
+
+    journaled_modes: Set[str] = {"install", "update"}
+
+    # Where the journal is kept, relative to the login user's home folder.
+    journal_path = ".marchitect/journal.json"
+
+    # Maximum number of steps executed at once. Only steps that declare
+    # depends_on can run alongside others; each running step gets its own
+    # session from the session pool.
+    max_parallel_steps = 1
+
+    # If true, install mode starts by installing the packages of every Apt
+    # and Pip3 in the plan (steps and their prefabs) with one command per
+    # package manager. Steps then find their packages already installed.
+    # Packages installed by earlier steps, e.g. apt repositories, aren't
+    # available to this first install.
+    aggregate_packages = False
+
+    # If true, whiteprints run commands without stdin in one long-lived shell
+    # per session rather than a new channel each (see
+    # Whiteprint.persistent_shell).
+    persistent_shell = False
+
+    # If true, whiteprints use a helper agent on the target host where it
+    # saves round trips (see Whiteprint.use_agent).
+    use_agent = False
+
     def __init__(
         self,
         user: str,
@@ -55,6 +135,9 @@ class SitePlan:
         connect_func: Callable[[], Session],
         cfg: Dict[Union[str, Type[Whiteprint]], Dict[str, Any]],
         rsrc_paths: List[Path],
+        session_pool: Optional[SessionPool] = None,
+        template_cache: Optional[TemplateCache] = None,
+        fact_cache: Optional[FactCache] = None,
     ):
         """
         Args:
@@ -64,16 +147,46 @@ class SitePlan:
             cfg: Configurations for whiteprints.
             rsrc_paths: Paths to whiteprint resource folders. The path should
                 contain sub-folders with names matching whiteprints.
+            session_pool: Pool to reuse SSH sessions from. It may be shared
+                with other site plans. If None, the site plan creates its own
+                pool, which is closed by :meth:`close`.
+            template_cache: Where compiled templates are cached. If None, a
+                process-wide cache for rsrc_paths is used so that site plans
+                for different hosts share compiled templates.
+            fact_cache: Where facts about the target host are cached. It may
+                be shared with other site plans. If None, the site plan keeps
+                facts in memory for an hour.
         """
         self.user = user
         self.hostname = hostname
         self.connect_func = connect_func
+        self._owns_session_pool = session_pool is None
+        self.session_pool = session_pool if session_pool is not None else SessionPool()
         self.cfg = cfg
         for rsrc_path in rsrc_paths:
             assert rsrc_path.exists()
         self.rsrc_paths = rsrc_paths
-        # Config extracted from target host
+        self.template_cache = (
+            template_cache
+            if template_cache is not None
+            else get_template_cache(rsrc_paths)
+        )
+        self.fact_cache = fact_cache if fact_cache is not None else FactCache()
+        # If set, used as cfg["_target"] instead of facts gathered from the
+        # target host.
         self.target_host_cfg: Optional[Dict[str, Any]] = None
+        # Counters from the last execute(), e.g. files_uploaded and
+        # files_skipped.
+        self.stats: Counter[str] = collections.Counter()
+        # Packages installed by the last execute(), and the target host's
+        # packages as of the last execute() or validate().
+        self.packages = PackageRegistry()
+        # Tasks shared by the whiteprints of the last execute(), see
+        # Whiteprint.once() and Whiteprint.notify().
+        self.tasks = TaskRegistry()
+        # Paths stat'ed up front by the last validate(), see
+        # Whiteprint.stat_paths().
+        self.path_stats: Dict[str, Optional[PathStat]] = {}
         self.logger = logging.getLogger(
             "{parent}.{name}.{target}".format(
                 parent=logger.name,
@@ -92,6 +205,9 @@ class SitePlan:
         private_key_password: Optional[str],
         cfg: Dict[Union[str, Type[Whiteprint]], Dict[str, Any]],
         rsrc_paths: List[Path],
+        session_pool: Optional[SessionPool] = None,
+        template_cache: Optional[TemplateCache] = None,
+        fact_cache: Optional[FactCache] = None,
     ) -> "SitePlan":
         """
         Creates a SitePlan that connects to the target host via a private key.
@@ -108,7 +224,16 @@ class SitePlan:
             session.set_blocking(False)
             return session
 
-        return cls(user, hostname, connect, cfg, rsrc_paths)
+        return cls(
+            user,
+            hostname,
+            connect,
+            cfg,
+            rsrc_paths,
+            session_pool,
+            template_cache,
+            fact_cache,
+        )
 
     @classmethod
     def from_password(
@@ -119,6 +244,9 @@ class SitePlan:
         password: str,
         cfg: Dict[Union[str, Type[Whiteprint]], Dict[str, Any]],
         rsrc_paths: List[Path],
+        session_pool: Optional[SessionPool] = None,
+        template_cache: Optional[TemplateCache] = None,
+        fact_cache: Optional[FactCache] = None,
     ) -> "SitePlan":
         """
         Creates a SitePlan that connects to the target host via a user & pass.
@@ -135,7 +263,35 @@ class SitePlan:
             session.set_blocking(False)
             return session
 
-        return cls(user, hostname, connect, cfg, rsrc_paths)
+        return cls(
+            user,
+            hostname,
+            connect,
+            cfg,
+            rsrc_paths,
+            session_pool,
+            template_cache,
+            fact_cache,
+        )
+
+    def __enter__(self) -> "SitePlan":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Disconnects pooled sessions unless the pool was passed in."""
+        if self._owns_session_pool:
+            self.session_pool.close()
+
+    def drop_idle_sessions(self) -> None:
+        """
+        Disconnects the pooled sessions to the target host that aren't in
+        use. Unlike :meth:`close`, the site plan can still be used, at the
+        cost of connecting again.
+        """
+        self.session_pool.drop_idle((self.user, self.hostname))
 
     @staticmethod
     def _create_session(hostname: str, port: int) -> Session:
@@ -145,6 +301,28 @@ class SitePlan:
         session.handshake(sock)
         return session
 
+    @contextlib.contextmanager
+    def _session(self) -> Iterator[Tuple[Session, Reactor]]:
+        """
+        Checks out a session from the pool. It's returned to the pool on
+        success, and disconnected on error since it may have been left
+        mid-operation.
+        """
+        key = (self.user, self.hostname)
+        session = self.session_pool.acquire(key, self.connect_func)
+        reactor = Reactor(session)
+        try:
+            yield session, reactor
+        except BaseException:
+            # The shell and the agent go away with the session.
+            reactor.discard_shell()
+            reactor.discard_agent()
+            reactor.close()
+            self.session_pool.discard(session)
+            raise
+        reactor.close()
+        self.session_pool.release(key, session)
+
     def _resolve_whiteprint_rsrc_path(
         self, whiteprint_cls: Type[Whiteprint]
     ) -> Optional[Path]:
@@ -156,67 +334,534 @@ class SitePlan:
                 return p
         return None
 
-    def _get_target_host_cfg(self, session: Session) -> Dict[str, Any]:
+    def _declared_facts(self) -> List[str]:
+        """Names of the facts that the plan's whiteprints declare they use."""
+        names: Dict[str, None] = {}
+        for step in self.plan:
+            wp_cls = step.whiteprint_cls
+            for cls in [wp_cls] + [
+                prefab.whiteprint_cls
+                for prefab in wp_cls.prefabs_head + wp_cls.prefabs_tail
+            ]:
+                names.update(dict.fromkeys(cls.facts))
+        return list(names)
+
+    def _gather_facts(
+        self, session: Session, reactor: Reactor, names: Iterable[str]
+    ) -> Dict[str, Any]:
+        """
+        Gathers facts by name, in one command for all of those that aren't
+        cached.
+        """
+        return reactor.run(self._gather_facts_op(session, reactor, names))
+
+    def _gather_facts_op(
+        self, session: Session, reactor: Reactor, names: Iterable[str]
+    ) -> Op[Dict[str, Any]]:
+        providers_by_name = {
+            provider.name: provider for provider in self.fact_providers
+        }
+        providers = []
+        for name in names:
+            if name not in providers_by_name:
+                raise ValueError("Unknown fact: %r" % name)
+            providers.append(providers_by_name[name])
+        host_key = "{}@{}".format(self.user, self.hostname)
+        facts = self.fact_cache.get(host_key, providers)
+        missing = [provider for provider in providers if provider.name not in facts]
+        if missing:
+            self.logger.debug("Gathering facts: %s", ", ".join(p.name for p in missing))
+            wp = Whiteprint(session, reactor=reactor)
+            r = yield from wp._exec_collect_op(  # pylint: disable=W0212
+                gather_cmd(missing), None, True
+            )
+            gathered = parse_gathered(missing, r.stdout)
+            self.fact_cache.put(host_key, missing, gathered)
+            facts.update(gathered)
+        return facts
+
+    def _mk_facts(
+        self,
+        gathered: Dict[str, Any],
+        fetch: Callable[[List[str]], Dict[str, Any]],
+    ) -> Facts:
+        """
+        Args:
+            fetch: Gathers facts that are looked up later, when it's OK to
+                block. Templates gather them over their whiteprint's own
+                session instead.
+        """
+        facts = dict(user=self.user, host=self.hostname, **gathered.pop(BaseFacts.name))
+        facts.update(gathered)
+        names = [
+            provider.name
+            for provider in self.fact_providers
+            if provider.name != BaseFacts.name
+        ]
+        return Facts(facts, names, fetch, self._gather_facts_op)
+
+    def _get_target_host_cfg(
+        self, session: Session, reactor: Reactor
+    ) -> Union[Facts, Dict[str, Any]]:
+        """
+        Gathers the base facts and those declared by the plan's whiteprints.
+        Others are gathered on first use, over the same session.
+        """
         if self.target_host_cfg is not None:
             return self.target_host_cfg
-        target_vars_wp = Whiteprint(session)
-        r = target_vars_wp.exec(
-            "uname -r && "
-            "lsb_release -sir && "
-            "hostname && "
-            "hostname -f && "
-            "cat /proc/cpuinfo | grep processor | wc -l"
+        gathered = self._gather_facts(
+            session, reactor, [BaseFacts.name] + self._declared_facts()
         )
-        vals = r.stdout.decode("utf-8").splitlines()
-        self.target_host_cfg = dict(
-            user=self.user,
-            host=self.hostname,
-            kernel=vals[0],
-            distro=vals[1].lower(),
-            distro_version=vals[2],
-            hostname=vals[3],
-            fqdn=vals[4],
-            cpu_count=int(vals[5]),
+        # Steps running in parallel may look up facts at the same time, but
+        # only one of them can use the session.
+        lock = threading.Lock()
+
+        def fetch(names: List[str]) -> Dict[str, Any]:
+            with lock:
+                return self._gather_facts(session, reactor, names)
+
+        return self._mk_facts(gathered, fetch)
+
+    def gather_facts(self, names: Optional[Iterable[str]] = None) -> Facts:
+        """
+        Gathers facts about the target host, or returns them from the fact
+        cache if they're fresh.
+
+        Args:
+            names: Names of the facts to gather besides the base ones. If
+                None, every fact is gathered.
+        """
+
+        def fetch(fetch_names: List[str]) -> Dict[str, Any]:
+            with self._session() as (session, reactor):
+                return self._gather_facts(session, reactor, fetch_names)
+
+        if names is None:
+            names = [provider.name for provider in self.fact_providers]
+        return self._mk_facts(fetch([BaseFacts.name] + list(names)), fetch)
+
+    def _mk_whiteprint(
+        self,
+        step: Step,
+        session: Session,
+        reactor: Reactor,
+        target_host_cfg: Union[Facts, Dict[str, Any]],
+        stats: Optional[Counter[str]] = None,
+    ) -> Whiteprint:
+        rsrc_path = self._resolve_whiteprint_rsrc_path(step.whiteprint_cls)
+        # Highest precedence first. Layers are merged on lookup rather than
+        # copied, so this is cheap however large the configs are.
+        layers = [
+            self.cfg.get(step.whiteprint_cls, {}),
+            step.cfg,
+            {"_target": target_host_cfg},
+            self.default_cfg,
+        ]
+        if step.alias is not None:
+            layers.insert(0, self.cfg.get(step.alias, {}))
+        return step.whiteprint_cls(
+            session,
+            LayeredConfig(layers),
+            rsrc_path,
+            reactor,
+            self.template_cache,
+            self.stats if stats is None else stats,
+            self,
+        )
+
+    def _step_keys(self) -> List[str]:
+        """
+        Names the steps in the journal by alias, or else by whiteprint class
+        name with a suffix for repeats.
+        """
+        keys = []
+        seen: Counter[str] = collections.Counter()
+        for step in self.plan:
+            key = step.alias or step.whiteprint_cls.__name__
+            seen[key] += 1
+            keys.append(key if seen[key] == 1 else "{}#{}".format(key, seen[key]))
+        return keys
+
+    def _step_deps(self, step_keys: List[str]) -> List[Set[int]]:
+        """
+        Returns:
+            For each step, the indexes of the steps it depends on.
+        """
+        deps = []
+        for i, step in enumerate(self.plan):
+            if step.depends_on is None:
+                deps.append({i - 1} if i > 0 else set())
+                continue
+            step_deps = set()
+            for ref in step.depends_on:
+                matches = {
+                    j
+                    for j, other in enumerate(self.plan)
+                    if j != i and (other.alias == ref or other.whiteprint_cls is ref)
+                }
+                if not matches:
+                    raise ValueError(
+                        "Unknown dependency of {}: {!r}".format(step_keys[i], ref)
+                    )
+                step_deps |= matches
+            deps.append(step_deps)
+        return deps
+
+    @staticmethod
+    def _step_order(deps: List[Set[int]], step_keys: List[str]) -> List[int]:
+        """
+        Orders steps after the steps they depend on, and otherwise in plan
+        order.
+        """
+        order: List[int] = []
+        done: Set[int] = set()
+        pending = list(range(len(deps)))
+        while pending:
+            ready = next((i for i in pending if deps[i] <= done), None)
+            if ready is None:
+                raise ValueError(
+                    "Circular dependencies between steps: {}".format(
+                        ", ".join(step_keys[i] for i in pending)
+                    )
+                )
+            pending.remove(ready)
+            done.add(ready)
+            order.append(ready)
+        return order
+
+    def _parallel(self) -> bool:
+        return self.max_parallel_steps > 1 and any(
+            step.depends_on is not None for step in self.plan
+        )
+
+    def _aggregate_packages(
+        self,
+        mode: str,
+        force: bool,
+        step_keys: List[str],
+        session: Session,
+        reactor: Reactor,
+        target_host_cfg: Union[Facts, Dict[str, Any]],
+        journal: Optional[Journal],
+    ) -> None:
+        """
+        Installs the packages of every package installer in the plan, one
+        command per package manager, leaving out steps that will be skipped.
+
+        Raises:
+            - PackageConflictError: Before anything is installed, if a
+              package is pinned to different versions.
+        """
+        if mode != "install" or not self.aggregate_packages:
+            return
+        # Package manager -> the first installer class seen for it.
+        installer_clss: Dict[str, Type[PackageInstaller]] = {}
+        package_maps: Dict[str, List[PackageMap]] = {}
+        for step, step_key in zip(self.plan, step_keys):
+            whiteprint = self._mk_whiteprint(step, session, reactor, target_host_cfg)
+            if journal is not None and self._should_skip(
+                journal, step_key, mode, step_fingerprint(whiteprint), force
+            ):
+                continue
+            for installer in find_package_installers(whiteprint):
+                installer_clss.setdefault(installer.manager, type(installer))
+                package_maps.setdefault(installer.manager, []).append(
+                    installer.package_map()
+                )
+        # Merged before installing anything so that conflicts fail fast.
+        merged = [
+            (installer_clss[manager], merge_packages(manager, maps))
+            for manager, maps in package_maps.items()
+        ]
+        for installer_cls, package_map in merged:
+            self.logger.info(
+                "Installing %d %s packages", len(package_map), installer_cls.manager
+            )
+            installer = installer_cls(
+                session,
+                {"packages": installer_cls.format_packages(package_map)},
+                None,
+                reactor,
+                self.template_cache,
+                self.stats,
+                self,
+            )
+            installer.install_packages(package_map)
+
+    def _prefetch_stats(
+        self,
+        mode: str,
+        session: Session,
+        reactor: Reactor,
+        whiteprints: List[Whiteprint],
+    ) -> None:
+        """
+        Stats the paths that validating whiteprints in mode will stat, with
+        one command.
+        """
+        paths = [
+            path
+            for whiteprint in whiteprints
+            for wp in whiteprint.prefab_whiteprints()
+            for path in wp.stat_paths(mode)
+        ]
+        if paths:
+            wp = Whiteprint(session, reactor=reactor)
+            self.path_stats = wp.stat_many(paths)
+
+    def _run_notified(self, mode: str, session: Session, reactor: Reactor) -> None:
+        """Executes the tasks that steps queued with Whiteprint.notify()."""
+        wp = Whiteprint(session, reactor=reactor)
+        for name, cmd in self.tasks.pop_notified():
+            self.logger.info("Running notified task %s (%s)", name, mode)
+            try:
+                wp.exec(cmd)
+            except WhiteprintError as e:
+                self.logger.error(e.log_msg())
+                raise
+
+    def _read_journal(self, session: Session, reactor: Reactor) -> Optional[Journal]:
+        if not self.skip_unchanged_steps:
+            return None
+        wp = Whiteprint(session, reactor=reactor)
+        return Journal.from_bytes(wp.exec(read_journal_cmd(self.journal_path)).stdout)
+
+    def _write_journal(
+        self, session: Session, reactor: Reactor, journal: Optional[Journal]
+    ) -> None:
+        if journal is None or not journal.changed:
+            return
+        wp = Whiteprint(session, reactor=reactor)
+        try:
+            wp.exec(write_journal_cmd(self.journal_path), stdin=journal.to_bytes())
+        except WhiteprintError as e:
+            # The steps were applied either way.
+            self.logger.warning("Failed to write journal: %s", e.log_msg())
+            return
+        journal.changed = False
+
+    def _should_skip(
+        self,
+        journal: Optional[Journal],
+        step_key: str,
+        mode: str,
+        fingerprint: Optional[str],
+        force: bool,
+    ) -> bool:
+        return (
+            journal is not None
+            and not force
+            and mode in self.journaled_modes
+            and fingerprint is not None
+            and journal.fingerprint(type(self).__name__, step_key, mode) == fingerprint
+        )
+
+    def _log_stats(self, mode: str) -> None:
+        if self.stats["steps_skipped"]:
+            self.logger.info(
+                "Skipped %d unchanged steps (%s)", self.stats["steps_skipped"], mode
+            )
+        if self.stats["files_uploaded"] or self.stats["files_skipped"]:
+            self.logger.info(
+                "Uploaded %d files, skipped %d unchanged (%s)",
+                self.stats["files_uploaded"],
+                self.stats["files_skipped"],
+                mode,
+            )
+
+    def _log_validation_error(self, step: Step, mode: str, err_msg: str) -> None:
+        self.logger.error(
+            "%s failed validation (%s): %s",
+            step.whiteprint_cls.__name__,
+            mode,
+            err_msg,
         )
-        return self.target_host_cfg
 
     def one_off_exec(
-        self, cmd: str, stdin: Optional[bytes] = None, error_ok: bool = False
+        self, cmd: str, stdin: Stdin = None, error_ok: bool = False
     ) -> ExecOutput:
-        session = self.connect_func()
-        wp = Whiteprint(session, None, None)
-        try:
+        with self._session() as (session, reactor):
+            wp = Whiteprint(session, None, None, reactor)
             return wp.exec(cmd, stdin=stdin, error_ok=error_ok)
-        finally:
-            session.disconnect()
 
-    def execute(self, mode: str) -> None:
-        session = self.connect_func()
-        target_host_cfg = self._get_target_host_cfg(session)
-        for step in self.plan:
-            rsrc_path = self._resolve_whiteprint_rsrc_path(step.whiteprint_cls)
-            site_cfg = copy.deepcopy(self.default_cfg)
-            site_cfg["_target"] = target_host_cfg
-            dict_deep_update(site_cfg, step.cfg)
-            dict_deep_update(site_cfg, self.cfg.get(step.whiteprint_cls, {}))
-            if step.alias is not None:
-                dict_deep_update(site_cfg, self.cfg.get(step.alias, {}))
-            self.logger.info("Executing %s (%s)", step.whiteprint_cls.__name__, mode)
-            whiteprint = step.whiteprint_cls(session, site_cfg, rsrc_path)
+    def _execute_step(
+        self,
+        mode: str,
+        force: bool,
+        step: Step,
+        step_key: str,
+        session: Session,
+        reactor: Reactor,
+        target_host_cfg: Union[Facts, Dict[str, Any]],
+        journal: Optional[Journal],
+        stats: Counter[str],
+    ) -> Tuple[bool, Optional[str]]:
+        """
+        Returns:
+            Whether the step was executed rather than skipped, and its
+            fingerprint, or None if it ran whiteprints other than its
+            prefabs so that it's never skipped.
+        """
+        whiteprint = self._mk_whiteprint(step, session, reactor, target_host_cfg, stats)
+        fingerprint = step_fingerprint(whiteprint)
+        if self._should_skip(journal, step_key, mode, fingerprint, force):
+            self.logger.info(
+                "Skipping %s (%s): unchanged", step.whiteprint_cls.__name__, mode
+            )
+            stats["steps_skipped"] += 1
+            return False, fingerprint
+        self.logger.info("Executing %s (%s)", step.whiteprint_cls.__name__, mode)
+        try:
+            whiteprint.execute(mode)
+        except WhiteprintError as e:
+            log_msg = e.log_msg()
+            if log_msg is not None:
+                self.logger.error(log_msg)
+            raise
+        return True, None if whiteprint.delegated else fingerprint
+
+    def _record_step(
+        self,
+        journal: Optional[Journal],
+        step: Step,
+        step_key: str,
+        mode: str,
+        fingerprint: Optional[str],
+    ) -> None:
+        if journal is not None:
+            journal.record(
+                type(self).__name__, step_key, mode, step.whiteprint_cls, fingerprint
+            )
+
+    def _execute_parallel(
+        self,
+        mode: str,
+        force: bool,
+        step_keys: List[str],
+        deps: List[Set[int]],
+        target_host_cfg: Union[Facts, Dict[str, Any]],
+        journal: Optional[Journal],
+    ) -> None:
+        """
+        Executes each step as soon as the steps it depends on are done, up to
+        max_parallel_steps at once. After a failure, no more steps are
+        started, and the first error is raised once running steps finish.
+        """
+
+        def run(i: int, stats: Counter[str]) -> Tuple[bool, Optional[str]]:
+            with self._session() as (session, reactor):
+                return self._execute_step(
+                    mode,
+                    force,
+                    self.plan[i],
+                    step_keys[i],
+                    session,
+                    reactor,
+                    target_host_cfg,
+                    journal,
+                    stats,
+                )
+
+        pending = list(range(len(self.plan)))
+        done: Set[int] = set()
+        error: Optional[BaseException] = None
+        with ThreadPoolExecutor(max_workers=self.max_parallel_steps) as executor:
+            # Each step counts into its own stats, merged as it finishes.
+            running: Dict[Future[Tuple[bool, Optional[str]]], int] = {}
+            step_stats: Dict[int, Counter[str]] = {}
+            while True:
+                if error is None:
+                    for i in [i for i in pending if deps[i] <= done]:
+                        if len(running) >= self.max_parallel_steps:
+                            break
+                        pending.remove(i)
+                        step_stats[i] = collections.Counter()
+                        running[executor.submit(run, i, step_stats[i])] = i
+                if not running:
+                    break
+                for future in wait(running, return_when=FIRST_COMPLETED).done:
+                    i = running.pop(future)
+                    self.stats.update(step_stats.pop(i))
+                    try:
+                        executed, fingerprint = future.result()
+                    except BaseException as e:  # pylint: disable=W0703
+                        if error is None:
+                            error = e
+                        continue
+                    done.add(i)
+                    if executed:
+                        self._record_step(
+                            journal, self.plan[i], step_keys[i], mode, fingerprint
+                        )
+        if error is not None:
+            raise error
+
+    def execute(self, mode: str, force: bool = False) -> None:
+        """
+        Executes the plan's steps, each after the steps it depends on. With
+        max_parallel_steps > 1, independent steps run at the same time.
+
+        Args:
+            force: If true, steps are executed even if skip_unchanged_steps is
+                set and the journal says they're unchanged.
+        """
+        self.stats = collections.Counter()
+        self.packages = PackageRegistry()
+        self.tasks = TaskRegistry()
+        self.path_stats = {}
+        step_keys = self._step_keys()
+        deps = self._step_deps(step_keys)
+        order = self._step_order(deps, step_keys)
+        with self._session() as (session, reactor):
+            target_host_cfg = self._get_target_host_cfg(session, reactor)
+            journal = self._read_journal(session, reactor)
             try:
-                whiteprint.execute(mode)
-            except WhiteprintError as e:
-                log_msg = e.log_msg()
-                if log_msg is not None:
-                    self.logger.error(log_msg)
+                self._aggregate_packages(
+                    mode,
+                    force,
+                    step_keys,
+                    session,
+                    reactor,
+                    target_host_cfg,
+                    journal,
+                )
+                if self._parallel():
+                    self._execute_parallel(
+                        mode, force, step_keys, deps, target_host_cfg, journal
+                    )
+                else:
+                    for i in order:
+                        step = self.plan[i]
+                        executed, fingerprint = self._execute_step(
+                            mode,
+                            force,
+                            step,
+                            step_keys[i],
+                            session,
+                            reactor,
+                            target_host_cfg,
+                            journal,
+                            self.stats,
+                        )
+                        if executed:
+                            self._record_step(
+                                journal, step, step_keys[i], mode, fingerprint
+                            )
+                self._run_notified(mode, session, reactor)
+            except BaseException:
+                # Keep the records of the steps that succeeded, but don't let
+                # a failure to write them hide the original error.
+                with contextlib.suppress(Exception):
+                    self._write_journal(session, reactor, journal)
                 raise
-        session.disconnect()
+            self._write_journal(session, reactor, journal)
+        self._log_stats(mode)
 
-    def install(self) -> None:
-        self.execute("install")
+    def install(self, force: bool = False) -> None:
+        self.execute("install", force)
 
-    def update(self) -> None:
-        self.execute("update")
+    def update(self, force: bool = False) -> None:
+        self.execute("update", force)
 
     def clean(self) -> None:
         self.execute("clean")
@@ -228,30 +873,291 @@ class SitePlan:
         self.execute("stop")
 
     def validate(self, mode: str) -> Optional[str]:
-        session = self.connect_func()
-        target_host_cfg = self._get_target_host_cfg(session)
         err_msg = None
-        for step in self.plan:
-            rsrc_path = self._resolve_whiteprint_rsrc_path(step.whiteprint_cls)
-            site_cfg = copy.deepcopy(self.default_cfg)
-            site_cfg["_target"] = target_host_cfg
-            dict_deep_update(site_cfg, step.cfg)
-            dict_deep_update(site_cfg, self.cfg.get(step.whiteprint_cls, {}))
-            if step.alias is not None:
-                dict_deep_update(site_cfg, self.cfg.get(step.alias, {}))
-            self.logger.info("Validating %s (%s)", step.whiteprint_cls.__name__, mode)
-            whiteprint = step.whiteprint_cls(session, site_cfg, rsrc_path)
+        self.packages = PackageRegistry()
+        self.path_stats = {}
+        with self._session() as (session, reactor):
+            target_host_cfg = self._get_target_host_cfg(session, reactor)
+            whiteprints = [
+                self._mk_whiteprint(step, session, reactor, target_host_cfg)
+                for step in self.plan
+            ]
+            self._prefetch_stats(mode, session, reactor, whiteprints)
+            for step, whiteprint in zip(self.plan, whiteprints):
+                self.logger.info(
+                    "Validating %s (%s)", step.whiteprint_cls.__name__, mode
+                )
+                try:
+                    err_msg = whiteprint.validate(mode)
+                except ValidationError as e:
+                    err_msg = e.log_msg()
+                if err_msg is not None:
+                    self._log_validation_error(step, mode, err_msg)
+                    break
+        return err_msg
+
+
+class AsyncSitePlan(SitePlan):
+    """
+    A site plan whose modes are coroutines, for use from an asyncio program.
+
+    Steps with AsyncWhiteprints run on the event loop. Other whiteprints run
+    in the loop's default executor, as does connecting to the target host
+    since libssh2 handshakes and authenticates in blocking mode.
+    """
+
+    # Coroutine counterparts of the SitePlan methods they override.
+    # pylint: disable=W0236
+
+    @contextlib.asynccontextmanager
+    async def _session_async(self) -> AsyncIterator[Tuple[Session, Reactor]]:
+        """
+        Like :meth:`SitePlan._session`, but connects in the default executor.
+        """
+        key = (self.user, self.hostname)
+        session = await asyncio.get_running_loop().run_in_executor(
+            None, self.session_pool.acquire, key, self.connect_func
+        )
+        reactor = Reactor(session)
+        try:
+            yield session, reactor
+        except BaseException:
+            # The shell and the agent go away with the session.
+            reactor.discard_shell()
+            reactor.discard_agent()
+            reactor.close()
+            self.session_pool.discard(session)
+            raise
+        reactor.close()
+        self.session_pool.release(key, session)
+
+    async def _get_target_host_cfg_async(
+        self, session: Session, reactor: Reactor
+    ) -> Union[Facts, Dict[str, Any]]:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._get_target_host_cfg, session, reactor
+        )
+
+    async def gather_facts(  # type: ignore[override]
+        self, names: Optional[Iterable[str]] = None
+    ) -> Facts:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, super().gather_facts, names
+        )
+
+    async def one_off_exec(  # type: ignore[override]
+        self, cmd: str, stdin: Stdin = None, error_ok: bool = False
+    ) -> ExecOutput:
+        async with self._session_async() as (session, reactor):
+            wp = AsyncWhiteprint(session, None, None, reactor)
+            return await wp.exec(cmd, stdin=stdin, error_ok=error_ok)
+
+    async def _execute_step_async(
+        self,
+        mode: str,
+        force: bool,
+        step: Step,
+        step_key: str,
+        session: Session,
+        reactor: Reactor,
+        target_host_cfg: Union[Facts, Dict[str, Any]],
+        journal: Optional[Journal],
+        stats: Counter[str],
+    ) -> Tuple[bool, Optional[str]]:
+        loop = asyncio.get_running_loop()
+        whiteprint = self._mk_whiteprint(step, session, reactor, target_host_cfg, stats)
+        fingerprint = await loop.run_in_executor(None, step_fingerprint, whiteprint)
+        if self._should_skip(journal, step_key, mode, fingerprint, force):
+            self.logger.info(
+                "Skipping %s (%s): unchanged", step.whiteprint_cls.__name__, mode
+            )
+            stats["steps_skipped"] += 1
+            return False, fingerprint
+        self.logger.info("Executing %s (%s)", step.whiteprint_cls.__name__, mode)
+        try:
+            if isinstance(whiteprint, AsyncWhiteprint):
+                await whiteprint.execute(mode)
+            else:
+                await loop.run_in_executor(None, whiteprint.execute, mode)
+        except WhiteprintError as e:
+            log_msg = e.log_msg()
+            if log_msg is not None:
+                self.logger.error(log_msg)
+            raise
+        return True, None if whiteprint.delegated else fingerprint
+
+    async def _execute_parallel_async(
+        self,
+        mode: str,
+        force: bool,
+        step_keys: List[str],
+        deps: List[Set[int]],
+        target_host_cfg: Union[Facts, Dict[str, Any]],
+        journal: Optional[Journal],
+    ) -> None:
+        """Like :meth:`SitePlan._execute_parallel`, but with tasks."""
+
+        async def run(i: int, stats: Counter[str]) -> Tuple[bool, Optional[str]]:
+            async with self._session_async() as (session, reactor):
+                return await self._execute_step_async(
+                    mode,
+                    force,
+                    self.plan[i],
+                    step_keys[i],
+                    session,
+                    reactor,
+                    target_host_cfg,
+                    journal,
+                    stats,
+                )
+
+        pending = list(range(len(self.plan)))
+        done: Set[int] = set()
+        error: Optional[BaseException] = None
+        running: Dict["asyncio.Task[Tuple[bool, Optional[str]]]", int] = {}
+        step_stats: Dict[int, Counter[str]] = {}
+        try:
+            while True:
+                if error is None:
+                    for i in [i for i in pending if deps[i] <= done]:
+                        if len(running) >= self.max_parallel_steps:
+                            break
+                        pending.remove(i)
+                        step_stats[i] = collections.Counter()
+                        running[asyncio.ensure_future(run(i, step_stats[i]))] = i
+                if not running:
+                    break
+                finished, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in finished:
+                    i = running.pop(task)
+                    self.stats.update(step_stats.pop(i))
+                    try:
+                        executed, fingerprint = task.result()
+                    except BaseException as e:  # pylint: disable=W0703
+                        if error is None:
+                            error = e
+                        continue
+                    done.add(i)
+                    if executed:
+                        self._record_step(
+                            journal, self.plan[i], step_keys[i], mode, fingerprint
+                        )
+        finally:
+            # Only reached with steps running if this coroutine is cancelled.
+            for task in running:
+                task.cancel()
+        if error is not None:
+            raise error
+
+    async def execute(  # type: ignore[override]
+        self, mode: str, force: bool = False
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        self.stats = collections.Counter()
+        self.packages = PackageRegistry()
+        self.tasks = TaskRegistry()
+        self.path_stats = {}
+        step_keys = self._step_keys()
+        deps = self._step_deps(step_keys)
+        order = self._step_order(deps, step_keys)
+        async with self._session_async() as (session, reactor):
+            target_host_cfg = await self._get_target_host_cfg_async(session, reactor)
+            journal = await loop.run_in_executor(
+                None, self._read_journal, session, reactor
+            )
             try:
-                err_msg = whiteprint.validate(mode)
-            except ValidationError as e:
-                err_msg = e.log_msg()
-            if err_msg is not None:
-                self.logger.error(
-                    "%s failed validation (%s): %s",
-                    step.whiteprint_cls.__name__,
+                await loop.run_in_executor(
+                    None,
+                    self._aggregate_packages,
                     mode,
-                    err_msg,
+                    force,
+                    step_keys,
+                    session,
+                    reactor,
+                    target_host_cfg,
+                    journal,
+                )
+                if self._parallel():
+                    await self._execute_parallel_async(
+                        mode, force, step_keys, deps, target_host_cfg, journal
+                    )
+                else:
+                    for i in order:
+                        step = self.plan[i]
+                        executed, fingerprint = await self._execute_step_async(
+                            mode,
+                            force,
+                            step,
+                            step_keys[i],
+                            session,
+                            reactor,
+                            target_host_cfg,
+                            journal,
+                            self.stats,
+                        )
+                        if executed:
+                            self._record_step(
+                                journal, step, step_keys[i], mode, fingerprint
+                            )
+                await loop.run_in_executor(
+                    None, self._run_notified, mode, session, reactor
+                )
+            except BaseException:
+                with contextlib.suppress(Exception):
+                    await loop.run_in_executor(
+                        None, self._write_journal, session, reactor, journal
+                    )
+                raise
+            await loop.run_in_executor(
+                None, self._write_journal, session, reactor, journal
+            )
+        self._log_stats(mode)
+
+    async def install(self, force: bool = False) -> None:  # type: ignore[override]
+        await self.execute("install", force)
+
+    async def update(self, force: bool = False) -> None:  # type: ignore[override]
+        await self.execute("update", force)
+
+    async def clean(self) -> None:  # type: ignore[override]
+        await self.execute("clean")
+
+    async def start(self) -> None:  # type: ignore[override]
+        await self.execute("start")
+
+    async def stop(self) -> None:  # type: ignore[override]
+        await self.execute("stop")
+
+    async def validate(self, mode: str) -> Optional[str]:  # type: ignore[override]
+        loop = asyncio.get_running_loop()
+        err_msg = None
+        self.packages = PackageRegistry()
+        self.path_stats = {}
+        async with self._session_async() as (session, reactor):
+            target_host_cfg = await self._get_target_host_cfg_async(session, reactor)
+            whiteprints = [
+                self._mk_whiteprint(step, session, reactor, target_host_cfg)
+                for step in self.plan
+            ]
+            await loop.run_in_executor(
+                None, self._prefetch_stats, mode, session, reactor, whiteprints
+            )
+            for step, whiteprint in zip(self.plan, whiteprints):
+                self.logger.info(
+                    "Validating %s (%s)", step.whiteprint_cls.__name__, mode
                 )
-                break
-        session.disconnect()
+                try:
+                    if isinstance(whiteprint, AsyncWhiteprint):
+                        err_msg = await whiteprint.validate(mode)
+                    else:
+                        err_msg = await loop.run_in_executor(
+                            None, whiteprint.validate, mode
+                        )
+                except ValidationError as e:
+                    err_msg = e.log_msg()
+                if err_msg is not None:
+                    self._log_validation_error(step, mode, err_msg)
+                    break
         return err_msg
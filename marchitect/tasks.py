@@ -0,0 +1,59 @@
+"""
+Tasks that whiteprints share within a site plan's run, like refreshing the
+apt index or reloading systemd, so that each runs once per host rather than
+once per whiteprint that needs it.
+"""
+
+import threading
+from typing import (
+    Dict,
+    List,
+    Set,
+    Tuple,
+)
+
+
+class TaskRegistry:
+    """
+    The named tasks of a site plan's run.
+
+    A task run with Whiteprint.once() runs at most once per run. A task
+    queued with Whiteprint.notify() runs once, after every step succeeded.
+
+    Safe to share between steps running in parallel: a step that needs a
+    task that's running waits for it to finish.
+    """
+
+    def __init__(self) -> None:
+        # Names of the once tasks that ran successfully.
+        self.ran: Set[str] = set()
+        # Notified task name -> cmd, in the order first notified.
+        self.notified: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._task_locks: Dict[str, threading.Lock] = {}
+
+    def lock(self, name: str) -> threading.Lock:
+        """Held while the once task name runs."""
+        with self._lock:
+            return self._task_locks.setdefault(name, threading.Lock())
+
+    def notify(self, name: str, cmd: str) -> None:
+        """
+        Raises:
+            - ValueError: If name was notified with a different cmd.
+        """
+        with self._lock:
+            cur_cmd = self.notified.setdefault(name, cmd)
+        if cur_cmd != cmd:
+            raise ValueError(
+                "Task {!r} notified with different commands: {!r} and {!r}".format(
+                    name, cur_cmd, cmd
+                )
+            )
+
+    def pop_notified(self) -> List[Tuple[str, str]]:
+        """Returns the notified tasks as (name, cmd), and forgets them."""
+        with self._lock:
+            notified = list(self.notified.items())
+            self.notified.clear()
+        return notified
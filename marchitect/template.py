@@ -0,0 +1,184 @@
+import collections
+import functools
+import hashlib
+from pathlib import Path
+import threading
+from typing import (
+    Any,
+    Dict,
+    Hashable,
+    Iterator,
+    Mapping,
+    Optional,
+    OrderedDict,
+    Sequence,
+    Tuple,
+)
+
+import jinja2
+
+
+class MostlyStrictUndefined(jinja2.Undefined):
+    """Just like jinja2's built-in except __bool__ is allowed.
+
+    This allows templates to check whether a variable is defined (also
+    conflated with truthy) without raising an error. However, all other uses
+    of an undefined will raise an error.
+    """
+
+    __slots__ = ()
+    __iter__ = __str__ = __len__ = __nonzero__ = __eq__ = __ne__ = __hash__ = (
+        jinja2.Undefined._fail_with_undefined_error  # pylint:disable=protected-access
+    )
+
+
+def _json_default(obj: Any) -> Dict[Any, Any]:
+    # Lets the tojson filter serialize config views, which aren't dicts.
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+class TemplateCache:
+    """
+    Compiles templates once and reuses them across renders.
+
+    Templates share a jinja2 Environment whose loader searches the resource
+    folders, so a template can `{% include %}` a template in any of them by
+    its path relative to the folder (e.g. "nginx/common.conf").
+
+    Compiled templates are kept in an LRU keyed by path and mtime for
+    templates on disk, and by a hash of the source for templates given as
+    strings. Optionally, bytecode is also cached on disk so that new
+    processes skip compilation too.
+
+    A cache is safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        rsrc_paths: Sequence[Path] = (),
+        bytecode_cache_dir: Optional[Path] = None,
+        max_size: int = 256,
+    ):
+        """
+        Args:
+            rsrc_paths: Resource folders searched by `{% include %}` and
+                similar template tags.
+            bytecode_cache_dir: If set, a folder to store compiled bytecode in.
+            max_size: Maximum number of compiled templates to keep in memory.
+        """
+        self.env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader([str(p) for p in rsrc_paths]),
+            undefined=MostlyStrictUndefined,
+            bytecode_cache=(
+                jinja2.FileSystemBytecodeCache(str(bytecode_cache_dir))
+                if bytecode_cache_dir is not None
+                else None
+            ),
+            auto_reload=True,
+        )
+        self.env.policies["json.dumps_kwargs"] = {
+            "sort_keys": True,
+            "default": _json_default,
+        }
+        self.max_size = max_size
+        # Number of lookups served from memory.
+        self.hits = 0
+        # Number of lookups that had to compile (or load bytecode).
+        self.misses = 0
+        self._templates: OrderedDict[Hashable, jinja2.Template] = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def from_path(self, path: Path) -> jinja2.Template:
+        """Returns the compiled template for the file at path."""
+        st = path.stat()
+        key = ("path", str(path), st.st_mtime_ns, st.st_size)
+        template = self._get(key)
+        if template is None:
+            with path.open(encoding="utf8") as f:
+                source = f.read()
+            template = self._compile(source, path.name, str(path))
+            self._put(key, template)
+        return template
+
+    def from_str(self, source: str) -> jinja2.Template:
+        """Returns the compiled template for source."""
+        digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        key = ("str", digest)
+        template = self._get(key)
+        if template is None:
+            template = self._compile(source, None, "<string:{}>".format(digest))
+            self._put(key, template)
+        return template
+
+    def _get(self, key: Hashable) -> Optional[jinja2.Template]:
+        with self._lock:
+            template = self._templates.get(key)
+            if template is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._templates.move_to_end(key)
+            return template
+
+    def _put(self, key: Hashable, template: jinja2.Template) -> None:
+        with self._lock:
+            self._templates[key] = template
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+
+    def _compile(
+        self, source: str, name: Optional[str], filename: str
+    ) -> jinja2.Template:
+        # Mirrors jinja2.loaders.BaseLoader.load() so that templates that
+        # aren't reachable through the loader can still use the bytecode cache.
+        bcc = self.env.bytecode_cache
+        bucket = None
+        code = None
+        if bcc is not None:
+            bucket = bcc.get_bucket(self.env, name or filename, filename, source)
+            code = bucket.code
+        if code is None:
+            code = self.env.compile(source, name, filename)
+            if bcc is not None and bucket is not None:
+                bucket.code = code
+                bcc.set_bucket(bucket)
+        return self.env.template_class.from_code(
+            self.env, code, self.env.make_globals(None), None
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_template_cache(rsrc_paths: Tuple[Path, ...]) -> TemplateCache:
+    return TemplateCache(rsrc_paths)
+
+
+def get_template_cache(rsrc_paths: Sequence[Path] = ()) -> TemplateCache:
+    """
+    Returns a process-wide template cache for the resource folders, so that
+    site plans for different hosts share compiled templates.
+    """
+    return _get_template_cache(tuple(rsrc_paths))
+
+
+def generate(template: jinja2.Template, cfg: Mapping[str, Any]) -> Iterator[str]:
+    """
+    Like template.generate(cfg), except that variables are looked up in cfg
+    rather than cfg being copied into a new dict first, so rendering doesn't
+    cost more for larger configs.
+    """
+    # Shared contexts don't add the globals themselves.
+    variables = collections.ChainMap(cfg, template.globals)  # type: ignore[arg-type]
+    ctx = template.new_context(variables, shared=True)  # type: ignore[arg-type]
+    try:
+        yield from template.root_render_func(ctx)
+    except Exception:  # pylint: disable=W0703
+        yield template.environment.handle_exception()
+
+
+def render(template: jinja2.Template, cfg: Mapping[str, Any]) -> str:
+    """Like template.render(cfg). See :func:`generate`."""
+    return "".join(generate(template, cfg))
@@ -1,4 +1,20 @@
-from typing import Any, Dict
+import copy
+import types
+from typing import (
+    Any,
+    Dict,
+    ItemsView,
+    Iterator,
+    List,
+    Mapping,
+    MutableMapping,
+    Sequence,
+    Set,
+    Tuple,
+    ValuesView,
+)
+
+from .facts import Facts
 
 
 def dict_deep_update(a: Dict[Any, Any], b: Dict[Any, Any]) -> None:
@@ -13,3 +29,209 @@ def dict_deep_update(a: Dict[Any, Any], b: Dict[Any, Any]) -> None:
             a[key] = b[key]
         else:
             dict_deep_update(a[key], b[key])
+
+
+def _lazy_copy(value: Any) -> Any:
+    """
+    A copy of value that can be changed without changing value. Dicts are
+    copied one level at a time as they're looked up (see _LazyCopyDict).
+    """
+    if isinstance(value, LayeredConfig):
+        return value.to_dict()
+    if isinstance(value, dict) and not isinstance(value, Facts):
+        return _LazyCopyDict(value)
+    if isinstance(value, (list, set, bytearray)):
+        return copy.deepcopy(value)
+    return value
+
+
+# The default original of a _LazyCopyDict, e.g. when schema validation makes
+# a new dict of the same type.
+_EMPTY_MAPPING: Mapping[Any, Any] = types.MappingProxyType({})
+
+
+class _LazyCopyDict(Dict[Any, Any]):
+    """
+    A shallow copy of a config dict whose values are copied in turn, with
+    _lazy_copy(), the first time they're looked up. Reading a large nested
+    dict only copies the dicts on the way to what's read, and only
+    shallowly, while changing it, in place or not, never changes the
+    original.
+    """
+
+    def __init__(self, original: Mapping[Any, Any] = _EMPTY_MAPPING):
+        super().__init__(original)
+        # Keys whose values are the dict's own rather than the original's.
+        self._own: Set[Any] = set()
+
+    def __getitem__(self, key: Any) -> Any:
+        value = super().__getitem__(key)
+        if key not in self._own:
+            value = _lazy_copy(value)
+            super().__setitem__(key, value)
+            self._own.add(key)
+        return value
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        super().__setitem__(key, value)
+        self._own.add(key)
+
+    def __iter__(self) -> Iterator[Any]:  # pylint: disable=W0246
+        # Overridden so that dict(), {**d}, and dict.update() look values up
+        # with __getitem__() rather than reading the original's.
+        return super().__iter__()
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return _LazyCopyDict, (dict(self.items()),)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        return self[key] if key in self else default
+
+    def setdefault(self, key: Any, default: Any = None) -> Any:
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key: Any, *default: Any) -> Any:
+        if key not in self:
+            return super().pop(key, *default)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self) -> Tuple[Any, Any]:
+        key = next(reversed(self))
+        return key, self.pop(key)
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def items(self) -> ItemsView[Any, Any]:  # type: ignore[override]
+        return ItemsView(self)
+
+    def values(self) -> ValuesView[Any]:  # type: ignore[override]
+        return ValuesView(self)
+
+    def copy(self) -> "_LazyCopyDict":
+        return _LazyCopyDict(self)
+
+
+# Marks a key deleted from a LayeredConfig that still exists in its layers.
+_DELETED = object()
+
+
+class LayeredConfig(MutableMapping[str, Any]):
+    """
+    A copy-on-write view of config dicts stacked on top of each other, like a
+    deep collections.ChainMap.
+
+    Reading gives the same result as deep merging the layers from the bottom
+    up with dict_deep_update(), but nothing is merged or copied up front: a
+    lookup walks the layers. Writes go to a layer of the view's own, so the
+    dicts it was built from are never modified.
+
+    A nested dict (including instances of dict subclasses) is merged across
+    layers into a new dict the first time its key is looked up. The new dict
+    only copies the dicts nested in it as they're looked up in turn, so only
+    the parts of the config that are read are ever copied, one level at a
+    time. Lists and sets are copied too since they may be modified in place.
+    Either way, the result is kept so that later lookups return the same
+    object. Facts are shared rather than copied, so that facts gathered
+    lazily are gathered once.
+    """
+
+    def __init__(self, layers: Sequence[Mapping[str, Any]], deep: bool = True):
+        """
+        Args:
+            layers: Highest precedence first.
+            deep: If true, dicts are merged across layers as by
+                dict_deep_update(). Otherwise, a value in a higher layer
+                replaces the one below it outright, as by dict.update().
+        """
+        self.__layers: List[Mapping[str, Any]] = [
+            layer for layer in layers if not (isinstance(layer, dict) and not layer)
+        ]
+        self.__deep = deep
+        self.__own: Dict[str, Any] = {}
+
+    def __getitem__(self, key: str) -> Any:
+        own = self.__own
+        if key in own:
+            value = own[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        # The dicts to merge, highest precedence first, and whether the
+        # highest one came from a view (which already owns it).
+        chain: List[Any] = []
+        from_view = False
+        for layer in self.__layers:
+            if key not in layer:
+                continue
+            value = layer[key]
+            if not chain:
+                from_view = isinstance(layer, LayeredConfig)
+            if not isinstance(value, (dict, LayeredConfig)) or isinstance(value, Facts):
+                # A non-dict replaces whatever is below it, and is itself
+                # replaced by dicts above it.
+                if chain:
+                    break
+                if from_view or isinstance(value, Facts):
+                    return value
+                if isinstance(value, (list, set, bytearray)):
+                    value = own[key] = copy.deepcopy(value)
+                return value
+            chain.append(value)
+            if not self.__deep:
+                break
+        if not chain:
+            raise KeyError(key)
+        if len(chain) == 1 and from_view:
+            merged = chain[0]
+        else:
+            merged = _lazy_copy(chain[-1])
+            for upper in reversed(chain[:-1]):
+                dict_deep_update(merged, _lazy_copy(upper))
+        own[key] = merged
+        return merged
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.__own[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self.__own[key] = _DELETED
+
+    def __contains__(self, key: object) -> bool:
+        own = self.__own
+        if key in own:
+            return own[key] is not _DELETED
+        return any(key in layer for layer in self.__layers)
+
+    def __iter__(self) -> Iterator[str]:
+        # Same key order as merging bottom up into a dict.
+        keys: Dict[str, None] = {}
+        for layer in reversed(self.__layers):
+            keys.update(dict.fromkeys(layer))
+        keys.update(dict.fromkeys(self.__own))
+        own = self.__own
+        return iter([key for key in keys if own.get(key) is not _DELETED])
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return "LayeredConfig({!r})".format(self.to_dict())
+
+    def copy(self) -> "LayeredConfig":
+        """Returns a copy-on-write copy that's independent of this view."""
+        return LayeredConfig([self])
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Materializes the view into plain (nested) dicts."""
+        return {
+            key: value.to_dict() if isinstance(value, LayeredConfig) else value
+            for key, value in self.items()
+        }
@@ -1,16 +1,36 @@
-import copy
+import asyncio
+import collections
+import hashlib
+import io
+import mmap
+import os
 from pathlib import Path
+import posixpath
 import select
+import selectors
+import shlex
+import tempfile
+import threading
 from typing import (
+    IO,
     Any,
     Callable,
+    Counter,
+    Deque,
     Dict,
+    Generator,
+    Hashable,
     Iterable,
+    Iterator,
     List,
+    MutableMapping,
     Optional,
+    OrderedDict,
     Tuple,
     Type,
+    TYPE_CHECKING,
     TypeVar,
+    Union,
 )
 
 import jinja2
@@ -25,17 +45,98 @@ from ssh2.error_codes import LIBSSH2_ERROR_EAGAIN  # type: ignore  # pylint: dis
 from ssh2.exceptions import (  # pylint: disable=E0611
     ChannelError,
     SCPProtocolError,
+    SFTPError,
 )
 from ssh2.session import (  # pylint: disable=E0611
     LIBSSH2_SESSION_BLOCK_INBOUND,
     LIBSSH2_SESSION_BLOCK_OUTBOUND,
     Session,
 )
+from ssh2.sftp import (  # type: ignore  # pylint: disable=E0611
+    LIBSSH2_FXF_CREAT,
+    LIBSSH2_FXF_READ,
+    LIBSSH2_FXF_TRUNC,
+    LIBSSH2_FXF_WRITE,
+    LIBSSH2_SFTP_ATTR_ACMODTIME,
+    SFTP,
+)
+from ssh2.sftp_handle import (  # type: ignore  # pylint: disable=E0611
+    SFTPAttributes,
+    SFTPHandle,
+)
 
-from .util import dict_deep_update
-
-
-Config = Dict[str, Any]
+from .agent import (
+    AGENT_UPLOAD_REQUEST,
+    agent_start_cmd,
+    agent_upload,
+    decode_response,
+    encode_request,
+    is_agent_ready,
+    parse_agent_stats,
+    parse_output_frame,
+)
+from .archive import TAR_FLAGS, tar_chunks
+from .batch import BATCH_SHELL, batch_marker, batch_script, parse_batch
+from .facts import Facts, FactsNeeded, defer_gathering
+from .manifest import Manifest, TreeDiff, diff_manifests, remote_manifest_cmd
+from .pathstat import PathStat, parse_stat_many, stat_many_cmd
+from .shell import (
+    SHELL_START_CMD,
+    shell_cmd_line,
+    shell_marker,
+    split_reply,
+)
+from .template import (  # pylint: disable=W0611
+    MostlyStrictUndefined,
+    TemplateCache,
+    generate,
+    get_template_cache,
+    render,
+)
+from .util import LayeredConfig
+
+if TYPE_CHECKING:
+    from .site_plan import SitePlan
+
+
+Config = MutableMapping[str, Any]
+
+# Standard input for Whiteprint.exec(): the data itself, a binary file object
+# to read it from, a path of a local file, or an iterable of chunks.
+Stdin = Union[bytes, IO[bytes], os.PathLike[str], Iterable[bytes], None]
+
+# Stream identifiers yielded by Whiteprint.exec_stream(). They match the file
+# descriptor numbers of the remote process.
+STDOUT = 1
+STDERR = 2
+
+# SFTP status codes (draft-ietf-secsh-filexfer-13), as reported by
+# SFTP.last_error().
+SFTP_STATUS_NAMES = {
+    1: "EOF",
+    2: "NO_SUCH_FILE",
+    3: "PERMISSION_DENIED",
+    4: "FAILURE",
+    5: "BAD_MESSAGE",
+    6: "NO_CONNECTION",
+    7: "CONNECTION_LOST",
+    8: "OP_UNSUPPORTED",
+    9: "INVALID_HANDLE",
+    10: "NO_SUCH_PATH",
+    11: "FILE_ALREADY_EXISTS",
+    12: "WRITE_PROTECT",
+    13: "NO_MEDIA",
+    14: "NO_SPACE_ON_FILESYSTEM",
+    15: "QUOTA_EXCEEDED",
+    16: "UNKNOWN_PRINCIPAL",
+    17: "LOCK_CONFLICT",
+    18: "DIR_NOT_EMPTY",
+    19: "NOT_A_DIRECTORY",
+    20: "INVALID_FILENAME",
+    21: "LINK_LOOP",
+}
+SFTP_NO_SUCH_FILE = 2
+SFTP_NO_SUCH_PATH = 10
 
 
 class ExecOutput:
@@ -80,6 +181,8 @@ def retry_eagain(f: Callable[..., T], *args: Any) -> T:
     """
     Helper to retry libssh2 functions if they return an EAGAIN error.
 
+    This busy-waits. Prefer :meth:`Reactor.call` which parks on the socket.
+
     Args:
         f: Function that requires no arguments to call.
     """
@@ -89,17 +192,471 @@ def retry_eagain(f: Callable[..., T], *args: Any) -> T:
     return ret
 
 
+# A non-blocking operation on a session. It's a generator that yields whenever
+# libssh2 returns EAGAIN, and returns its result when done. If the operation is
+# blocked reading a channel, it yields that channel so that the driver can
+# check for data libssh2 has already buffered before parking on the socket.
+Op = Generator[Optional[Channel], None, T]
+
+
+def _eagain(f: Callable[..., T], *args: Any) -> Op[T]:
+    """Calls f(*args), yielding each time it returns EAGAIN."""
+    ret = f(*args)
+    while ret == LIBSSH2_ERROR_EAGAIN:
+        yield None
+        ret = f(*args)
+    return ret
+
+
+def _eagain_obj(f: Callable[..., T], *args: Any) -> Op[T]:
+    """
+    Like _eagain, but for functions that return an object on success. These
+    may signal EAGAIN by returning None.
+    """
+    ret = f(*args)
+    while ret is None or ret == LIBSSH2_ERROR_EAGAIN:
+        yield None
+        ret = f(*args)
+    return ret
+
+
+def _has_buffered_input(chan: Channel) -> bool:
+    """
+    Whether libssh2 has already read data or an EOF for chan off the socket.
+
+    Reading one channel can pull packets for others into libssh2's buffers, in
+    which case waiting on the socket for them would stall.
+    """
+    return bool(chan.poll_channel_read(1) or chan.eof())
+
+
+def _write_all_op(chan: Channel, data: bytes) -> Op[None]:
+    """Writes all of data to chan, yielding while the channel is full."""
+    mv_data = memoryview(data)
+    while len(mv_data) > 0:
+        rc, sent = chan.write(data)
+        mv_data = mv_data[sent:]
+        if len(mv_data) > 0:
+            # Channel.write() only accepts bytes, so the remainder is
+            # copied, but only after a partial write.
+            data = bytes(mv_data)
+            if rc == LIBSSH2_ERROR_EAGAIN:
+                yield None
+
+
+def _read_line_op(chan: Channel, buf: bytearray) -> Op[Optional[bytes]]:
+    """
+    Reads chan's stdout into buf until it holds a whole line, and returns the
+    line. Returns None if the channel reached EOF first. stderr is discarded.
+    """
+    while True:
+        end = buf.find(b"\n")
+        if end >= 0:
+            line = bytes(buf[: end + 1])
+            del buf[: end + 1]
+            return line
+        progress = False
+        for read, dest in ((chan.read, buf), (chan.read_stderr, bytearray())):
+            size, data = read()
+            while size > 0:
+                dest += data
+                progress = True
+                size, data = read()
+        if b"\n" in buf:
+            continue
+        if chan.eof():
+            return None
+        if not progress:
+            yield chan
+
+
+class Reactor:
+    """
+    Drives non-blocking operations on a session without spinning.
+
+    Each operation (see Op) is stepped until it yields because libssh2 returned
+    EAGAIN. The reactor then parks on the session's socket in whichever
+    direction(s) libssh2 reports being blocked on, and resumes the operation
+    as soon as the socket is ready.
+
+    There should be one reactor per session. Whiteprints share the reactor of
+    the whiteprint or site plan that created them.
+    """
+
+    # Upper bound on a single park. Socket readiness is what wakes the
+    # reactor; this only guards against a wakeup that libssh2 consumed on
+    # behalf of another operation.
+    wakeup_timeout = 1.0
+
+    def __init__(self, session: Session):
+        self.session = session
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(session.sock, selectors.EVENT_READ)
+        # Whether an op is in the middle of a session-level request.
+        self._session_busy = False
+        # The session's SFTP channel, started on first use and shared by all
+        # SFTP transfers.
+        self._sftp: Optional[SFTP] = None
+        # Whether an op is in the middle of an SFTP-level request.
+        self._sftp_busy = False
+        # The session's persistent shell, started on first use, and the
+        # marker that ends each command's output.
+        self._shell: Optional[Tuple[Channel, bytes]] = None
+        # Whether an op is in the middle of a shell command.
+        self._shell_busy = False
+        # The session's helper agent (see marchitect.agent), started on first
+        # use, and the output read from it that isn't a whole line yet.
+        self._agent: Optional[Tuple[Channel, bytearray]] = None
+        # Whether an op is in the middle of an agent request.
+        self._agent_busy = False
+        # Whether the agent couldn't be started, e.g. because the target
+        # host has no python3. It isn't tried again.
+        self.agent_unavailable = False
+
+    def close(self) -> None:
+        """
+        Exits the persistent shell and the agent, if any, and releases the
+        reactor.
+        """
+        if self._shell is not None and not self._shell_busy:
+            chan, _ = self._shell
+            self._shell = None
+            self.run(self._close_shell_op(chan))
+        if self._agent is not None and not self._agent_busy:
+            chan, _ = self._agent
+            self._agent = None
+            self.run(self._close_shell_op(chan))
+        self._selector.close()
+        self._sftp = None
+
+    def wait(self, timeout: Optional[float] = None) -> Tuple[bool, bool]:
+        """
+        Parks until the socket is ready in the direction libssh2 is blocked on.
+
+        Args:
+            timeout: Defaults to wakeup_timeout.
+
+        Returns:
+            - Element 0: Whether the socket is readable.
+            - Element 1: Whether the socket is writable.
+        """
+        directions = self.session.block_directions()
+        events = 0
+        if directions & LIBSSH2_SESSION_BLOCK_INBOUND:
+            events |= selectors.EVENT_READ
+        if directions & LIBSSH2_SESSION_BLOCK_OUTBOUND:
+            events |= selectors.EVENT_WRITE
+        if events == 0:
+            return False, False
+        self._selector.modify(self.session.sock, events)
+        ready = self._selector.select(
+            self.wakeup_timeout if timeout is None else timeout
+        )
+        ready_events = ready[0][1] if ready else 0
+        return (
+            bool(ready_events & selectors.EVENT_READ),
+            bool(ready_events & selectors.EVENT_WRITE),
+        )
+
+    async def wait_async(self) -> None:
+        """
+        Like wait(), but waits for socket readiness through the running event
+        loop rather than blocking the thread.
+        """
+        directions = self.session.block_directions()
+        if directions == 0:
+            return
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def wake() -> None:
+            if not ready.done():
+                ready.set_result(None)
+
+        fd = self.session.sock.fileno()
+        if directions & LIBSSH2_SESSION_BLOCK_INBOUND:
+            loop.add_reader(fd, wake)
+        if directions & LIBSSH2_SESSION_BLOCK_OUTBOUND:
+            loop.add_writer(fd, wake)
+        timer = loop.call_later(self.wakeup_timeout, wake)
+        try:
+            await ready
+        finally:
+            timer.cancel()
+            if directions & LIBSSH2_SESSION_BLOCK_INBOUND:
+                loop.remove_reader(fd)
+            if directions & LIBSSH2_SESSION_BLOCK_OUTBOUND:
+                loop.remove_writer(fd)
+
+    def run(self, op: Op[T]) -> T:
+        """Runs op to completion and returns its result."""
+        return self.run_many([op])[0]
+
+    def run_many(self, ops: Iterable[Op[T]], max_in_flight: int = 8) -> List[T]:
+        """
+        Runs ops concurrently and returns their results in input order.
+
+        All ops are stepped in turn, and the reactor only parks once all of
+        them are blocked.
+
+        Args:
+            max_in_flight: Maximum number of ops in progress at once. Each op
+                typically holds a channel open, and servers limit the number of
+                channels per connection (OpenSSH's MaxSessions defaults to 10).
+        """
+        scheduler = self._schedule(ops, max_in_flight)
+        while True:
+            try:
+                next(scheduler)
+            except StopIteration as e:
+                return e.value  # type: ignore
+            self.wait()
+
+    async def run_async(self, op: Op[T]) -> T:
+        """Like run(), but parks through the running event loop."""
+        return (await self.run_many_async([op]))[0]
+
+    async def run_many_async(
+        self, ops: Iterable[Op[T]], max_in_flight: int = 8
+    ) -> List[T]:
+        """Like run_many(), but parks through the running event loop."""
+        scheduler = self._schedule(ops, max_in_flight)
+        while True:
+            try:
+                next(scheduler)
+            except StopIteration as e:
+                return e.value  # type: ignore
+            await self.wait_async()
+
+    def gather(self, ops: Iterable[Op[T]], max_in_flight: int = 8) -> Op[List[T]]:
+        """
+        Like run_many(), but is itself an op so that it can be composed with
+        others.
+        """
+        return (yield from self._schedule(ops, max_in_flight))
+
+    @staticmethod
+    def _schedule(
+        ops: Iterable[Op[T]], max_in_flight: int
+    ) -> Generator[None, None, List[T]]:
+        """
+        Steps ops until all are done, yielding whenever the caller should park
+        on the socket because every op in flight is blocked.
+        """
+        assert max_in_flight > 0
+        todo = enumerate(ops)
+        in_flight: Dict[int, Op[T]] = {}
+        results: Dict[int, T] = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                try:
+                    i, op = next(todo)
+                except StopIteration:
+                    exhausted = True
+                else:
+                    in_flight[i] = op
+            if not in_flight:
+                break
+            park = True
+            for i, op in list(in_flight.items()):
+                try:
+                    chan = next(op)
+                except StopIteration as e:
+                    results[i] = e.value
+                    del in_flight[i]
+                    park = False
+                else:
+                    if chan is not None and _has_buffered_input(chan):
+                        park = False
+            if park:
+                yield None
+        return [results[i] for i in range(len(results))]
+
+    def call(self, f: Callable[..., T], *args: Any) -> T:
+        """Calls a libssh2 function, parking on the socket while it's EAGAIN."""
+        return self.run(_eagain(f, *args))
+
+    def session_op(self, f: Callable[..., T], *args: Any) -> Op[T]:
+        """
+        Calls a libssh2 function that keeps its in-progress state on the
+        session rather than a channel (opening a channel, starting an SCP
+        transfer, ...).
+
+        libssh2 only tracks one such request at a time, so concurrent ops take
+        turns.
+        """
+        while self._session_busy:
+            yield None
+        self._session_busy = True
+        try:
+            return (yield from _eagain_obj(f, *args))
+        finally:
+            self._session_busy = False
+
+    def sftp_op(self, f: Callable[[SFTP], Op[T]]) -> Op[T]:
+        """
+        Runs the op returned by f with the session's SFTP channel, starting the
+        channel on first use.
+
+        libssh2 reads responses for all of a channel's handles through shared
+        state, so concurrent ops take turns: each holds the channel until its
+        op is done. Ops keep many requests in flight themselves.
+        """
+        while self._sftp_busy:
+            yield None
+        self._sftp_busy = True
+        try:
+            if self._sftp is None:
+                self._sftp = yield from self.session_op(self.session.sftp_init)
+            return (yield from f(self._sftp))
+        finally:
+            self._sftp_busy = False
+
+    def discard_sftp(self) -> None:
+        """
+        Drops the SFTP channel after a transfer failed midway, so that the
+        next SFTP op starts a new one.
+
+        libssh2 may leave responses to the failed transfer's pipelined
+        requests unread, which would confuse later requests on the channel.
+        """
+        self._sftp = None
+
+    def shell_op(self, f: Callable[[Channel, bytes], Op[T]]) -> Op[T]:
+        """
+        Runs the op returned by f with the session's persistent shell channel
+        and its marker, starting the shell on first use.
+
+        The shell runs one command at a time, so concurrent ops take turns.
+        If the op doesn't finish, the shell is discarded since it may be left
+        mid-command.
+        """
+        while self._shell_busy:
+            yield None
+        self._shell_busy = True
+        done = False
+        try:
+            if self._shell is None:
+                chan = yield from self.session_op(self.session.open_session)
+                yield from _eagain(chan.execute, SHELL_START_CMD)
+                self._shell = (chan, shell_marker())
+            res = yield from f(*self._shell)
+            done = True
+            return res
+        finally:
+            self._shell_busy = False
+            if not done:
+                self._shell = None
+
+    def discard_shell(self) -> None:
+        """
+        Drops the persistent shell, e.g. because it exited or its session is
+        about to be discarded, so that the next shell op starts a new one.
+        """
+        self._shell = None
+
+    @staticmethod
+    def _close_shell_op(chan: Channel) -> Op[None]:
+        # The shell (or agent) exits once its stdin is closed.
+        yield from _eagain(chan.send_eof)
+        yield from _eagain(chan.close)
+
+    def agent_op(self, f: Callable[[Channel, bytearray], Op[T]]) -> Op[T]:
+        """
+        Runs the op returned by f with the session's agent channel and its
+        buffered output, starting the agent on first use.
+
+        The agent answers one request at a time, so concurrent ops take
+        turns. If the op doesn't finish, the agent is discarded since it may
+        be left mid-request.
+
+        Raises:
+            - AgentUnavailableError: If the agent can't be started.
+        """
+        while self._agent_busy:
+            yield None
+        if self.agent_unavailable:
+            raise AgentUnavailableError()
+        self._agent_busy = True
+        done = False
+        try:
+            if self._agent is None:
+                self._agent = yield from self._start_agent_op()
+                if self._agent is None:
+                    self.agent_unavailable = True
+                    done = True
+                    raise AgentUnavailableError()
+            res = yield from f(*self._agent)
+            done = True
+            return res
+        finally:
+            self._agent_busy = False
+            if not done:
+                self._agent = None
+
+    def _start_agent_op(self) -> Op[Optional[Tuple[Channel, bytearray]]]:
+        chan = yield from self.session_op(self.session.open_session)
+        yield from _eagain(chan.execute, agent_start_cmd())
+        buf = bytearray()
+        line = yield from _read_line_op(chan, buf)
+        if line == AGENT_UPLOAD_REQUEST:
+            yield from _write_all_op(chan, agent_upload())
+            line = yield from _read_line_op(chan, buf)
+        if line is None or not is_agent_ready(line):
+            yield from self._close_shell_op(chan)
+            return None
+        return chan, buf
+
+    def discard_agent(self) -> None:
+        """
+        Drops the agent, e.g. because it exited or its session is about to
+        be discarded, so that the next agent op starts a new one.
+        """
+        self._agent = None
+
+    def sftp_last_error(self) -> int:
+        """Returns the SFTP status code of the last failed SFTP request."""
+        assert self._sftp is not None
+        return int(self._sftp.last_error())
+
+
 class WhiteprintError(Exception):
     def log_msg(self) -> str:
         raise NotImplementedError
 
 
+class AgentError(WhiteprintError):
+    """
+    Raised when the helper agent failed to carry out a request.
+    """
+
+    def __init__(self, method: str, error: str):
+        super().__init__(method, error)
+        self.method = method
+        self.error = error
+
+    def log_msg(self) -> str:
+        return "Agent request {!r} failed: {}".format(self.method, self.error)
+
+
+class AgentUnavailableError(WhiteprintError):
+    """
+    Raised when the helper agent can't be started on the target host, e.g.
+    because it has no python3.
+    """
+
+    def log_msg(self) -> str:
+        return "Agent unavailable"
+
+
 class RemoteFileNotFoundError(WhiteprintError):
     """
-    Raised when downloading a file via SCP fails because it does not exist.
+    Raised when downloading a file via SCP or SFTP fails because it does not
+    exist.
     """
 
-    def __init__(self, msg: str, inner: SCPProtocolError):
+    def __init__(self, msg: str, inner: Exception):
         super().__init__(msg, inner)
         self.msg = msg
         self.inner = inner
@@ -110,11 +667,11 @@ class RemoteFileNotFoundError(WhiteprintError):
 
 class RemoteTargetDirError(WhiteprintError):
     """
-    Raised when uploading a file via SCP fails because the target directory
-    does not exist.
+    Raised when uploading a file via SCP or SFTP fails because the target
+    directory does not exist.
     """
 
-    def __init__(self, msg: str, inner: SCPProtocolError):
+    def __init__(self, msg: str, inner: Exception):
         super().__init__(msg, inner)
         self.msg = msg
         self.inner = inner
@@ -123,6 +680,25 @@ class RemoteTargetDirError(WhiteprintError):
         return self.msg
 
 
+class RemoteSFTPError(WhiteprintError):
+    """
+    Raised when an SFTP request fails for a reason without a more specific
+    exception.
+    """
+
+    def __init__(self, path: str, code: int, inner: Exception):
+        super().__init__(path, code, inner)
+        self.path = path
+        # SFTP status code, see SFTP_STATUS_NAMES.
+        self.code = code
+        self.inner = inner
+
+    def log_msg(self) -> str:
+        return "SFTP request for {!r} failed: {}".format(
+            self.path, SFTP_STATUS_NAMES.get(self.code, str(self.code))
+        )
+
+
 class RemoteExecError(WhiteprintError):
     """
     Raised when the remote exec returned a non-zero exit status.
@@ -157,19 +733,117 @@ class ValidationError(WhiteprintError):
         return self.msg
 
 
-_target_host_cfg_schema = {
-    schema.Optional("_target"): {
-        "user": str,
-        "host": str,
-        "kernel": str,
-        "distro": str,
-        "distro_version": str,
-        "hostname": str,
-        "fqdn": str,
-        "cpu_count": int,
-    }
+_target_host_cfg_schema: Dict[Any, Any] = {
+    schema.Optional("_target"): schema.Or(
+        Facts,
+        schema.Schema(
+            {
+                "user": str,
+                "host": str,
+                "kernel": str,
+                "distro": str,
+                "distro_version": str,
+                "hostname": str,
+                "fqdn": str,
+                "cpu_count": int,
+            }
+        ),
+    )
 }
 
+_target_schema = schema.Schema(_target_host_cfg_schema)
+
+
+def _freeze(value: Any) -> Hashable:
+    """
+    Returns a key for value that's equal for structurally equal values,
+    including the types of leaves. Raises TypeError if value contains
+    something unhashable.
+    """
+    if isinstance(value, dict):
+        return (dict, frozenset((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(_freeze(v) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return (type(value), frozenset(_freeze(v) for v in value))
+    hash(value)
+    return (type(value), value)
+
+
+class _DeclaredKeysSchema:
+    """
+    For a cfg schema whose keys are all declared by name, optionally with
+    `str: object` to allow any other key, the schema of just the declared
+    keys. Validating those, and checking the names of the other keys, is
+    enough, so the values of other keys needn't be looked at, however many
+    there are.
+    """
+
+    def __init__(self, cfg_schema: Config):
+        self.keys: List[str] = []
+        # Whether keys besides the declared ones are an error.
+        self.closed = True
+        # Whether some key besides the declared ones is required.
+        self.other_key_required = False
+        declared: Config = {}
+        for key, value in cfg_schema.items():
+            name = key.schema if isinstance(key, schema.Optional) else key
+            if isinstance(name, str):
+                self.keys.append(name)
+                declared[key] = value
+            else:
+                self.closed = False
+                self.other_key_required = not isinstance(key, schema.Optional)
+        self.compiled = schema.Schema(declared)
+
+    @classmethod
+    def applies_to(cls, cfg_schema: Config) -> bool:
+        for key, value in cfg_schema.items():
+            name = key.schema if isinstance(key, schema.Optional) else key
+            if not isinstance(name, str) and not (name is str and value is object):
+                return False
+        return True
+
+
+class _ValidatedCfgCache:
+    """
+    Remembers the configs each compiled schema has validated, so that
+    identical configs (e.g. the same prefab on every host of a fleet) are
+    validated once per process. A cache is safe to share between threads.
+    """
+
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self._cfgs: OrderedDict[Hashable, Dict[str, Any]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def validate(self, compiled: Any, cfg: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Returns:
+            The validated cfg. It may be shared, so it must not be modified.
+        """
+        key: Optional[Hashable]
+        try:
+            key = (compiled, _freeze(cfg))
+        except TypeError:
+            key = None
+        if key is not None:
+            with self._lock:
+                validated = self._cfgs.get(key)
+                if validated is not None:
+                    self._cfgs.move_to_end(key)
+                    return validated
+        result: Dict[str, Any] = compiled.validate(cfg)
+        if key is not None:
+            with self._lock:
+                self._cfgs[key] = result
+                if len(self._cfgs) > self.max_size:
+                    self._cfgs.popitem(last=False)
+        return result
+
+
+_validated_cfgs = _ValidatedCfgCache()
+
 
 class Whiteprint:
     """
@@ -191,15 +865,64 @@ class Whiteprint:
 
     cfg_schema: Optional[Config] = None
 
+    # The cfg_schema that _compiled_cfg_schema() last compiled for the class,
+    # and the results.
+    _cfg_schema_compiled: Optional[
+        Tuple[Config, Any, Optional[_DeclaredKeysSchema]]
+    ] = None
+
     prefabs_head: List["Prefab"] = []
 
     prefabs_tail: List["Prefab"] = []
 
+    # Names of the target host facts used beyond the base ones (see
+    # marchitect.facts), e.g. ["memory"]. A site plan gathers them up front,
+    # along with the base facts. Facts that aren't listed are gathered on
+    # first use.
+    facts: List[str] = []
+
+    # Keys of cfg whose values are local resources (absolute, or relative to
+    # rsrc_path) that the whiteprint reads, e.g. ["src_path"]. Their contents
+    # are part of the fingerprint of a step that uses the whiteprint as a
+    # prefab, so that the step isn't skipped when they change.
+    rsrc_cfg_keys: List[str] = []
+
+    # Rendered templates larger than this many bytes are spooled to disk
+    # before upload.
+    template_spool_max_size = 1_000_000
+
+    # Size of the blocks that uploads are split into. Each block is copied
+    # once before being handed to libssh2.
+    scp_chunk_size = 256 * 1024
+
+    # How scp_*() methods and templates move files: "scp" or "sftp". SFTP
+    # pipelines requests, reuses one channel per session, and reports real
+    # error codes.
+    transport = "scp"
+
+    # Bytes of SFTP read or write requests kept in flight per transfer.
+    sftp_pipeline_size = 2 * 1024 * 1024
+
+    # Whether exec() runs commands in one long-lived shell per session rather
+    # than a new channel each. Commands with stdin still get their own
+    # channel. Also enabled by the site plan's persistent_shell.
+    persistent_shell = False
+
+    # Whether to use the helper agent (see marchitect.agent) for exec()
+    # without stdin, stat_many(), package queries, and remote digests. If the
+    # target host can't run it, the shell is used instead. Also enabled by
+    # the site plan's use_agent.
+    use_agent = False
+
     def __init__(
         self,
         session: Session,
         site_cfg: Optional[Config] = None,
         rsrc_path: Optional[Path] = None,
+        reactor: Optional[Reactor] = None,
+        template_cache: Optional[TemplateCache] = None,
+        stats: Optional[Counter[str]] = None,
+        site_plan: Optional["SitePlan"] = None,
     ) -> None:
         """
         Args:
@@ -207,19 +930,38 @@ class Whiteprint:
                 close the session when finished, that's up to the caller.
              rsrc_path: Path to the location where relative-path specified
                 resources can be found.
+             reactor: The reactor driving I/O on session. If omitted, a new
+                one is created.
+             template_cache: Where compiled templates are cached. If omitted,
+                a process-wide cache that includes from the parent folder of
+                rsrc_path is used.
+             stats: Counters shared with nested whiteprints, e.g. the number
+                of uploads skipped because the remote file was unchanged.
+             site_plan: The site plan executing this whiteprint, if any. Its
+                state for the current run is shared with nested whiteprints.
         """
         assert session.get_blocking() is False
         self.session = session
-        self.cfg: Config = copy.deepcopy(self.default_cfg)
-        if site_cfg is not None:
-            self.cfg.update(site_cfg)
+        self.reactor = reactor if reactor is not None else Reactor(session)
+        # site_cfg's top-level values replace the defaults, as by
+        # dict.update(). Neither is copied or modified.
+        cfg = LayeredConfig(
+            [site_cfg if site_cfg is not None else {}, self.default_cfg], deep=False
+        )
+        self.cfg: Config = self._validate_cfg(cfg) if self.cfg_schema else cfg
         self.rsrc_path = rsrc_path
         assert self.rsrc_path is None or self.rsrc_path.exists()
-
-        if self.cfg_schema:
-            self.cfg = schema.Schema(
-                {**self.cfg_schema, **_target_host_cfg_schema}
-            ).validate(self.cfg)
+        if template_cache is None:
+            template_cache = get_template_cache(
+                [rsrc_path.parent] if rsrc_path is not None else []
+            )
+        self.template_cache = template_cache
+        self.stats: Counter[str] = stats if stats is not None else collections.Counter()
+        self.site_plan = site_plan
+        # The classes of the whiteprints other than prefabs that this one,
+        # or a whiteprint it ran, ran with use_execute() or use_validate().
+        # Shared with the whiteprints it runs.
+        self._delegated_to: List[Type["Whiteprint"]] = []
 
         computed_prefabs_head = self._compute_prefabs_head(self.cfg)
         if computed_prefabs_head:
@@ -228,6 +970,58 @@ class Whiteprint:
         if computed_prefabs_tail:
             self.prefabs_tail = self.prefabs_tail[:] + computed_prefabs_tail
 
+    @classmethod
+    def _compiled_cfg_schema(cls) -> Any:
+        """Returns the cfg schema combined with _target's, compiled once."""
+        compiled = cls.__dict__.get("_cfg_schema_compiled")
+        if compiled is None or compiled[0] is not cls.cfg_schema:
+            assert cls.cfg_schema is not None
+            compiled = (
+                cls.cfg_schema,
+                schema.Schema({**cls.cfg_schema, **_target_host_cfg_schema}),
+                (
+                    _DeclaredKeysSchema(cls.cfg_schema)
+                    if _DeclaredKeysSchema.applies_to(cls.cfg_schema)
+                    else None
+                ),
+            )
+            cls._cfg_schema_compiled = compiled
+        return compiled[1]
+
+    def _validate_cfg(self, cfg: LayeredConfig) -> Config:
+        """
+        Validates cfg against cfg_schema. Results are memoized, except for
+        the target host's facts which differ from host to host.
+        """
+        compiled = self._compiled_cfg_schema()
+        declared: Optional[_DeclaredKeysSchema] = type(self).__dict__[
+            "_cfg_schema_compiled"
+        ][2]
+        target: Dict[str, Any] = {}
+        if "_target" in cfg:
+            target = _target_schema.validate({"_target": cfg["_target"]})
+        if declared is not None and (declared.closed or declared.other_key_required):
+            # Looking for other keys only goes through the keys, not their
+            # values. If there's one that's not allowed, or none that's
+            # required, the full schema says what's wrong.
+            keys = set(declared.keys)
+            keys.add("_target")
+            has_other = any(key not in keys for key in cfg)
+            if has_other == declared.closed:
+                declared = None
+        if declared is None:
+            plain = cfg.to_dict()
+            plain.pop("_target", None)
+            validated = _validated_cfgs.validate(compiled, plain)
+            # The memoized cfg is shared, so it's only ever read through a
+            # view.
+            return LayeredConfig([target, validated])
+        validated = _validated_cfgs.validate(
+            declared.compiled, {key: cfg[key] for key in declared.keys if key in cfg}
+        )
+        # The keys the schema doesn't declare are left as they are.
+        return LayeredConfig([target, validated, cfg], deep=False)
+
     @classmethod
     def _compute_prefabs_head(
         cls, cfg: Config  # pylint: disable=W0613
@@ -240,172 +1034,630 @@ class Whiteprint:
     ) -> List["Prefab"]:
         return []
 
-    def exec(
-        self, cmd: str, stdin: Optional[bytes] = None, error_ok: bool = False
-    ) -> ExecOutput:
+    def exec(self, cmd: str, stdin: Stdin = None, error_ok: bool = False) -> ExecOutput:
         """
         Executes cmd in a session channel.
 
         This function collects std{out,err} in non-blocking mode to prevent
         the std{out,err} pipes from becoming full and blocking further
-        execution of the cmd.
+        execution of the cmd. Output chunks are accumulated in lists and
+        joined once, so the cost is linear in the size of the output.
+
+        stdin is streamed: it's written as fast as the remote side accepts
+        it, while output is read in the same loop, so a program that writes
+        output while consuming its input can't deadlock. The stdin pipe is
+        explicitly closed after being written to.
 
-        stdin pipe is explicitly closed after being written to.
+        Without stdin, cmd is run by the helper agent if use_agent is set,
+        which streams its output back in chunks, or else in the persistent
+        shell if persistent_shell is set.
 
         Args:
             cmd: Executed in the context of a shell.
-            stdin: Standard input to program.
+            stdin: Standard input to program. Either bytes, a binary file
+                object, a path (pathlib.Path or other os.PathLike) of a local
+                file, or an iterable of bytes chunks. File objects and
+                iterables are consumed lazily, so the input needn't fit in
+                memory.
             error_ok: If true, does not raise a RemoteExecError if exist status
                 is non-zero.
         """
-        chan = retry_eagain(self.session.open_session)
-        try:
-            retry_eagain(lambda: chan.execute(cmd))  # type: ignore
-        except ChannelError:  # pylint: disable=W0706
-            # TODO: Figure out what errors can arise.
-            raise
-        if stdin is not None:
-            chan.write(stdin)
-        chan.send_eof()
+        if stdin is None:
+            if self._uses_agent():
+                try:
+                    return self.reactor.run(self._agent_exec_op(cmd, error_ok))
+                except AgentUnavailableError:
+                    pass
+            if self._uses_persistent_shell():
+                return self.reactor.run(self._shell_exec_op(cmd, error_ok))
+        return self.reactor.run(self._exec_collect_op(cmd, stdin, error_ok))
+
+    def exec_many(
+        self, cmds: Iterable[str], error_ok: bool = False, max_in_flight: int = 8
+    ) -> List[ExecOutput]:
+        """
+        Executes cmds concurrently, each in its own channel on this session.
 
-        stdout = b""
-        stdout_done = False
-        stderr = b""
-        stderr_done = False
-        while True:
-            res = retry_eagain(lambda: wait_session(self.session, 0.1))
-            if res[0]:
-                if not stdout_done:
-                    size, data = chan.read()
-                    while size > 0:
-                        stdout += data
-                        size, data = chan.read()
-                    if size == 0:
-                        stdout_done = True
-                    elif size != LIBSSH2_ERROR_EAGAIN:
-                        assert False, "Unexpected can read error: %d" % size
-                else:
-                    # Sanity check
-                    assert chan.read()[0] == 0
+        Args:
+            cmds: Each is executed in the context of a shell.
+            error_ok: If true, does not raise a RemoteExecError if any exit
+                status is non-zero.
+            max_in_flight: Maximum number of channels open at once. Must not
+                exceed the server's MaxSessions.
 
-                if not stderr_done:
-                    size, data = chan.read_stderr()
-                    while size > 0:
-                        stderr += data
-                        size, data = chan.read_stderr()
-                    if size == 0:
-                        stderr_done = True
-                    elif size != LIBSSH2_ERROR_EAGAIN:
-                        assert False, "Unexpected can read error: %d" % size
-                else:
-                    # Sanity check
-                    assert chan.read_stderr()[0] == 0
+        Returns:
+            The output of each cmd in the same order as cmds.
 
-            res_eof = chan.wait_eof()
-            if res_eof == LIBSSH2_ERROR_EAGAIN:
-                # Process still running
-                continue
-            elif res_eof == 0:
-                if not stdout_done:
-                    size, data = chan.read()
-                    while size > 0:
-                        stdout += data
-                        size, data = chan.read()
-                    if size == 0:
-                        stdout_done = True
-                    else:
-                        assert False, "Unexpected final read error: %d" % size
-                if not stderr_done:
-                    size, data = chan.read_stderr()
-                    while size > 0:
-                        stderr += data
-                        size, data = chan.read_stderr()
-                    if size == 0:
-                        stderr_done = True
-                    else:
-                        assert False, "Unexpected final read error: %d" % size
-                assert stdout_done
-                assert stderr_done
-                # Need to wait for a successful close (0) to get the exit code.
-                assert retry_eagain(chan.close) == 0
-                exec_output = ExecOutput(chan.get_exit_status(), stdout, stderr)
-                if exec_output.exit_status != 0 and not error_ok:
+        Raises:
+            - RemoteExecError: For the first cmd (in input order) with a
+              non-zero exit status. All cmds are run to completion first.
+        """
+        cmds = list(cmds)
+        exec_outputs = self.reactor.run_many(
+            [self._exec_collect_op(cmd, None, True) for cmd in cmds], max_in_flight
+        )
+        if not error_ok:
+            for cmd, exec_output in zip(cmds, exec_outputs):
+                if exec_output.exit_status != 0:
                     raise RemoteExecError(cmd, exec_output)
-                else:
-                    return exec_output
-            else:
-                assert False, "Unexpected wait_eof value: {}".format(res)
+        return exec_outputs
 
-    def _resolve_rsrc(self, raw_path: str) -> Path:
-        raw_path_obj = Path(raw_path)
-        if raw_path_obj.is_absolute():
-            return raw_path_obj
-        else:
-            assert self.rsrc_path is not None, (
-                "Need rsrc_path for lookup of %r but none set." % raw_path
-            )
-            resolved_path = self.rsrc_path / raw_path_obj
-            assert resolved_path.exists(), "Could not find rsrc %r" % raw_path
-            return resolved_path
+    def exec_batch(
+        self, cmds: Iterable[str], error_ok: bool = False
+    ) -> List[ExecOutput]:
+        """
+        Executes cmds in order as one remote script, in a single channel, so
+        that a run of small commands costs one round trip rather than one
+        per command.
 
-    def _scp_send64_helper(
-        self, dest_path: str, mode: int, size: int, mtime: int, atime: int
-    ) -> Channel:
-        try:
-            return retry_eagain(
-                self.session.scp_send64, dest_path, mode & 0o777, size, mtime, atime
+        Each cmd is executed by its own shell, as with exec(), with no stdin.
+
+        Args:
+            error_ok: If true, every cmd is run and no RemoteExecError is
+                raised for non-zero exit statuses. If false, cmds after the
+                first one that fails aren't run.
+
+        Returns:
+            The output of each cmd in the same order as cmds.
+
+        Raises:
+            - RemoteExecError: For the first cmd that failed, or that didn't
+              finish because the script itself was killed.
+        """
+        cmds = list(cmds)
+        if not cmds:
+            return []
+        marker = batch_marker()
+        res = self.exec(
+            BATCH_SHELL, batch_script(cmds, marker, not error_ok), error_ok=True
+        )
+        return self._batch_outputs(cmds, marker, res, error_ok)
+
+    @staticmethod
+    def _batch_outputs(
+        cmds: List[str], marker: bytes, res: ExecOutput, error_ok: bool
+    ) -> List[ExecOutput]:
+        exec_outputs = [
+            ExecOutput(exit_status, stdout, stderr)
+            for exit_status, stdout, stderr in parse_batch(
+                marker, len(cmds), res.stdout, res.stderr
             )
-        except SCPProtocolError as e:
-            # Unfortunately, very coarse error without any more info. It very
-            # possibly occurs in other circumstances as well.
-            assert e.args == ()
-            raise RemoteTargetDirError("%r is a bad path." % dest_path, e) from e
+        ]
+        if not error_ok:
+            for cmd, exec_output in zip(cmds, exec_outputs):
+                if exec_output.exit_status != 0:
+                    raise RemoteExecError(cmd, exec_output)
+        if len(exec_outputs) < len(cmds):
+            raise RemoteExecError(cmds[len(exec_outputs)], res)
+        return exec_outputs
 
-    def _scp_recv2_helper(self, src_path: str) -> Tuple[Channel, FileInfo]:
-        try:
-            # Hack for mypy
-            scp_recv2: Callable[..., Tuple[Channel, FileInfo]] = self.session.scp_recv2
-            return retry_eagain(scp_recv2, src_path)
-        except SCPProtocolError as e:
-            # Unfortunately, very coarse error without any more info. It very
-            # possibly occurs in other circumstances as well.
-            assert e.args == ()
-            raise RemoteFileNotFoundError("%r not found." % src_path, e) from e
+    def _cached_stats(
+        self, paths: List[str]
+    ) -> Tuple[Dict[str, Optional[PathStat]], List[str]]:
+        """
+        Returns the stats of paths that the site plan prefetched, and the
+        paths that still need a stat.
+        """
+        cache = self.site_plan.path_stats if self.site_plan is not None else {}
+        stats = {path: cache[path] for path in paths if path in cache}
+        return stats, [path for path in paths if path not in stats]
 
-    def scp_up(self, src_path: str, dest_path: str, mode: Optional[int] = None) -> None:
+    def stat_many(
+        self, paths: Iterable[str], digest: bool = False
+    ) -> Dict[str, Optional[PathStat]]:
         """
+        Stats remote paths with a single command. Symlinks aren't followed.
+
         Args:
-            src_path: A path on the local filesystem.
-            dest_path: A path on the remote filesystem.
-            mode: The ACL for the new destination file. If omitted, uses the
-                ACL on the source file.
+            digest: If true, regular files' SHA-256 digests are included.
+
+        Returns:
+            Path -> its state, or None if it doesn't exist.
         """
-        src_path_obj = self._resolve_rsrc(src_path)
-        fileinfo = src_path_obj.stat()
+        paths = list(dict.fromkeys(paths))
+        stats, missing = self._cached_stats(paths) if not digest else ({}, paths)
+        if missing:
+            used, res = self._try_agent("stat", paths=missing, digest=digest)
+            if used:
+                stats.update(parse_agent_stats(res))
+            else:
+                res = self.exec(stat_many_cmd(missing, digest))
+                stats.update(parse_stat_many(missing, res.stdout))
+        return {path: stats[path] for path in paths}
+
+    def stat_paths(self, mode: str) -> List[str]:  # pylint: disable=W0613
+        """
+        Paths that validate(mode) stats. A site plan stats the paths of all
+        of its whiteprints and their prefabs at once before validating, and
+        hands the results to stat_many().
+        """
+        return []
+
+    def prefab_whiteprints(self) -> Iterator["Whiteprint"]:
+        """
+        Yields this whiteprint and the whiteprints of its prefabs,
+        recursively. Whiteprints nested with use_execute() can't be found
+        before they run.
+        """
+        yield self
+        for prefab in self.prefabs_head + self.prefabs_tail:
+            yield from self._mk_child(
+                prefab.whiteprint_cls, prefab.cfg
+            ).prefab_whiteprints()
+
+    def agent_call(self, method: str, **params: Any) -> Any:
+        """
+        Makes a request to the helper agent on the target host, starting it
+        if needed. See marchitect.agent for the methods and their params.
+
+        Raises:
+            - AgentUnavailableError: If the agent can't be started.
+            - AgentError: If the request failed.
+        """
+        return self.reactor.run(self._agent_call_op(method, params))
+
+    def _uses_agent(self) -> bool:
+        return (
+            self.use_agent or (self.site_plan is not None and self.site_plan.use_agent)
+        ) and not self.reactor.agent_unavailable
+
+    def _try_agent(self, method: str, **params: Any) -> Tuple[bool, Any]:
+        """
+        Makes a request to the agent if it's enabled and available.
+
+        Returns:
+            Whether the agent was used, and its result.
+        """
+        if not self._uses_agent():
+            return False, None
+        try:
+            return True, self.agent_call(method, **params)
+        except AgentUnavailableError:
+            return False, None
+
+    def _agent_call_op(self, method: str, params: Dict[str, Any]) -> Op[Any]:
+        result, _ = yield from self._agent_request_op(method, params)
+        return result
+
+    def _agent_request_op(
+        self, method: str, params: Dict[str, Any]
+    ) -> Op[Tuple[Any, Dict[str, List[bytes]]]]:
+        """
+        Returns the result of a request, and the output chunks of each stream
+        that were streamed ahead of it.
+        """
+
+        def call(
+            chan: Channel, buf: bytearray
+        ) -> Op[Tuple[Any, Optional[str], Dict[str, List[bytes]]]]:
+            yield from _write_all_op(chan, encode_request(method, params))
+            output: Dict[str, List[bytes]] = {"stdout": [], "stderr": []}
+            while True:
+                line = yield from _read_line_op(chan, buf)
+                if line is None:
+                    raise AgentError(method, "Agent exited")
+                frame = parse_output_frame(line)
+                if frame is None:
+                    return decode_response(line) + (output,)
+                output[frame[0]].append(frame[1])
+
+        result, error, output = yield from self.reactor.agent_op(call)
+        if error is not None:
+            raise AgentError(method, error)
+        return result, output
+
+    def _agent_exec_op(self, cmd: str, error_ok: bool) -> Op[ExecOutput]:
+        result, output = yield from self._agent_request_op("run", {"cmd": cmd})
+        exec_output = ExecOutput(
+            result["exit_status"],
+            b"".join(output["stdout"]),
+            b"".join(output["stderr"]),
+        )
+        if exec_output.exit_status != 0 and not error_ok:
+            raise RemoteExecError(cmd, exec_output)
+        return exec_output
+
+    def _uses_persistent_shell(self) -> bool:
+        return self.persistent_shell or (
+            self.site_plan is not None and self.site_plan.persistent_shell
+        )
+
+    def _shell_exec_op(self, cmd: str, error_ok: bool) -> Op[ExecOutput]:
+        """
+        Executes cmd in the session's persistent shell. If the shell exits
+        before cmd is done, the shell's exit status is cmd's.
+        """
+
+        def run(chan: Channel, marker: bytes) -> Op[ExecOutput]:
+            yield from _write_all_op(chan, shell_cmd_line(cmd, marker))
+            stdout = bytearray()
+            # Only the shell's own errors arrive on stderr.
+            stderr = bytearray()
+            while True:
+                progress = False
+                for read, buf in ((chan.read, stdout), (chan.read_stderr, stderr)):
+                    size, data = read()
+                    while size > 0:
+                        buf += data
+                        progress = True
+                        size, data = read()
+                    assert size in (0, LIBSSH2_ERROR_EAGAIN), (
+                        "Unexpected read error: %d" % size
+                    )
+                reply = split_reply(stdout, marker) if progress else None
+                if reply is not None:
+                    exit_status, reply_stdout, reply_stderr = reply
+                    return ExecOutput(
+                        exit_status, reply_stdout, bytes(stderr) + reply_stderr
+                    )
+                if chan.eof():
+                    self.reactor.discard_shell()
+                    assert (yield from _eagain(chan.close)) == 0
+                    return ExecOutput(
+                        chan.get_exit_status(), bytes(stdout), bytes(stderr)
+                    )
+                if not progress:
+                    yield chan
+
+        exec_output = yield from self.reactor.shell_op(run)
+        if exec_output.exit_status != 0 and not error_ok:
+            raise RemoteExecError(cmd, exec_output)
+        return exec_output
+
+    def _exec_collect_op(
+        self, cmd: str, stdin: Stdin, error_ok: bool
+    ) -> Op[ExecOutput]:
+        chunks: Dict[int, List[bytes]] = {STDOUT: [], STDERR: []}
+        exit_status = yield from self._exec_op(
+            cmd, stdin, lambda fd, data: chunks[fd].append(data)
+        )
+        exec_output = ExecOutput(
+            exit_status, b"".join(chunks[STDOUT]), b"".join(chunks[STDERR])
+        )
+        if exec_output.exit_status != 0 and not error_ok:
+            raise RemoteExecError(cmd, exec_output)
+        return exec_output
+
+    def exec_stream(
+        self, cmd: str, stdin: Stdin = None, error_ok: bool = False
+    ) -> Generator[Tuple[int, bytes], None, int]:
+        """
+        Executes cmd in a session channel and yields output as it arrives.
+
+        Yields (stream, chunk) pairs where stream is STDOUT or STDERR. At most
+        a channel window's worth of output is buffered, so this is the way to
+        consume commands with very large outputs.
+
+        The exit status is the return value of the generator; capture it with
+        `yield from` or from the StopIteration raised by next().
+
+        Args:
+            cmd: Executed in the context of a shell.
+            stdin: Standard input to program.
+            error_ok: If true, does not raise a RemoteExecError if exist status
+                is non-zero. If false, the raised error has empty std{out,err}
+                since those have already been yielded.
+        """
+        pending: Deque[Tuple[int, bytes]] = collections.deque()
+        op = self._exec_op(cmd, stdin, lambda fd, data: pending.append((fd, data)))
+        exit_status: Optional[int] = None
+        while exit_status is None:
+            try:
+                chan = next(op)
+            except StopIteration as e:
+                exit_status = e.value
+                chan = None
+            while pending:
+                yield pending.popleft()
+            if exit_status is None and (chan is None or not _has_buffered_input(chan)):
+                self.reactor.wait()
+        if exit_status != 0 and not error_ok:
+            raise RemoteExecError(cmd, ExecOutput(exit_status, b"", b""))
+        return exit_status
+
+    def _exec_op(
+        self,
+        cmd: str,
+        stdin: Stdin,
+        on_output: Callable[[int, bytes], None],
+    ) -> Op[int]:
+        """
+        Executes cmd, passing output chunks to on_output as they're read.
+
+        stdin is written as the channel window allows, in the same loop that
+        drains output, so a process that writes output before it has read all
+        of its input can't deadlock.
+
+        Returns the exit status.
+        """
+        chan = yield from self.reactor.session_op(self.session.open_session)
+        try:
+            yield from _eagain(chan.execute, cmd)
+        except ChannelError:  # pylint: disable=W0706
+            # TODO: Figure out what errors can arise.
+            raise
+        stdin_chunks = self._stdin_chunks(stdin)
+        # Unwritten remainder of the current stdin chunk.
+        stdin_pending = b""
+
+        def feed() -> Tuple[bool, bool]:
+            """
+            Writes stdin until the channel is full. Returns whether any data
+            was written and whether stdin is exhausted.
+            """
+            nonlocal stdin_pending
+            assert stdin_chunks is not None
+            progress = False
+            while True:
+                if not stdin_pending:
+                    chunk = next(stdin_chunks, None)
+                    if chunk is None:
+                        return progress, True
+                    stdin_pending = chunk
+                    continue
+                if chan.eof():
+                    # The process won't read any more input.
+                    return progress, True
+                rc, sent = chan.write(stdin_pending)
+                if sent:
+                    stdin_pending = stdin_pending[sent:]
+                    progress = True
+                if rc == LIBSSH2_ERROR_EAGAIN:
+                    return progress, False
+
+        stdin_done = stdin_chunks is None
+        if stdin_done:
+            yield from _eagain(chan.send_eof)
+
+        def drain(read: Callable[[], Tuple[int, bytes]], fd: int) -> Tuple[bool, bool]:
+            """Returns whether any data was read and whether the stream is done."""
+            progress = False
+            size, data = read()
+            while size > 0:
+                on_output(fd, data)
+                progress = True
+                size, data = read()
+            if size == 0:
+                return progress, True
+            assert size == LIBSSH2_ERROR_EAGAIN, "Unexpected read error: %d" % size
+            return progress, False
+
+        stdout_done = False
+        stderr_done = False
+        while True:
+            progress = False
+            if not stdin_done:
+                progress, stdin_done = feed()
+                if stdin_done:
+                    # Releases a file opened for a path even if the process
+                    # stopped reading early.
+                    close = getattr(stdin_chunks, "close", None)
+                    if close is not None:
+                        close()
+                    yield from _eagain(chan.send_eof)
+            if not stdout_done:
+                stdout_progress, stdout_done = drain(chan.read, STDOUT)
+                progress |= stdout_progress
+            if not stderr_done:
+                stderr_progress, stderr_done = drain(chan.read_stderr, STDERR)
+                progress |= stderr_progress
+
+            res_eof = chan.wait_eof()
+            if res_eof == LIBSSH2_ERROR_EAGAIN:
+                # Process still running. Only park if this pass read nothing;
+                # otherwise there may be more to read right away.
+                if not progress:
+                    yield chan
+            elif res_eof == 0:
+                if not stdout_done:
+                    _, stdout_done = drain(chan.read, STDOUT)
+                if not stderr_done:
+                    _, stderr_done = drain(chan.read_stderr, STDERR)
+                assert stdout_done, "Unexpected EAGAIN on final stdout read"
+                assert stderr_done, "Unexpected EAGAIN on final stderr read"
+                # Need to wait for a successful close (0) to get the exit code.
+                assert (yield from _eagain(chan.close)) == 0
+                exit_status: int = chan.get_exit_status()
+                return exit_status
+            else:
+                assert False, "Unexpected wait_eof value: {}".format(res_eof)
+
+    def _stdin_chunks(self, stdin: Stdin) -> Optional[Iterator[bytes]]:
+        if stdin is None:
+            return None
+        elif isinstance(stdin, bytes):
+            return self._buffer_chunks(stdin)
+        elif isinstance(stdin, os.PathLike):
+            return self._path_chunks(Path(stdin))
+        elif hasattr(stdin, "read"):
+            return self._file_chunks(stdin)  # type: ignore
+        else:
+            return iter(stdin)
+
+    def _path_chunks(self, path: Path) -> Iterator[bytes]:
+        with path.open("rb") as f:
+            yield from self._file_chunks(f)
+
+    def _resolve_rsrc(self, raw_path: str) -> Path:
+        raw_path_obj = Path(raw_path)
+        if raw_path_obj.is_absolute():
+            return raw_path_obj
+        else:
+            assert self.rsrc_path is not None, (
+                "Need rsrc_path for lookup of %r but none set." % raw_path
+            )
+            resolved_path = self.rsrc_path / raw_path_obj
+            assert resolved_path.exists(), "Could not find rsrc %r" % raw_path
+            return resolved_path
+
+    def _scp_send64_op(
+        self, dest_path: str, mode: int, size: int, mtime: int, atime: int
+    ) -> Op[Channel]:
+        try:
+            chan: Channel = yield from self.reactor.session_op(
+                self.session.scp_send64, dest_path, mode & 0o777, size, mtime, atime
+            )
+        except SCPProtocolError as e:
+            # Unfortunately, very coarse error without any more info. It very
+            # possibly occurs in other circumstances as well.
+            assert e.args == ()
+            raise RemoteTargetDirError("%r is a bad path." % dest_path, e) from e
+        return chan
+
+    def _scp_recv2_op(self, src_path: str) -> Op[Tuple[Channel, FileInfo]]:
+        try:
+            # Hack for mypy
+            scp_recv2: Callable[..., Tuple[Channel, FileInfo]] = self.session.scp_recv2
+            res = yield from self.reactor.session_op(scp_recv2, src_path)
+        except SCPProtocolError as e:
+            # Unfortunately, very coarse error without any more info. It very
+            # possibly occurs in other circumstances as well.
+            assert e.args == ()
+            raise RemoteFileNotFoundError("%r not found." % src_path, e) from e
+        return res
+
+    def _buffer_chunks(self, buf: Any) -> Iterator[bytes]:
+        """Splits a bytes or mmap buffer into scp_chunk_size pieces."""
+        chunk_size = max(1, self.scp_chunk_size)
+        for i in range(0, len(buf), chunk_size):
+            yield buf[i : i + chunk_size]
+
+    def _file_chunks(self, f: IO[bytes]) -> Iterator[bytes]:
+        """Reads the rest of f in scp_chunk_size pieces."""
+        chunk_size = max(1, self.scp_chunk_size)
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+    @staticmethod
+    def _scp_finish_up_op(chan: Channel) -> Op[None]:
+        yield from _eagain(chan.send_eof)
+        yield from _eagain(chan.wait_eof)
+        yield from _eagain(chan.wait_closed)
+        yield from _eagain(chan.close)
+
+    def _up_op(
+        self,
+        dest_path: str,
+        mode: int,
+        size: int,
+        mtime: int,
+        atime: int,
+        chunks: Iterable[bytes],
+        transport: Optional[str] = None,
+    ) -> Op[None]:
+        """
+        Uploads chunks totalling size bytes as dest_path.
+
+        Args:
+            mtime: If 0, mtime and atime are left to the remote host.
+            transport: "scp" or "sftp". If None, uses self.transport.
+        """
+        transport = transport or self.transport
+        if transport == "sftp":
+            yield from self._sftp_up_op(dest_path, mode, mtime, atime, chunks)
+            return
+        assert transport == "scp", "Unknown transport: %r" % transport
+        chan = yield from self._scp_send64_op(dest_path, mode, size, mtime, atime)
+        for chunk in chunks:
+            yield from _write_all_op(chan, chunk)
+        yield from self._scp_finish_up_op(chan)
+
+    def _down_op(
+        self,
+        src_path: str,
+        on_data: Callable[[bytes], Any],
+        transport: Optional[str] = None,
+    ) -> Op[None]:
+        """
+        Downloads src_path, passing its contents to on_data piece by piece.
+
+        Args:
+            transport: "scp" or "sftp". If None, uses self.transport.
+        """
+        transport = transport or self.transport
+        if transport == "sftp":
+            yield from self._sftp_down_op(src_path, on_data)
+            return
+        assert transport == "scp", "Unknown transport: %r" % transport
+        chan, fileinfo = yield from self._scp_recv2_op(src_path)
+        expected_size = fileinfo.st_size
+        while True:
+            size, data = chan.read()
+            while size == LIBSSH2_ERROR_EAGAIN:
+                yield chan
+                size, data = chan.read()
+            if size == expected_size + 1:
+                on_data(data[:-1])
+                yield from _eagain(chan.close)
+                return
+            else:
+                on_data(data)
+                expected_size -= size
+
+    def scp_up(self, src_path: str, dest_path: str, mode: Optional[int] = None) -> None:
+        """
+        Args:
+            src_path: A path on the local filesystem.
+            dest_path: A path on the remote filesystem.
+            mode: The ACL for the new destination file. If omitted, uses the
+                ACL on the source file.
+        """
+        self.reactor.run(self._scp_up_op(src_path, dest_path, mode))
+
+    def _scp_up_op(
+        self,
+        src_path: str,
+        dest_path: str,
+        mode: Optional[int] = None,
+        transport: Optional[str] = None,
+    ) -> Op[None]:
+        src_path_obj = self._resolve_rsrc(src_path)
+        fileinfo = src_path_obj.stat()
         if mode is None:
             mode = fileinfo.st_mode
-        chan = self._scp_send64_helper(
-            dest_path,
-            mode,
-            fileinfo.st_size,
-            int(fileinfo.st_mtime),
-            int(fileinfo.st_atime),
-        )
+        mtime = int(fileinfo.st_mtime)
+        atime = int(fileinfo.st_atime)
         with src_path_obj.open("rb") as f:
-            for data in f:
-                mv_data = memoryview(data)
-                while True:
-                    _, sent = chan.write(bytes(mv_data))
-                    mv_data = mv_data[sent:]
-                    if len(mv_data) == 0:
-                        break
-        while chan.send_eof() == LIBSSH2_ERROR_EAGAIN:
-            continue
-        while chan.wait_eof() == LIBSSH2_ERROR_EAGAIN:
-            continue
-        while chan.wait_closed() == LIBSSH2_ERROR_EAGAIN:
-            continue
-        chan.close()
+            if fileinfo.st_size == 0:
+                yield from self._up_op(dest_path, mode, 0, mtime, atime, [], transport)
+                return
+            # Slicing the mapping copies straight from the page cache into
+            # the bytes that libssh2's bindings need.
+            with mmap.mmap(f.fileno(), fileinfo.st_size, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                yield from self._up_op(
+                    dest_path,
+                    mode,
+                    fileinfo.st_size,
+                    mtime,
+                    atime,
+                    self._buffer_chunks(mm),
+                    transport,
+                )
 
     def scp_down(self, src_path: str, dest_path: str) -> None:
         """
@@ -413,20 +1665,13 @@ class Whiteprint:
             src_path: A path on the remote filesystem.
             dest_path: A path on the local filesystem.
         """
-        chan, fileinfo = self._scp_recv2_helper(src_path)
-        expected_size = fileinfo.st_size
+        self.reactor.run(self._scp_down_op(src_path, dest_path))
+
+    def _scp_down_op(
+        self, src_path: str, dest_path: str, transport: Optional[str] = None
+    ) -> Op[None]:
         with open(dest_path, "wb") as f:
-            while True:
-                size, data = chan.read()
-                while size == LIBSSH2_ERROR_EAGAIN:
-                    size, data = chan.read()
-                if size == expected_size + 1:
-                    f.write(data[:-1])
-                    retry_eagain(chan.close)
-                    return
-                else:
-                    f.write(data)
-                    expected_size -= size
+            yield from self._down_op(src_path, f.write, transport)
 
     def scp_up_from_bytes(self, data: bytes, dest_path: str, mode: int = 0o664) -> None:
         """
@@ -438,30 +1683,17 @@ class Whiteprint:
             mode: The ACL for the new destination file. If omitted, uses the
                 ACL on the source file.
         """
-        assert isinstance(data, bytes)
-
-        def chunks(l: bytes, n: int) -> Iterable[bytes]:
-            n = max(1, n)
-            return (l[i : i + n] for i in range(0, len(l), n))
+        self.reactor.run(self._scp_up_from_bytes_op(data, dest_path, mode))
 
+    def _scp_up_from_bytes_op(
+        self, data: bytes, dest_path: str, mode: int = 0o664
+    ) -> Op[None]:
+        assert isinstance(data, bytes)
         # Goal: mtime/atime to be set to the current time on the target
         # machine. Solution: Setting mtime/atime to 0 seems to work.
-        chan = self._scp_send64_helper(dest_path, mode, len(data), 0, 0)
-        # TODO: Find optimal chunk size.
-        for chunk in chunks(data, 32_000):
-            mv_chunk = memoryview(chunk)
-            while True:
-                _, sent = chan.write(bytes(mv_chunk))
-                mv_chunk = mv_chunk[sent:]
-                if len(mv_chunk) == 0:
-                    break
-        while chan.send_eof() == LIBSSH2_ERROR_EAGAIN:
-            continue
-        while chan.wait_eof() == LIBSSH2_ERROR_EAGAIN:
-            continue
-        while chan.wait_closed() == LIBSSH2_ERROR_EAGAIN:
-            continue
-        chan.close()
+        yield from self._up_op(
+            dest_path, mode, len(data), 0, 0, self._buffer_chunks(data)
+        )
 
     def scp_down_to_bytes(self, src_path: str) -> bytes:
         """
@@ -473,29 +1705,278 @@ class Whiteprint:
         Returns:
             Contents of the requested file.
         """
-        chan, fileinfo = self._scp_recv2_helper(src_path)
-        expected_size = fileinfo.st_size
+        return self.reactor.run(self._scp_down_to_bytes_op(src_path))
+
+    def _scp_down_to_bytes_op(self, src_path: str) -> Op[bytes]:
+        chunks: List[bytes] = []
+        yield from self._down_op(src_path, chunks.append)
+        return b"".join(chunks)
+
+    def sftp_up(
+        self, src_path: str, dest_path: str, mode: Optional[int] = None
+    ) -> None:
+        """
+        Like :meth:`scp_up`, but always transfers over SFTP.
+
+        Raises:
+            - RemoteTargetDirError: If the target directory does not exist.
+            - RemoteSFTPError: For other SFTP failures.
+        """
+        self.reactor.run(self._scp_up_op(src_path, dest_path, mode, "sftp"))
+
+    def sftp_down(self, src_path: str, dest_path: str) -> None:
+        """
+        Like :meth:`scp_down`, but always transfers over SFTP.
+
+        Raises:
+            - RemoteFileNotFoundError: If src_path does not exist.
+            - RemoteSFTPError: For other SFTP failures.
+        """
+        self.reactor.run(self._scp_down_op(src_path, dest_path, "sftp"))
+
+    def sftp_stat(self, path: str) -> SFTPAttributes:
+        """
+        Returns the attributes (filesize, permissions, uid, gid, atime, mtime)
+        of a remote path.
+
+        Raises:
+            - RemoteFileNotFoundError: If path does not exist.
+            - RemoteSFTPError: For other SFTP failures.
+        """
+        return self.reactor.run(self._sftp_stat_op(path))
+
+    def _sftp_error(self, path: str, e: SFTPError, upload: bool) -> WhiteprintError:
+        """Maps a failed SFTP request to an exception using its status code."""
+        code = self.reactor.sftp_last_error()
+        if code in (SFTP_NO_SUCH_FILE, SFTP_NO_SUCH_PATH):
+            if upload:
+                return RemoteTargetDirError("%r is a bad path." % path, e)
+            return RemoteFileNotFoundError("%r not found." % path, e)
+        return RemoteSFTPError(path, code, e)
+
+    def _sftp_stat_op(self, path: str) -> Op[SFTPAttributes]:
+        def stat(sftp: SFTP) -> Op[SFTPAttributes]:
+            try:
+                return (yield from _eagain_obj(sftp.stat, path))
+            except SFTPError as e:
+                raise self._sftp_error(path, e, False) from e
+
+        return (yield from self.reactor.sftp_op(stat))
+
+    def _sftp_up_op(
+        self, dest_path: str, mode: int, mtime: int, atime: int, chunks: Iterable[bytes]
+    ) -> Op[None]:
+        flags = LIBSSH2_FXF_WRITE | LIBSSH2_FXF_CREAT | LIBSSH2_FXF_TRUNC
 
-        data = b""
+        def up(sftp: SFTP) -> Op[None]:
+            try:
+                handle: SFTPHandle = yield from _eagain_obj(
+                    sftp.open, dest_path, flags, mode & 0o777
+                )
+            except SFTPError as e:
+                raise self._sftp_error(dest_path, e, True) from e
+            try:
+                yield from self._sftp_write_op(handle, chunks)
+                if mtime:
+                    attrs = SFTPAttributes()
+                    attrs.flags = LIBSSH2_SFTP_ATTR_ACMODTIME
+                    attrs.mtime = mtime
+                    attrs.atime = atime
+                    yield from _eagain(handle.fsetstat, attrs)
+            except SFTPError as e:
+                err = self._sftp_error(dest_path, e, True)
+                self.reactor.discard_sftp()
+                raise err from e
+            except BaseException:
+                self.reactor.discard_sftp()
+                raise
+            yield from _eagain(handle.close)
+
+        yield from self.reactor.sftp_op(up)
+
+    def _sftp_write_op(self, handle: SFTPHandle, chunks: Iterable[bytes]) -> Op[None]:
+        """
+        Writes chunks to handle, keeping up to sftp_pipeline_size bytes of write
+        requests in flight so that round trips don't cap throughput.
+        """
+        chunk_iter = iter(chunks)
+        exhausted = False
+        # Starts at the first byte the server hasn't acknowledged. libssh2
+        # resumes from the same position and sends any newly appended data.
+        pending = b""
         while True:
-            size, chunk = chan.read()
-            while size == LIBSSH2_ERROR_EAGAIN:
-                size, chunk = chan.read()
-            if size == expected_size + 1:
-                data += chunk[:-1]
-                retry_eagain(chan.close)
-                return data
-            else:
-                data += chunk
-                expected_size -= size
+            if not exhausted and len(pending) < self.sftp_pipeline_size:
+                parts = [pending]
+                size = len(pending)
+                while size < self.sftp_pipeline_size:
+                    chunk = next(chunk_iter, None)
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    parts.append(chunk)
+                    size += len(chunk)
+                pending = b"".join(parts)
+            if not pending:
+                return
+            rc, acked = handle.write(pending)
+            if acked:
+                pending = pending[acked:]
+            if rc == LIBSSH2_ERROR_EAGAIN:
+                yield None
+
+    def _sftp_down_op(self, src_path: str, on_data: Callable[[bytes], Any]) -> Op[None]:
+        def down(sftp: SFTP) -> Op[None]:
+            try:
+                handle: SFTPHandle = yield from _eagain_obj(
+                    sftp.open, src_path, LIBSSH2_FXF_READ, 0
+                )
+            except SFTPError as e:
+                raise self._sftp_error(src_path, e, False) from e
+            try:
+                while True:
+                    # libssh2 splits large reads into many outstanding requests.
+                    size, data = handle.read(self.sftp_pipeline_size)
+                    if size == LIBSSH2_ERROR_EAGAIN:
+                        yield None
+                    elif size == 0:
+                        break
+                    else:
+                        on_data(data)
+            except SFTPError as e:
+                err = self._sftp_error(src_path, e, False)
+                self.reactor.discard_sftp()
+                raise err from e
+            except BaseException:
+                self.reactor.discard_sftp()
+                raise
+            yield from _eagain(handle.close)
+
+        yield from self.reactor.sftp_op(down)
+
+    def sync_tree(
+        self,
+        local_dir: str,
+        remote_dir: str,
+        delete: bool = False,
+        max_in_flight: int = 8,
+    ) -> TreeDiff:
+        """
+        Makes remote_dir a copy of local_dir, uploading only files that were
+        added or changed.
+
+        Files are compared by size and SHA-256 digest. The remote manifest is
+        fetched in a single command, so an unchanged tree costs one round
+        trip. Changed files are uploaded concurrently.
+
+        Args:
+            local_dir: A path on the local filesystem. Relative paths are
+                resolved against the resource folder.
+            remote_dir: A path on the remote filesystem. Created if missing.
+            delete: If true, remote files and folders that don't exist
+                locally are removed.
+            max_in_flight: Maximum number of concurrent uploads.
+
+        Returns:
+            The changes that were made.
+        """
+        return self.reactor.run(
+            self._sync_tree_op(local_dir, remote_dir, delete, max_in_flight)
+        )
+
+    def diff_tree(
+        self, local_dir: str, remote_dir: str, delete: bool = False
+    ) -> TreeDiff:
+        """
+        Returns the changes sync_tree() would make without making them.
+        """
+        return self.reactor.run(self._diff_tree_op(local_dir, remote_dir, delete))
+
+    def _diff_tree_op(
+        self, local_dir: str, remote_dir: str, delete: bool
+    ) -> Op[TreeDiff]:
+        local = Manifest.from_local(self._resolve_rsrc(local_dir))
+        # Digests of unreadable files are missing; they're treated as changed.
+        res = yield from self._exec_collect_op(
+            remote_manifest_cmd(remote_dir), None, True
+        )
+        remote = Manifest.from_remote_output(res.stdout)
+        return diff_manifests(local, remote, delete)
+
+    def _sync_tree_op(
+        self, local_dir: str, remote_dir: str, delete: bool, max_in_flight: int
+    ) -> Op[TreeDiff]:
+        diff = yield from self._diff_tree_op(local_dir, remote_dir, delete)
+        self.stats["files_skipped"] += diff.unchanged
+        if not diff.changed:
+            return diff
+        cmd = diff.prepare_cmd(remote_dir)
+        if cmd is not None:
+            yield from self._exec_collect_op(cmd, None, False)
+        local_root = self._resolve_rsrc(local_dir)
+        yield from self.reactor.gather(
+            [
+                self._scp_up_op(
+                    str(local_root / path), posixpath.join(remote_dir, path)
+                )
+                for path in diff.uploads
+            ],
+            max_in_flight,
+        )
+        self.stats["files_uploaded"] += len(diff.uploads)
+        return diff
+
+    def tar_up(
+        self,
+        local_dir: str,
+        remote_dir: str,
+        compression: Optional[str] = "gzip",
+        compression_level: Optional[int] = None,
+    ) -> None:
+        """
+        Uploads a folder as a compressed tar archive streamed into `tar -x` on
+        the target.
+
+        Every file is sent, so this is best for first-time installs of large
+        trees: a single channel avoids per-file round trips and compression
+        cuts the bytes sent. Use sync_tree() to update a tree in place.
+
+        Args:
+            local_dir: A path on the local filesystem. Relative paths are
+                resolved against the resource folder.
+            remote_dir: A path on the remote filesystem. Created if missing.
+                Existing files are overwritten; others are left alone.
+            compression: "gzip", "bzip2", "xz", or None. The target's tar
+                must support it.
+            compression_level: If None, uses the compressor's default.
+        """
+        self.reactor.run(
+            self._tar_up_op(local_dir, remote_dir, compression, compression_level)
+        )
+
+    def _tar_up_op(
+        self,
+        local_dir: str,
+        remote_dir: str,
+        compression: Optional[str],
+        compression_level: Optional[int],
+    ) -> Op[None]:
+        assert compression in TAR_FLAGS, "Unknown compression: %r" % compression
+        quoted_dir = shlex.quote(remote_dir)
+        cmd = "mkdir -p -- {0} && tar -x{1}f - --no-same-owner -C {0}".format(
+            quoted_dir, TAR_FLAGS[compression]
+        )
+        chunks = tar_chunks(
+            self._resolve_rsrc(local_dir),
+            compression,
+            compression_level,
+            self.scp_chunk_size,
+        )
+        yield from self._exec_collect_op(cmd, chunks, False)
 
     def _resolve_cfg(self, cfg_override: Optional[Config]) -> Config:
         if cfg_override is not None:
-            cfg = copy.deepcopy(self.cfg)
-            dict_deep_update(cfg, cfg_override)
-        else:
-            cfg = self.cfg
-        return cfg
+            return LayeredConfig([cfg_override, self.cfg])
+        return self.cfg
 
     def scp_up_template(
         self,
@@ -503,26 +1984,48 @@ class Whiteprint:
         dest_path: str,
         mode: Optional[int] = None,
         cfg_override: Optional[Config] = None,
-    ) -> None:
+        skip_unchanged: bool = False,
+    ) -> bool:
         """
         Args:
             src_path: Path to a jinja template file. Variable substitution will
                 be done before upload.
             cfg_override: Additional configuration variables with precedence
                 over those of this whiteprint.
+            skip_unchanged: If set, the upload is skipped when the remote file
+                has the same SHA-256 digest as the rendered template. The
+                remote file's mode is left as is when skipped.
         See :meth:`src_up`.
+
+        Returns:
+            Whether the file was uploaded.
         """
+        return self.reactor.run(
+            self._scp_up_template_op(
+                src_path, dest_path, mode, cfg_override, skip_unchanged
+            )
+        )
+
+    def _scp_up_template_op(
+        self,
+        src_path: str,
+        dest_path: str,
+        mode: Optional[int] = None,
+        cfg_override: Optional[Config] = None,
+        skip_unchanged: bool = False,
+    ) -> Op[bool]:
         cfg = self._resolve_cfg(cfg_override)
         src_path_obj = self._resolve_rsrc(src_path)
         if mode is None:
             fileinfo = src_path_obj.stat()
             mode = fileinfo.st_mode
 
-        with src_path_obj.open(encoding="utf8") as f:
-            template_contents = f.read()
-        template = jinja2.Template(template_contents, undefined=MostlyStrictUndefined)
-        rendered_template = template.render(cfg).encode("utf-8")
-        self.scp_up_from_bytes(rendered_template, dest_path, mode)
+        template = self.template_cache.from_path(src_path_obj)
+        return (
+            yield from self._scp_up_rendered_op(
+                template, cfg, dest_path, mode, skip_unchanged
+            )
+        )
 
     def scp_up_template_from_str(
         self,
@@ -530,16 +2033,108 @@ class Whiteprint:
         dest_path: str,
         mode: int = 0o664,
         cfg_override: Optional[Config] = None,
-    ) -> None:
+        skip_unchanged: bool = False,
+    ) -> bool:
+        """See :meth:`scp_up_template`."""
+        return self.reactor.run(
+            self._scp_up_template_from_str_op(
+                template_contents, dest_path, mode, cfg_override, skip_unchanged
+            )
+        )
+
+    def _scp_up_template_from_str_op(
+        self,
+        template_contents: str,
+        dest_path: str,
+        mode: int = 0o664,
+        cfg_override: Optional[Config] = None,
+        skip_unchanged: bool = False,
+    ) -> Op[bool]:
         cfg = self._resolve_cfg(cfg_override)
-        template = jinja2.Template(template_contents, undefined=MostlyStrictUndefined)
-        rendered_template = template.render(cfg).encode("utf-8")
-        self.scp_up_from_bytes(rendered_template, dest_path, mode)
+        template = self.template_cache.from_str(template_contents)
+        return (
+            yield from self._scp_up_rendered_op(
+                template, cfg, dest_path, mode, skip_unchanged
+            )
+        )
+
+    def _scp_up_rendered_op(
+        self,
+        template: jinja2.Template,
+        cfg: Config,
+        dest_path: str,
+        mode: int,
+        skip_unchanged: bool,
+    ) -> Op[bool]:
+        # SCP needs the size up front, so the template is rendered into a
+        # spooled file first. Rendering streams through generate() so that
+        # large outputs spill to disk rather than being held in memory.
+        with tempfile.SpooledTemporaryFile(
+            max_size=self.template_spool_max_size
+        ) as spool:
+            yield from self._render_op(template, cfg, spool)
+            size = spool.tell()
+            if skip_unchanged:
+                spool.seek(0)
+                digest = hashlib.sha256()
+                for data in iter(lambda: spool.read(32_000), b""):
+                    digest.update(data)
+                remote_digest = yield from self._remote_sha256_op(dest_path)
+                if remote_digest == digest.hexdigest():
+                    self.stats["files_skipped"] += 1
+                    return False
+            spool.seek(0)
+            yield from self._up_op(
+                dest_path, mode, size, 0, 0, self._file_chunks(spool)
+            )
+            if skip_unchanged:
+                self.stats["files_uploaded"] += 1
+            return True
+
+    def _render_op(
+        self, template: jinja2.Template, cfg: Config, f: IO[bytes]
+    ) -> Op[None]:
+        """
+        Renders template into f. Facts that the template looks up and that
+        haven't been gathered are gathered over this whiteprint's session,
+        and then the template is rendered again.
+        """
+        while True:
+            f.seek(0)
+            f.truncate()
+            text = io.TextIOWrapper(f, encoding="utf-8")
+            try:
+                with defer_gathering():
+                    text.writelines(generate(template, cfg))
+                return
+            except FactsNeeded as e:
+                needed = e
+            finally:
+                text.flush()
+                text.detach()
+            yield from needed.facts.gather_op(self.session, self.reactor, needed.names)
+
+    def _remote_sha256_op(self, path: str) -> Op[Optional[str]]:
+        """Returns the hex SHA-256 digest of a remote file, or None if absent."""
+        if self._uses_agent():
+            try:
+                digests = yield from self._agent_call_op("hash", {"paths": [path]})
+            except AgentUnavailableError:
+                pass
+            else:
+                digest: Optional[str] = digests[path]
+                return digest
+        res = yield from self._exec_collect_op(
+            "sha256sum -- {}".format(shlex.quote(path)), None, True
+        )
+        if res.exit_status != 0:
+            return None
+        return res.stdout.split(maxsplit=1)[0].decode("ascii")
 
     @staticmethod
     def render_template(template_contents: str, cfg: Config) -> str:
-        template = jinja2.Template(template_contents, undefined=MostlyStrictUndefined)
-        return template.render(cfg)
+        template = get_template_cache().from_str(template_contents)
+        return render(template, cfg)
 
     def execute(self, mode: str) -> None:
         for prefab in self.prefabs_head:
@@ -589,6 +2184,37 @@ class Whiteprint:
     def _validate(self, mode: str) -> Optional[str]:
         raise NotImplementedError
 
+    def once(self, name: str, cmd: str) -> bool:
+        """
+        Executes cmd as the task name, e.g. "apt-update", unless a task by
+        that name already ran during the site plan's current run. Without a
+        site plan, cmd is always executed.
+
+        Returns:
+            Whether cmd was executed.
+        """
+        if self.site_plan is None:
+            self.exec(cmd)
+            return True
+        tasks = self.site_plan.tasks
+        with tasks.lock(name):
+            if name in tasks.ran:
+                return False
+            self.exec(cmd)
+            tasks.ran.add(name)
+        return True
+
+    def notify(self, name: str, cmd: str) -> None:
+        """
+        Queues cmd as the task name, e.g. "restart-nginx", to be executed
+        once after the site plan's steps have all succeeded. Without a site
+        plan, cmd is executed right away.
+        """
+        if self.site_plan is None:
+            self.exec(cmd)
+        else:
+            self.site_plan.tasks.notify(name, cmd)
+
     def use_execute(
         self,
         mode: str,
@@ -598,7 +2224,7 @@ class Whiteprint:
         """
         Execute another whiteprint from this whiteprint.
         """
-        wp = whiteprint_cls(self.session, cfg, self.rsrc_path)
+        wp = self._mk_child(whiteprint_cls, cfg)
         wp.execute(mode)
 
     def use_validate(
@@ -613,35 +2239,341 @@ class Whiteprint:
         Raises:
             - ValidationError: If validation failed.
         """
-        wp = whiteprint_cls(self.session, cfg, self.rsrc_path)
+        wp = self._mk_child(whiteprint_cls, cfg)
         err = wp.validate(mode)
         if err:
             raise ValidationError(err)
 
+    @property
+    def delegated(self) -> bool:
+        """
+        Whether this whiteprint ran whiteprints other than its prefabs with
+        use_execute() or use_validate(). What these do isn't known before
+        they run, so a step that delegates isn't fingerprinted.
+        """
+        return bool(self._delegated_to)
+
+    def _mk_child(
+        self, whiteprint_cls: Type["Whiteprint"], cfg: Optional[Config]
+    ) -> "Whiteprint":
+        """Creates a whiteprint sharing this one's session and resources."""
+        if not any(
+            prefab.whiteprint_cls is whiteprint_cls and prefab.cfg is cfg
+            for prefab in self.prefabs_head + self.prefabs_tail
+        ):
+            self._delegated_to.append(whiteprint_cls)
+        wp = whiteprint_cls(
+            self.session,
+            cfg,
+            self.rsrc_path,
+            self.reactor,
+            self.template_cache,
+            self.stats,
+            self.site_plan,
+        )
+        wp._delegated_to = self._delegated_to  # pylint: disable=W0212
+        return wp
+
+
+class AsyncWhiteprint(Whiteprint):
+    """
+    A whiteprint whose remote operations are coroutines.
+
+    Subclass and implement `async def _execute()` and optionally
+    `async def _validate()`. Operations wait on the session's socket through
+    the running event loop, so a single loop can drive many hosts at once.
+
+    Prefabs and nested whiteprints that aren't AsyncWhiteprints are run in
+    the loop's default executor so they don't block the loop.
+    """
+
+    # Coroutine counterparts of the Whiteprint methods they override.
+    # pylint: disable=W0236
+
+    async def exec(  # type: ignore[override]
+        self, cmd: str, stdin: Stdin = None, error_ok: bool = False
+    ) -> ExecOutput:
+        """See :meth:`Whiteprint.exec`."""
+        if stdin is None:
+            if self._uses_agent():
+                try:
+                    return await self.reactor.run_async(
+                        self._agent_exec_op(cmd, error_ok)
+                    )
+                except AgentUnavailableError:
+                    pass
+            if self._uses_persistent_shell():
+                return await self.reactor.run_async(self._shell_exec_op(cmd, error_ok))
+        return await self.reactor.run_async(self._exec_collect_op(cmd, stdin, error_ok))
+
+    async def exec_many(  # type: ignore[override]
+        self, cmds: Iterable[str], error_ok: bool = False, max_in_flight: int = 8
+    ) -> List[ExecOutput]:
+        """See :meth:`Whiteprint.exec_many`."""
+        cmds = list(cmds)
+        exec_outputs = await self.reactor.run_many_async(
+            [self._exec_collect_op(cmd, None, True) for cmd in cmds], max_in_flight
+        )
+        if not error_ok:
+            for cmd, exec_output in zip(cmds, exec_outputs):
+                if exec_output.exit_status != 0:
+                    raise RemoteExecError(cmd, exec_output)
+        return exec_outputs
+
+    async def exec_batch(  # type: ignore[override]
+        self, cmds: Iterable[str], error_ok: bool = False
+    ) -> List[ExecOutput]:
+        """See :meth:`Whiteprint.exec_batch`."""
+        cmds = list(cmds)
+        if not cmds:
+            return []
+        marker = batch_marker()
+        res = await self.exec(
+            BATCH_SHELL, batch_script(cmds, marker, not error_ok), error_ok=True
+        )
+        return self._batch_outputs(cmds, marker, res, error_ok)
+
+    async def stat_many(  # type: ignore[override]
+        self, paths: Iterable[str], digest: bool = False
+    ) -> Dict[str, Optional[PathStat]]:
+        """See :meth:`Whiteprint.stat_many`."""
+        paths = list(dict.fromkeys(paths))
+        stats, missing = self._cached_stats(paths) if not digest else ({}, paths)
+        if missing:
+            used, res = await self._try_agent("stat", paths=missing, digest=digest)
+            if used:
+                stats.update(parse_agent_stats(res))
+            else:
+                res = await self.exec(stat_many_cmd(missing, digest))
+                stats.update(parse_stat_many(missing, res.stdout))
+        return {path: stats[path] for path in paths}
+
+    async def agent_call(self, method: str, **params: Any) -> Any:
+        """See :meth:`Whiteprint.agent_call`."""
+        return await self.reactor.run_async(self._agent_call_op(method, params))
+
+    async def _try_agent(  # type: ignore[override]
+        self, method: str, **params: Any
+    ) -> Tuple[bool, Any]:
+        """See :meth:`Whiteprint._try_agent`."""
+        if not self._uses_agent():
+            return False, None
+        try:
+            return True, await self.agent_call(method, **params)
+        except AgentUnavailableError:
+            return False, None
+
+    async def scp_up(  # type: ignore[override]
+        self, src_path: str, dest_path: str, mode: Optional[int] = None
+    ) -> None:
+        """See :meth:`Whiteprint.scp_up`."""
+        await self.reactor.run_async(self._scp_up_op(src_path, dest_path, mode))
+
+    async def scp_down(  # type: ignore[override]
+        self, src_path: str, dest_path: str
+    ) -> None:
+        """See :meth:`Whiteprint.scp_down`."""
+        await self.reactor.run_async(self._scp_down_op(src_path, dest_path))
+
+    async def scp_up_from_bytes(  # type: ignore[override]
+        self, data: bytes, dest_path: str, mode: int = 0o664
+    ) -> None:
+        """See :meth:`Whiteprint.scp_up_from_bytes`."""
+        await self.reactor.run_async(self._scp_up_from_bytes_op(data, dest_path, mode))
+
+    async def scp_down_to_bytes(self, src_path: str) -> bytes:  # type: ignore[override]
+        """See :meth:`Whiteprint.scp_down_to_bytes`."""
+        return await self.reactor.run_async(self._scp_down_to_bytes_op(src_path))
+
+    async def sftp_up(  # type: ignore[override]
+        self, src_path: str, dest_path: str, mode: Optional[int] = None
+    ) -> None:
+        """See :meth:`Whiteprint.sftp_up`."""
+        await self.reactor.run_async(self._scp_up_op(src_path, dest_path, mode, "sftp"))
+
+    async def sftp_down(  # type: ignore[override]
+        self, src_path: str, dest_path: str
+    ) -> None:
+        """See :meth:`Whiteprint.sftp_down`."""
+        await self.reactor.run_async(self._scp_down_op(src_path, dest_path, "sftp"))
+
+    async def sftp_stat(self, path: str) -> SFTPAttributes:
+        """See :meth:`Whiteprint.sftp_stat`."""
+        return await self.reactor.run_async(self._sftp_stat_op(path))
+
+    async def sync_tree(  # type: ignore[override]
+        self,
+        local_dir: str,
+        remote_dir: str,
+        delete: bool = False,
+        max_in_flight: int = 8,
+    ) -> TreeDiff:
+        """See :meth:`Whiteprint.sync_tree`."""
+        return await self.reactor.run_async(
+            self._sync_tree_op(local_dir, remote_dir, delete, max_in_flight)
+        )
+
+    async def diff_tree(  # type: ignore[override]
+        self, local_dir: str, remote_dir: str, delete: bool = False
+    ) -> TreeDiff:
+        """See :meth:`Whiteprint.diff_tree`."""
+        return await self.reactor.run_async(
+            self._diff_tree_op(local_dir, remote_dir, delete)
+        )
+
+    async def tar_up(  # type: ignore[override]
+        self,
+        local_dir: str,
+        remote_dir: str,
+        compression: Optional[str] = "gzip",
+        compression_level: Optional[int] = None,
+    ) -> None:
+        """See :meth:`Whiteprint.tar_up`."""
+        await self.reactor.run_async(
+            self._tar_up_op(local_dir, remote_dir, compression, compression_level)
+        )
+
+    async def scp_up_template(  # type: ignore[override]
+        self,
+        src_path: str,
+        dest_path: str,
+        mode: Optional[int] = None,
+        cfg_override: Optional[Config] = None,
+        skip_unchanged: bool = False,
+    ) -> bool:
+        """See :meth:`Whiteprint.scp_up_template`."""
+        return await self.reactor.run_async(
+            self._scp_up_template_op(
+                src_path, dest_path, mode, cfg_override, skip_unchanged
+            )
+        )
+
+    async def scp_up_template_from_str(  # type: ignore[override]
+        self,
+        template_contents: str,
+        dest_path: str,
+        mode: int = 0o664,
+        cfg_override: Optional[Config] = None,
+        skip_unchanged: bool = False,
+    ) -> bool:
+        """See :meth:`Whiteprint.scp_up_template_from_str`."""
+        return await self.reactor.run_async(
+            self._scp_up_template_from_str_op(
+                template_contents, dest_path, mode, cfg_override, skip_unchanged
+            )
+        )
+
+    async def execute(self, mode: str) -> None:  # type: ignore[override]
+        for prefab in self.prefabs_head:
+            try:
+                await self.use_execute(mode, prefab.whiteprint_cls, prefab.cfg)
+            except NotImplementedError:
+                pass
+        try:
+            await self._execute(mode)
+        except NotImplementedError:
+            pass
+        for prefab in self.prefabs_tail:
+            try:
+                await self.use_execute(mode, prefab.whiteprint_cls, prefab.cfg)
+            except NotImplementedError:
+                pass
 
-class MostlyStrictUndefined(jinja2.Undefined):
-    """Just like jinja2's built-in except __bool__ is allowed.
-
-    This allows templates to check whether a variable is defined (also
-    conflated with truthy) without raising an error. However, all other uses
-    of an undefined will raise an error.
-    """
-
-    __slots__ = ()
-    # Alright black... whatever you say.
-    __iter__ = (
-        __str__
-    ) = (
-        __len__
-    ) = (
-        __nonzero__
-    ) = (
-        __eq__
-    ) = (
-        __ne__
-    ) = (
-        __hash__
-    ) = jinja2.Undefined._fail_with_undefined_error  # pylint:disable=protected-access
+    async def _execute(self, mode: str) -> None:  # type: ignore[override]
+        raise NotImplementedError
+
+    async def validate(self, mode: str) -> Optional[str]:  # type: ignore[override]
+        for prefab in self.prefabs_head:
+            try:
+                await self.use_validate(mode, prefab.whiteprint_cls, prefab.cfg)
+            except NotImplementedError:
+                continue
+        try:
+            err = await self._validate(mode)
+        except NotImplementedError:
+            pass
+        else:
+            if err:
+                return err
+        for prefab in self.prefabs_tail:
+            try:
+                await self.use_validate(mode, prefab.whiteprint_cls, prefab.cfg)
+            except NotImplementedError:
+                continue
+        return None
+
+    async def _validate(self, mode: str) -> Optional[str]:  # type: ignore[override]
+        raise NotImplementedError
+
+    async def once(self, name: str, cmd: str) -> bool:  # type: ignore[override]
+        """See :meth:`Whiteprint.once`."""
+        if self.site_plan is None:
+            await self.exec(cmd)
+            return True
+        tasks = self.site_plan.tasks
+        lock = tasks.lock(name)
+        # Steps in the executor may hold the lock, so it's waited on there.
+        # The wait can't be cancelled once the executor has started it, so
+        # if the caller is cancelled instead, the lock is released as soon as
+        # it's acquired.
+        acquired = asyncio.get_running_loop().run_in_executor(None, lock.acquire)
+        try:
+            await asyncio.shield(acquired)
+        except asyncio.CancelledError:
+            acquired.add_done_callback(lambda _: lock.release())
+            raise
+        try:
+            if name in tasks.ran:
+                return False
+            await self.exec(cmd)
+            tasks.ran.add(name)
+        finally:
+            lock.release()
+        return True
+
+    async def notify(self, name: str, cmd: str) -> None:  # type: ignore[override]
+        """See :meth:`Whiteprint.notify`."""
+        if self.site_plan is None:
+            await self.exec(cmd)
+        else:
+            self.site_plan.tasks.notify(name, cmd)
+
+    async def use_execute(  # type: ignore[override]
+        self,
+        mode: str,
+        whiteprint_cls: Type[Whiteprint],
+        cfg: Optional[Config] = None,
+    ) -> None:
+        """
+        Execute another whiteprint from this whiteprint.
+        """
+        wp = self._mk_child(whiteprint_cls, cfg)
+        if isinstance(wp, AsyncWhiteprint):
+            await wp.execute(mode)
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, wp.execute, mode)
+
+    async def use_validate(  # type: ignore[override]
+        self,
+        mode: str,
+        whiteprint_cls: Type[Whiteprint],
+        cfg: Optional[Config] = None,
+    ) -> None:
+        """
+        Run validation of another whiteprint from this whiteprint.
+
+        Raises:
+            - ValidationError: If validation failed.
+        """
+        wp = self._mk_child(whiteprint_cls, cfg)
+        if isinstance(wp, AsyncWhiteprint):
+            err = await wp.validate(mode)
+        else:
+            err = await asyncio.get_running_loop().run_in_executor(
+                None, wp.validate, mode
+            )
+        if err:
+            raise ValidationError(err)
 
 
 class Prefab:
@@ -1,35 +1,74 @@
 #!/usr/bin/env python
 
+import asyncio
+import collections
+import copy
 import glob
+import hashlib
+import importlib.util
+import json
 import os
+import pickle
 from pathlib import Path
 import random
+import shutil
+import socket
 import string
 import sys
 import tempfile
+import time
+import tracemalloc
 from typing import (
     Any,
+    Callable,
     Dict,
+    List,
     Tuple,
     Type,
 )
 import textwrap
 import unittest
-from unittest.mock import patch
+from unittest.mock import call, patch
 
 from ssh2.session import Session  # pylint: disable=E0611
 
-from marchitect.prefab import Apt, Folder, LineInFile, Pip3
+from marchitect.agent import AGENT_PATH, parse_output_frame
+from marchitect.facts import FactCache, Facts, MemoryFacts
+from marchitect.fleet import Fleet
+from marchitect.journal import step_fingerprint
+from marchitect.prefab import (
+    Apt,
+    DirectoryFromPath,
+    FileFromPath,
+    FileFromString,
+    Folder,
+    LineInFile,
+    PackageConflictError,
+    Pip3,
+    merge_packages,
+)
+from marchitect.session_pool import SessionPool
+from marchitect.shell import SPOOL_ERROR_STATUS
+from marchitect.tasks import TaskRegistry
+from marchitect.template import TemplateCache
 from marchitect.site_plan import (
+    AsyncSitePlan,
     Step,
     SitePlan,
 )
-from marchitect.util import dict_deep_update
+from marchitect.util import LayeredConfig, dict_deep_update
 from marchitect.whiteprint import (
+    SFTP_NO_SUCH_FILE,
+    STDERR,
+    STDOUT,
+    AgentError,
+    AgentUnavailableError,
+    AsyncWhiteprint,
     ExecOutput,
     Prefab,
     RemoteExecError,
     RemoteFileNotFoundError,
+    RemoteSFTPError,
     RemoteTargetDirError,
     ValidationError,
     Whiteprint,
@@ -63,6 +102,18 @@ def _mk_siteplan_from_env_var_ssh_creds(sp_cls: Type[SitePlan]) -> SitePlan:
         )
 
 
+def _mk_fleet_from_env_var_ssh_creds(
+    sp_cls: Type[SitePlan], hostnames: List[str]
+) -> Fleet:
+    site_plans = []
+    for hostname in hostnames:
+        sp = _mk_siteplan_from_env_var_ssh_creds(sp_cls)
+        # Reuse the env var creds, but report the requested hostname.
+        sp.hostname = hostname
+        site_plans.append(sp)
+    return Fleet(site_plans)
+
+
 def _mk_session_from_env_var_ssh_creds() -> Session:
     return _mk_siteplan_from_env_var_ssh_creds(SitePlan).connect_func()
 
@@ -124,6 +175,19 @@ def mk_random_temp_file(size: int = 1024) -> Tuple[str, bytes]:
     return path, data
 
 
+def mock_exec(outputs: Dict[str, bytes]) -> Callable[..., ExecOutput]:
+    """
+    Returns a stand-in for Whiteprint.exec() that outputs outputs[cmd], or
+    nothing for other cmds.
+    """
+
+    def exec_(cmd: str, *args: Any, **kwargs: Any) -> ExecOutput:
+        # pylint: disable=W0613
+        return ExecOutput(0, outputs.get(cmd, b""), b"")
+
+    return exec_
+
+
 class TestBasic(unittest.TestCase):
     @staticmethod
     def glob_test_files():
@@ -156,6 +220,74 @@ class TestBasic(unittest.TestCase):
         assert a["b"]["e"] == 7
         assert a["z"] == 100
 
+    def test_layered_config(self):
+        low = {"a": 1, "b": {"c": 2, "l": [1]}, "d": 3, "z": {}}
+        high = {"a": 4, "b": {"c": 5, "e": 7}, "z": 100}
+        cfg = LayeredConfig([high, low])
+        expected = {"a": 1, "b": {"c": 2, "l": [1]}, "d": 3, "z": {}}
+        dict_deep_update(expected, {"a": 4, "b": {"c": 5, "e": 7}, "z": 100})
+        assert cfg == expected
+        assert cfg.to_dict() == expected
+        assert list(cfg) == list(expected)
+        # Nested dicts are dicts, as they would be if merged up front.
+        assert isinstance(cfg["b"], dict) and cfg["b"] is cfg["b"]
+        assert json.dumps(cfg["b"], sort_keys=True) == json.dumps(
+            expected["b"], sort_keys=True
+        )
+
+        # Writes, including in-place ones, don't touch the layers.
+        cfg["b"]["c"] = 6
+        cfg["b"]["l"].append(2)
+        cfg["new"] = {"x": 1}
+        del cfg["d"]
+        assert cfg["b"]["c"] == 6 and cfg["b"]["l"] == [1, 2]
+        assert "d" not in cfg and cfg["new"] == {"x": 1}
+        assert low == {"a": 1, "b": {"c": 2, "l": [1]}, "d": 3, "z": {}}
+        assert high == {"a": 4, "b": {"c": 5, "e": 7}, "z": 100}
+        with self.assertRaises(KeyError):
+            del cfg["d"]
+
+        # Reading a nested dict doesn't deep copy it, and neither copying
+        # what was read nor changing it changes the layers.
+        big = {"hosts": {"h%d" % i: {"ips": ["10.0.0.%d" % i]} for i in range(100)}}
+        with patch("copy.deepcopy", side_effect=copy.deepcopy) as deepcopy:
+            cfg = LayeredConfig([{}, big])
+            assert cfg["hosts"]["h7"]["ips"] == ["10.0.0.7"]
+            assert len(cfg["hosts"]) == 100
+        assert deepcopy.call_count == 1
+        for copied in (
+            dict(cfg["hosts"]),
+            {**cfg["hosts"]},
+            copy.deepcopy(cfg["hosts"]),
+            pickle.loads(pickle.dumps(cfg["hosts"])),
+        ):
+            copied["h8"]["ips"].append("x")
+        cfg["hosts"]["h9"].setdefault("ips", []).append("x")
+        cfg["hosts"].pop("h10")["ips"].append("x")
+        assert big["hosts"]["h8"] == {"ips": ["10.0.0.8"]}
+        assert big["hosts"]["h9"] == {"ips": ["10.0.0.9"]}
+        assert big["hosts"]["h10"] == {"ips": ["10.0.0.10"]}
+
+        # A shallow view replaces top-level values like dict.update().
+        shallow = LayeredConfig([high, low], deep=False)
+        assert shallow["b"] == {"c": 5, "e": 7}
+
+        # Instances of dict subclasses are merged too, except for facts,
+        # which are shared.
+        cfg = LayeredConfig(
+            [{"m": {"b": 2}}, {"m": collections.OrderedDict([("a", 1)])}]
+        )
+        assert cfg["m"] == collections.OrderedDict([("a", 1), ("b", 2)])
+        facts = Facts({"kernel": "k"}, [], lambda names: {})
+        cfg = LayeredConfig([{"_target": facts}, {"_target": {"user": "u"}}])
+        assert cfg["_target"] is facts
+
+        # Usable as a template context.
+        rendered = Whiteprint.render_template(
+            "{{ a }} {{ b.c }} {{ b.e }} {{ b|tojson }}", LayeredConfig([high, low])
+        )
+        assert rendered == '4 5 7 {"c": 5, "e": 7, "l": [1]}'
+
     def test_whiteprint_bad_cfg_schema(self):
         session = _mk_session_from_env_var_ssh_creds()
 
@@ -163,6 +295,91 @@ class TestBasic(unittest.TestCase):
             WhiteprintBadCfgSchema(session)
         assert ctx.exception.args[0] == "Missing key: 'name'"
 
+    def test_whiteprint_cfg_schema_memo(self):
+        validated: List[Any] = []
+
+        class WhiteprintCounted(Whiteprint):  # pylint: disable=W0223
+            cfg_schema = {
+                "packages": [schema.And(str, lambda p: not validated.append(p))],
+                schema.Optional("owner"): str,
+            }
+
+        session = _mk_session_from_env_var_ssh_creds()
+        target = {
+            "user": "u",
+            "host": "h",
+            "kernel": "k",
+            "distro": "d",
+            "distro_version": "v",
+            "hostname": "h",
+            "fqdn": "h",
+            "cpu_count": 1,
+        }
+        wps = [
+            WhiteprintCounted(
+                session, {"packages": ["a", "b"], "_target": dict(target, host=host)}
+            )
+            for host in ("h0", "h1", "h2")
+        ]
+        # Validated once, but each keeps its own facts.
+        assert validated == ["a", "b"]
+        assert [wp.cfg["_target"]["host"] for wp in wps] == ["h0", "h1", "h2"]
+        compile_schema = WhiteprintCounted._compiled_cfg_schema  # pylint: disable=W0212
+        assert compile_schema() is compile_schema()
+
+        # The memoized cfg is shared, but not through the whiteprints.
+        wps[0].cfg["packages"].append("c")
+        wps[0].cfg["owner"] = "root"
+        wp = WhiteprintCounted(session, {"packages": ["a", "b"]})
+        assert wp.cfg == {"packages": ["a", "b"]}
+        assert validated == ["a", "b"]
+
+        WhiteprintCounted(session, {"packages": ["a", "c"]})
+        assert validated == ["a", "b", "a", "c"]
+        for _ in range(2):
+            with self.assertRaises(schema.SchemaError):
+                WhiteprintCounted(session, {"packages": ["a", 1]})
+            with self.assertRaises(schema.SchemaError):
+                WhiteprintCounted(session, {"packages": [], "_target": {}})
+
+        # If any other key is allowed, only the declared ones are validated,
+        # so large layers of other keys aren't materialized.
+        class WhiteprintOpen(Whiteprint):  # pylint: disable=W0223
+            cfg_schema = {
+                "port": schema.Use(int),
+                schema.Optional("tls", default=False): bool,
+                str: object,
+            }
+
+        big = {"k%d" % i: {"v": [i]} for i in range(1000)}
+        site_cfg = LayeredConfig([{"port": "80", "_target": target}, big])
+        with patch.object(LayeredConfig, "to_dict", side_effect=AssertionError):
+            wp = WhiteprintOpen(session, site_cfg)
+        assert (wp.cfg["port"], wp.cfg["tls"], wp.cfg["k7"]) == (80, False, {"v": [7]})
+        assert wp.cfg["_target"]["host"] == "h" and len(wp.cfg) == 1003
+        with self.assertRaises(schema.SchemaError):
+            WhiteprintOpen(session, LayeredConfig([{"port": "x"}, big]))
+
+        class WhiteprintOther(Whiteprint):  # pylint: disable=W0223
+            cfg_schema = {"port": int, str: object}
+
+        assert WhiteprintOther(session, LayeredConfig([{"port": 1}, big])).cfg["k1"]
+        with self.assertRaises(schema.SchemaMissingKeyError):
+            WhiteprintOther(session, {"port": 1})
+
+        # If no other key is allowed, only the names of the other keys are
+        # checked.
+        class WhiteprintClosed(Whiteprint):  # pylint: disable=W0223
+            cfg_schema = {"hosts": {str: {"ips": [str]}}}
+
+        hosts = {"h%d" % i: {"ips": ["10.0.0.%d" % i]} for i in range(1000)}
+        site_cfg = LayeredConfig([{"_target": target}, {"hosts": hosts}])
+        with patch.object(LayeredConfig, "to_dict", side_effect=AssertionError):
+            wp = WhiteprintClosed(session, site_cfg)
+        assert wp.cfg["hosts"]["h7"] == {"ips": ["10.0.0.7"]}
+        with self.assertRaises(schema.SchemaWrongKeyError):
+            WhiteprintClosed(session, {"hosts": {"h": {"ips": []}}, "other": 1})
+
     def test_whiteprint_exec(self):
         wp = create_blank_whiteprint()
         res = wp.exec("ls /")
@@ -212,11 +429,329 @@ class TestBasic(unittest.TestCase):
 
         os.remove(dest_temp_path)
 
+    def test_whiteprint_exec_stream(self):
+        wp = create_blank_whiteprint()
+
+        chunks = list(wp.exec_stream("echo out && echo err 1>&2"))
+        assert b"".join(c for fd, c in chunks if fd == STDOUT) == b"out\n"
+        assert b"".join(c for fd, c in chunks if fd == STDERR) == b"err\n"
+
+        stream = wp.exec_stream("head -c 1000000 /dev/zero; exit 3", error_ok=True)
+        size = 0
+        while True:
+            try:
+                fd, chunk = next(stream)
+            except StopIteration as e:
+                assert e.value == 3
+                break
+            assert fd == STDOUT
+            size += len(chunk)
+        assert size == 1_000_000
+
+        with self.assertRaises(RemoteExecError) as ctx:
+            list(wp.exec_stream("exit 2"))
+        assert ctx.exception.exec_output.exit_status == 2
+
+    def test_whiteprint_exec_parks_on_socket(self):
+        wp = create_blank_whiteprint()
+        # While the remote command sleeps, the reactor should be parked on the
+        # socket rather than spinning on EAGAIN.
+        start = time.process_time()
+        wp.exec("sleep 1")
+        assert time.process_time() - start < 0.25
+
+    def test_whiteprint_exec_many(self):
+        wp = create_blank_whiteprint()
+
+        start = time.perf_counter()
+        res = wp.exec_many(
+            ["sleep 0.5 && echo %d" % i for i in range(16)], max_in_flight=8
+        )
+        # Two waves of 8 concurrent channels rather than 16 serial sleeps.
+        assert time.perf_counter() - start < 4
+        assert [r.stdout for r in res] == [b"%d\n" % i for i in range(16)]
+
+        res = wp.exec_many(["echo a", "echo b 1>&2 && exit 3"], error_ok=True)
+        assert res[0].stdout == b"a\n"
+        assert res[1].stderr == b"b\n"
+        assert res[1].exit_status == 3
+
+        with self.assertRaises(RemoteExecError) as ctx:
+            wp.exec_many(["true", "exit 4", "exit 5"])
+        assert ctx.exception.cmd == "exit 4"
+
+    def test_whiteprint_exec_batch(self):
+        wp = create_blank_whiteprint()
+        path = temp_file_path()
+
+        res = wp.exec_batch(
+            [
+                "echo a",
+                "printf b && echo c 1>&2 && exit 3",
+                "cd / && pwd",
+                "pwd && cat",
+                "echo 'unterminated",
+            ],
+            error_ok=True,
+        )
+        assert [r.exit_status for r in res] == [0, 3, 0, 0, 2]
+        assert res[0].stdout == b"a\n"
+        assert res[1].stdout == b"b"
+        assert res[1].stderr == b"c\n"
+        # Each command gets its own shell and no stdin.
+        assert res[2].stdout == b"/\n"
+        assert res[3].stdout == wp.exec("pwd").stdout
+        assert res[4].stderr
+
+        with self.assertRaises(RemoteExecError) as ctx:
+            wp.exec_batch(["true", "exit 4", "touch {}".format(path)])
+        assert ctx.exception.cmd == "exit 4"
+        assert ctx.exception.exec_output.exit_status == 4
+        assert not os.path.exists(path)
+
+        assert wp.exec_batch([]) == []
+
+    def test_whiteprint_persistent_shell(self):
+        wp = create_blank_whiteprint()
+        wp.persistent_shell = True
+
+        # $$ is the pid of the shell that runs the commands.
+        shell_pid = wp.exec("echo $$").stdout
+        assert wp.exec("echo $$").stdout == shell_pid
+        res = wp.exec("printf a && echo b 1>&2 && exit 3", error_ok=True)
+        assert res.exit_status == 3
+        assert res.stdout == b"a"
+        assert res.stderr == b"b\n"
+        with self.assertRaises(RemoteExecError) as ctx:
+            wp.exec("exit 4")
+        assert ctx.exception.exec_output.exit_status == 4
+        # Commands can't affect the ones that follow.
+        home = wp.exec("pwd").stdout
+        wp.exec("cd / && x=1")
+        assert wp.exec("pwd && echo ${x:-unset}").stdout == home + b"unset\n"
+        assert wp.exec("cat").stdout == b""
+        assert wp.exec("cat", stdin=b"hello").stdout == b"hello"
+
+        # A command whose output can't be spooled (here because it removes
+        # the spool) fails rather than leaving exec() waiting for its reply,
+        # and the shell makes a new spool for the next one.
+        res = wp.exec(
+            'echo a && rm -rf "${TMPDIR:-/tmp}"/marchitect-shell.*', error_ok=True
+        )
+        assert res.exit_status == SPOOL_ERROR_STATUS
+        assert b"could not be spooled" in res.stderr
+        assert wp.exec("echo $$ && echo b").stdout == shell_pid + b"b\n"
+
+        # A shell that exits is replaced.
+        res = wp.exec("kill $$", error_ok=True)
+        assert res.exit_status != 0
+        assert wp.exec("echo $$").stdout != shell_pid
+
+        wp.persistent_shell = False
+        assert wp.exec("echo $$").stdout != wp.exec("echo $$").stdout
+
+        # Site plans can enable it for all of their whiteprints, and exit the
+        # shell when done.
+        shell_pids = []
+
+        class WhiteprintPids(Whiteprint):
+            def _execute(self, mode: str):
+                shell_pids.append(self.exec("echo $$").stdout.strip())
+                shell_pids.append(self.exec("echo $$").stdout.strip())
+
+            def _validate(self, mode: str):
+                return None
+
+        class SitePlanShell(SitePlan):
+            plan = [Step(WhiteprintPids)]
+            persistent_shell = True
+
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanShell)
+        sp.target_host_cfg = {}
+        sp.install()
+        assert shell_pids[0] == shell_pids[1]
+        res = wp.exec("kill -0 {}".format(shell_pids[0].decode()), error_ok=True)
+        assert res.exit_status != 0
+
+    def test_whiteprint_agent(self):
+        wp = create_blank_whiteprint()
+        wp.exec("rm -f ~/{}".format(AGENT_PATH))
+        dir_path = temp_file_path()
+        file_path = temp_file_path()
+        missing_path = temp_file_path()
+        os.mkdir(dir_path, 0o750)
+        with open(file_path, "wb") as f:
+            f.write(b"hello")
+        paths = [dir_path, file_path, missing_path]
+        try:
+            shell_stats = wp.stat_many(paths, digest=True)
+            shell_packages = Apt(wp.session, {"packages": []}).installed_packages()
+
+            wp.use_agent = True
+            # The agent is uploaded on first use, and cached.
+            assert wp.agent_call("hash", paths=[file_path]) == {
+                file_path: hashlib.sha256(b"hello").hexdigest()
+            }
+            assert wp.exec("test -f ~/{}".format(AGENT_PATH)).exit_status == 0
+            agent_stats = wp.stat_many(paths, digest=True)
+            assert repr(agent_stats) == repr(shell_stats)
+            apt = Apt(wp.session, {"packages": []}, reactor=wp.reactor)
+            apt.use_agent = True
+            assert apt.installed_packages() == shell_packages
+
+            res = wp.exec("printf a && echo b 1>&2 && exit 3", error_ok=True)
+            assert (res.exit_status, res.stdout, res.stderr) == (3, b"a", b"b\n")
+            with self.assertRaises(RemoteExecError):
+                wp.exec("exit 4")
+            assert wp.exec("cat").stdout == b""
+            # Large output is streamed in chunks rather than in one response.
+            with patch(
+                "marchitect.whiteprint.parse_output_frame",
+                side_effect=parse_output_frame,
+            ) as frames:
+                res = wp.exec("head -c 300000 /dev/zero && echo done 1>&2")
+            assert (res.stdout, res.stderr) == (b"\0" * 300000, b"done\n")
+            assert frames.call_count > 5
+            with self.assertRaises(AgentError):
+                wp.agent_call("read", path=dir_path)
+        finally:
+            os.remove(file_path)
+            os.rmdir(dir_path)
+
+        # Without the agent, the shell is used instead.
+        with patch("marchitect.whiteprint.agent_start_cmd", return_value="exit 127"):
+            wp = create_blank_whiteprint()
+            wp.use_agent = True
+            assert wp.exec("echo $$").stdout != wp.exec("echo $$").stdout
+            assert wp.stat_many([missing_path]) == {missing_path: None}
+            assert wp.reactor.agent_unavailable
+            with self.assertRaises(AgentUnavailableError):
+                wp.agent_call("hash", paths=[])
+
+        folder_path = temp_file_path()
+
+        class WhiteprintFolder(Whiteprint):
+            prefabs_head = [Prefab(Folder, {"path": folder_path, "mode": 0o700})]
+
+            def _execute(self, mode: str):
+                pass
+
+            def _validate(self, mode: str):
+                return None
+
+        class SitePlanAgent(SitePlan):
+            plan = [Step(WhiteprintFolder)]
+            use_agent = True
+
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanAgent)
+        sp.target_host_cfg = {}
+        sp.install()
+        assert os.stat(folder_path).st_mode & 0o777 == 0o700
+        assert sp.validate("install") is None
+        sp.clean()
+        assert not os.path.exists(folder_path)
+        wp.exec("rm -f ~/{}".format(AGENT_PATH))
+
+    def test_whiteprint_stat_many(self):
+        wp = create_blank_whiteprint()
+        dir_path = temp_file_path()
+        file_path = temp_file_path()
+        link_path = temp_file_path()
+        missing_path = temp_file_path()
+        os.mkdir(dir_path, 0o750)
+        with open(file_path, "wb") as f:
+            f.write(b"hello")
+        os.symlink(file_path, link_path)
+        try:
+            stats = wp.stat_many([dir_path, file_path, link_path, missing_path])
+            assert list(stats) == [dir_path, file_path, link_path, missing_path]
+            assert stats[dir_path].is_dir
+            assert stats[dir_path].mode == 0o750
+            assert stats[file_path].is_file
+            assert stats[file_path].size == 5
+            assert stats[file_path].sha256 is None
+            assert stats[link_path].is_symlink
+            assert stats[missing_path] is None
+
+            stats = wp.stat_many([file_path, dir_path], digest=True)
+            assert stats[file_path].sha256 == hashlib.sha256(b"hello").hexdigest()
+            assert stats[dir_path].sha256 is None
+
+            # Records don't end at a newline, so a path may have one.
+            odd_path = dir_path + "/a\n-\nb\u2028c"
+            with open(odd_path, "wb") as f:
+                f.write(b"hi")
+            stats = wp.stat_many([odd_path, missing_path, file_path], digest=True)
+            assert stats[odd_path].sha256 == hashlib.sha256(b"hi").hexdigest()
+            assert stats[missing_path] is None
+            assert stats[file_path].size == 5
+            os.remove(odd_path)
+        finally:
+            os.remove(link_path)
+            os.remove(file_path)
+            os.rmdir(dir_path)
+
+        # A site plan stats every path it validates with one command.
+        paths = [temp_file_path() for _ in range(3)]
+
+        class WhiteprintFolders(Whiteprint):
+            prefabs_head = [Prefab(Folder, {"path": path}) for path in paths]
+
+            def _execute(self, mode: str):
+                pass
+
+            def _validate(self, mode: str):
+                return None
+
+        class SitePlanFolders(SitePlan):
+            plan = [Step(WhiteprintFolders)]
+
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanFolders)
+        sp.target_host_cfg = {}
+        sp.execute("install")
+        try:
+            exec_orig = Whiteprint.exec
+            with patch.object(
+                Whiteprint, "exec", autospec=True, side_effect=exec_orig
+            ) as exec_mock:
+                assert sp.validate("install") is None
+            assert exec_mock.call_count == 1
+            os.rmdir(paths[1])
+            assert sp.validate("install") == "'{}' does not exist.".format(paths[1])
+        finally:
+            sp.execute("clean")
+        assert not any(os.path.exists(path) for path in paths)
+
     def test_whiteprint_stdin(self):
         wp = create_blank_whiteprint()
         res = wp.exec("cat", stdin=b"test")
         assert res.stdout == b"test"
 
+        # Much larger than the channel window
+        src_temp_path, data = mk_random_temp_file(10_000_000)
+        res = wp.exec("cat", stdin=data)
+        assert res.stdout == data
+        res = wp.exec("sha256sum", stdin=Path(src_temp_path))
+        assert res.stdout.split()[0].decode("ascii") == hashlib.sha256(data).hexdigest()
+        with open(src_temp_path, "rb") as f:
+            res = wp.exec("wc -c", stdin=f)
+        assert res.stdout.strip() == b"10000000"
+        chunks = (data[i : i + 100_000] for i in range(0, len(data), 100_000))
+        res = wp.exec("wc -c", stdin=chunks)
+        assert res.stdout.strip() == b"10000000"
+        os.remove(src_temp_path)
+
+        # The process fills its stderr pipe before reading any input, and
+        # echoes its input back, so neither side makes progress unless input
+        # is written while output is read.
+        res = wp.exec("head -c 5000000 /dev/zero >&2; cat", stdin=data)
+        assert len(res.stderr) == 5_000_000
+        assert res.stdout == data
+
+        # The process exits without reading all of its input.
+        res = wp.exec("head -c 10", stdin=iter([data] * 10))
+        assert res.stdout == data[:10]
+
     def test_whiteprint_scp(self):
         wp = create_blank_whiteprint()
 
@@ -239,6 +774,59 @@ class TestBasic(unittest.TestCase):
         os.remove(dest_temp_path)
         os.remove(round_trip_path)
 
+    def test_whiteprint_sftp(self):
+        wp = create_blank_whiteprint()
+
+        # Several files over the same SFTP channel, some concurrently.
+        src_temp_path, data = mk_random_temp_file(5_000_000)
+        os.utime(src_temp_path, (1_000_000, 1_000_000))
+        dest_temp_paths = [temp_file_path() for _ in range(3)]
+
+        async def sftp_up_many():
+            async_wp = AsyncWhiteprint(_mk_session_from_env_var_ssh_creds())
+            await asyncio.gather(
+                *[
+                    async_wp.sftp_up(src_temp_path, dest_temp_path, 0o640)
+                    for dest_temp_path in dest_temp_paths
+                ]
+            )
+
+        asyncio.run(sftp_up_many())
+        for dest_temp_path in dest_temp_paths:
+            attrs = wp.sftp_stat(dest_temp_path)
+            assert attrs.filesize == 5_000_000
+            assert attrs.permissions & 0o777 == 0o640
+            assert attrs.mtime == 1_000_000
+            round_trip_path = temp_file_path()
+            wp.sftp_down(dest_temp_path, round_trip_path)
+            with open(round_trip_path, "rb") as f:
+                assert f.read() == data
+            os.remove(round_trip_path)
+            os.remove(dest_temp_path)
+
+        # Real error codes
+        with self.assertRaises(RemoteFileNotFoundError):
+            wp.sftp_stat("/does-not-exist")
+        round_trip_path = temp_file_path()
+        with self.assertRaises(RemoteFileNotFoundError):
+            wp.sftp_down("/does-not-exist", round_trip_path)
+        os.remove(round_trip_path)
+        with self.assertRaises(RemoteTargetDirError):
+            wp.sftp_up(src_temp_path, "/does-not-exist/file-path")
+        with self.assertRaises(RemoteSFTPError) as ctx:
+            wp.sftp_up(src_temp_path, "/proc/version")
+        assert ctx.exception.code not in (0, SFTP_NO_SUCH_FILE)
+        os.remove(src_temp_path)
+
+        # As the default transport
+        wp.transport = "sftp"
+        dest_temp_path = temp_file_path()
+        wp.scp_up_from_bytes(b"", dest_temp_path)
+        assert wp.scp_down_to_bytes(dest_temp_path) == b""
+        wp.scp_up_template_from_str("{{ x }}", dest_temp_path, cfg_override={"x": 1})
+        assert wp.scp_down_to_bytes(dest_temp_path) == b"1"
+        os.remove(dest_temp_path)
+
     def test_whiteprint_scp_bytes(self):
         wp = create_blank_whiteprint()
 
@@ -324,6 +912,26 @@ class TestBasic(unittest.TestCase):
         os.remove(src_temp_path)
         os.remove(dest_temp_path)
 
+    def test_whiteprint_scp_template_large(self):
+        wp = create_blank_whiteprint()
+        dest_temp_path = temp_file_path()
+        # Renders to ~6.9 MB, well past the in-memory spool size.
+        template = "{% for i in range(n) %}line {{ i }}\n{% endfor %}"
+        tracemalloc.start()
+        try:
+            wp.scp_up_template_from_str(
+                template, dest_temp_path, cfg_override={"n": 500_000}
+            )
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        with open(dest_temp_path, "rb") as f:
+            lines = f.read().splitlines()
+        assert len(lines) == 500_000
+        assert lines[-1] == b"line 499999"
+        assert peak < 3_000_000, peak
+        os.remove(dest_temp_path)
+
     def test_whiteprint_rsrc_lookup(self):
         session = _mk_session_from_env_var_ssh_creds()
         wp = Whiteprint(session, rsrc_path=Path(tempfile.tempdir))
@@ -396,6 +1004,476 @@ class TestBasic(unittest.TestCase):
 
         sp.clean()
 
+    def test_siteplan_facts(self):
+        class WhiteprintFacts(Whiteprint):
+            facts = ["memory"]
+
+            def _execute(self, mode: str):
+                target = self.cfg["_target"]
+                assert target["memory"]["total_kb"] > 0
+                assert "arch" not in target.keys()
+                # Facts that weren't declared are gathered on first use.
+                assert self.render_template("{{ _target.arch }}", self.cfg)
+                assert "arch" in target.keys()
+
+            def _validate(self, mode: str):
+                return None
+
+        class SitePlanFacts(SitePlan):
+            plan = [
+                Step(WhiteprintFacts),
+            ]
+
+        cmds: List[str] = []
+        real_exec = Whiteprint._exec_collect_op  # pylint: disable=W0212
+
+        def recording_exec(self, cmd, *args, **kwargs):
+            cmds.append(cmd)
+            return real_exec(self, cmd, *args, **kwargs)
+
+        cache_dir = Path(tempfile.mkdtemp(prefix="architect_test_"))
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanFacts)
+        sp.fact_cache = FactCache(cache_dir)
+        with patch.object(Whiteprint, "_exec_collect_op", recording_exec):
+            sp.install()
+            # Base and declared facts in one command, arch in another.
+            assert len(cmds) == 2
+            assert "uname -r" in cmds[0] and "meminfo" in cmds[0]
+            assert "uname -m" in cmds[1]
+            sp.install()
+            assert len(cmds) == 2
+        (cache_file,) = cache_dir.iterdir()
+        assert cache_file.name == "{}@{}.json".format(sp.user, sp.hostname)
+
+        # Templates that async whiteprints upload gather facts over their own
+        # session, without blocking the event loop.
+        dest_path = temp_file_path()
+
+        class AsyncWhiteprintFacts(AsyncWhiteprint):
+            async def _execute(self, mode: str):
+                await self.scp_up_template_from_str(
+                    "{{ _target.disks|length }}", dest_path
+                )
+
+            async def _validate(self, mode: str):
+                return None
+
+        class AsyncSitePlanFacts(AsyncSitePlan):
+            plan = [Step(AsyncWhiteprintFacts)]
+
+        asp = _mk_siteplan_from_env_var_ssh_creds(AsyncSitePlanFacts)
+        asp.fact_cache = FactCache()
+        blocking: List[List[str]] = []
+        real_gather = SitePlan._gather_facts  # pylint: disable=W0212
+
+        def recording_gather(self, session, reactor, names):
+            blocking.append(list(names))
+            return real_gather(self, session, reactor, names)
+
+        with patch.object(SitePlan, "_gather_facts", recording_gather):
+            asyncio.run(asp.install())
+        # Only the facts gathered up front were gathered in a blocking way.
+        assert blocking == [["base"]]
+        with open(dest_path, encoding="utf-8") as f:
+            assert int(f.read()) > 0
+        os.remove(dest_path)
+
+        # A new cache reads facts from disk, and gathers those that have
+        # expired or whose provider has changed.
+        sp.fact_cache = FactCache(cache_dir)
+        cmds.clear()
+        with patch.object(Whiteprint, "_exec_collect_op", recording_exec):
+            facts = sp.gather_facts(["memory"])
+            assert not cmds
+            assert isinstance(facts, dict) and facts["cpu_count"] > 0
+            sp.fact_cache = FactCache(cache_dir, ttl=0)
+            sp.gather_facts([])
+            assert len(cmds) == 1
+            sp.fact_cache = FactCache(cache_dir)
+            with patch.object(MemoryFacts, "version", 2):
+                sp.gather_facts(["memory"])
+            assert "meminfo" in cmds[1] and "uname -r" not in cmds[1]
+
+        # Fleets gather from every host at once.
+        fleet = _mk_fleet_from_env_var_ssh_creds(SitePlanFacts, ["h0", "h1"])
+        results = fleet.gather_facts(["packages"])
+        assert all(r.ok for r in results)
+        for sp in fleet.site_plans:
+            assert "packages" in sp.fact_cache.get(
+                "{}@{}".format(sp.user, sp.hostname), sp.fact_providers
+            )
+        shutil.rmtree(cache_dir)
+
+    def test_siteplan_journal(self):
+        executed: List[Tuple[str, str]] = []
+
+        class WhiteprintRecord(Whiteprint):
+            def _execute(self, mode: str):
+                executed.append((self.cfg["name"], mode))
+
+            def _validate(self, mode: str):
+                return None
+
+        journal_path = temp_file_path()
+
+        class SitePlanJournal(SitePlan):
+            plan = [
+                Step(WhiteprintRecord, {"name": "a"}),
+                Step(WhiteprintRecord, {"name": "b"}),
+            ]
+
+        SitePlanJournal.journal_path = journal_path
+        SitePlanJournal.skip_unchanged_steps = True
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanJournal)
+        sp.target_host_cfg = {}
+        sp.install()
+        assert executed == [("a", "install"), ("b", "install")]
+
+        # Unchanged steps are skipped.
+        del executed[:]
+        sp.install()
+        assert not executed
+        assert sp.stats["steps_skipped"] == 2
+
+        # Only the changed step runs.
+        sp.plan[1].cfg["name"] = "c"
+        sp.install()
+        assert executed == [("c", "install")]
+
+        # Unless forced.
+        del executed[:]
+        sp.install(force=True)
+        assert executed == [("a", "install"), ("c", "install")]
+
+        # Other modes aren't skipped, and invalidate install.
+        del executed[:]
+        sp.clean()
+        sp.clean()
+        sp.install()
+        assert executed == [("a", "clean"), ("c", "clean")] * 2 + [
+            ("a", "install"),
+            ("c", "install"),
+        ]
+
+        wp = create_blank_whiteprint()
+        journal = json.loads(wp.scp_down_to_bytes(journal_path))
+        steps = journal["site_plans"]["SitePlanJournal"]["steps"]
+        assert list(steps) == ["WhiteprintRecord", "WhiteprintRecord#2"]
+        assert list(steps["WhiteprintRecord"]) == ["install"]
+
+        # Without skipping, the journal isn't read or written.
+        SitePlanJournal.skip_unchanged_steps = False
+        os.remove(journal_path)
+        del executed[:]
+        sp.install()
+        assert len(executed) == 2
+        assert not os.path.exists(journal_path)
+
+        # Fingerprints cover the whiteprint's resources.
+        rsrc_dir = Path(tempfile.mkdtemp(prefix="architect_test_"))
+        wp = WhiteprintRecord(wp.session, {"name": "a"}, rsrc_dir)
+        fingerprint = step_fingerprint(wp)
+        assert step_fingerprint(wp) == fingerprint
+        (rsrc_dir / "app.conf").write_text("x")
+        assert step_fingerprint(wp) != fingerprint
+        shutil.rmtree(rsrc_dir)
+
+        # And the resources its prefabs read, wherever they are, and the
+        # templates that those include from other resource folders.
+        rsrc_root = Path(tempfile.mkdtemp(prefix="architect_test_"))
+        (rsrc_root / "wp").mkdir()
+        (rsrc_root / "common").mkdir()
+        (rsrc_root / "common" / "inc.conf").write_text("a")
+        src_path = rsrc_root / "app.conf"
+        src_path.write_text('{% include "common/inc.conf" %}')
+        tree_path = rsrc_root / "tree"
+        tree_path.mkdir()
+
+        class WhiteprintPrefabs(WhiteprintRecord):
+            prefabs_head = [
+                Prefab(FileFromPath, {"src_path": str(src_path), "dest_path": "/x"}),
+                Prefab(
+                    DirectoryFromPath,
+                    {"src_path": str(tree_path), "dest_path": "/y"},
+                ),
+            ]
+
+        wp = WhiteprintPrefabs(
+            wp.session,
+            {"name": "a"},
+            rsrc_root / "wp",
+            template_cache=TemplateCache([rsrc_root]),
+        )
+        fingerprints = {step_fingerprint(wp)}
+        (rsrc_root / "common" / "inc.conf").write_text("b")
+        fingerprints.add(step_fingerprint(wp))
+        (tree_path / "f").write_text("c")
+        fingerprints.add(step_fingerprint(wp))
+        src_path.write_text("d")
+        fingerprints.add(step_fingerprint(wp))
+        assert len(fingerprints) == 4 and None not in fingerprints
+        # Unless a template includes another by an expression.
+        src_path.write_text("{% include name %}")
+        assert step_fingerprint(wp) is None
+        shutil.rmtree(rsrc_root)
+
+        # Only the facts that don't change from run to run are fingerprinted,
+        # so the step is still skipped when others (e.g. free memory) change.
+        SitePlanJournal.skip_unchanged_steps = True
+        sp.target_host_cfg = {"distro": "debian", "memory": {"available_kb": 1}}
+        sp.install()
+        del executed[:]
+        sp.target_host_cfg["memory"]["available_kb"] = 2
+        sp.install()
+        assert not executed
+        sp.target_host_cfg["distro"] = "ubuntu"
+        sp.install()
+        assert len(executed) == 2
+
+        # Editing a class that a whiteprint inherits from reruns its step.
+        module_dir = tempfile.mkdtemp(prefix="architect_test_")
+        module_path = os.path.join(module_dir, "journal_base.py")
+        base_source = textwrap.dedent(
+            """\
+            from marchitect.whiteprint import Whiteprint
+
+            class WhiteprintBase(Whiteprint):
+                def _validate(self, mode):
+                    return None
+            """
+        )
+        with open(module_path, "w", encoding="utf-8") as f:
+            f.write(base_source)
+        spec = importlib.util.spec_from_file_location("journal_base", module_path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["journal_base"] = module
+        spec.loader.exec_module(module)
+
+        class WhiteprintDerived(module.WhiteprintBase):
+            def _execute(self, mode: str):
+                executed.append((self.cfg["name"], mode))
+
+        sp.plan = [Step(WhiteprintDerived, {"name": "d"})]
+        sp.install()
+        del executed[:]
+        sp.install()
+        assert not executed
+        with open(module_path, "w", encoding="utf-8") as f:
+            f.write(base_source.replace("return None", "return None  # changed"))
+        sp.install()
+        assert executed == [("d", "install")]
+        del sys.modules["journal_base"]
+        shutil.rmtree(module_dir)
+
+        # A step that runs other whiteprints than its prefabs is never
+        # skipped, since what they do isn't known until they run.
+        class WhiteprintPrefab(WhiteprintRecord):
+            prefabs_head = [Prefab(WhiteprintRecord, {"name": "p"})]
+
+        class WhiteprintDelegate(WhiteprintPrefab):
+            def _execute(self, mode: str):
+                self.use_execute(mode, WhiteprintRecord, {"name": "u"})
+
+        del executed[:]
+        wp = WhiteprintPrefab(wp.session, {"name": "a"})
+        wp.execute("install")
+        assert executed == [("p", "install"), ("a", "install")]
+        assert not wp.delegated
+        sp.plan = [Step(WhiteprintDelegate, {"name": "e"})]
+        del executed[:]
+        sp.install()
+        sp.install()
+        assert executed == [("p", "install"), ("u", "install")] * 2
+
+        # Nor is a step whose config has objects without a deterministic repr.
+        wp = WhiteprintRecord(wp.session, {"name": "a", "x": object()})
+        assert step_fingerprint(wp) is None
+        os.remove(journal_path)
+
+    def test_siteplan_step_dependencies(self):
+        events: List[Tuple[str, str]] = []
+
+        class WhiteprintSleep(Whiteprint):
+            def _execute(self, mode: str):
+                events.append(("start", self.cfg["name"]))
+                self.exec("sleep 0.3")
+                events.append(("end", self.cfg["name"]))
+
+            def _validate(self, mode: str):
+                return None
+
+        class AsyncWhiteprintSleep(AsyncWhiteprint):
+            async def _execute(self, mode: str):
+                events.append(("start", self.cfg["name"]))
+                await self.exec("sleep 0.3")
+                events.append(("end", self.cfg["name"]))
+
+            async def _validate(self, mode: str):
+                return None
+
+        def mk_plan(wp_cls: Type[Whiteprint]) -> List[Step]:
+            return [
+                Step(wp_cls, {"name": "c"}, alias="c", depends_on=["a", "b"]),
+                Step(wp_cls, {"name": "a"}, alias="a", depends_on=[]),
+                Step(wp_cls, {"name": "b"}, alias="b", depends_on=[]),
+                Step(wp_cls, {"name": "d"}, depends_on=["c"]),
+            ]
+
+        class SitePlanDeps(SitePlan):
+            plan = mk_plan(WhiteprintSleep)
+
+        class AsyncSitePlanDeps(AsyncSitePlan):
+            plan = mk_plan(AsyncWhiteprintSleep)
+            max_parallel_steps = 4
+
+        # Sequential by default, but dependencies come first.
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanDeps)
+        sp.target_host_cfg = {}
+        sp.install()
+        assert [name for event, name in events if event == "start"] == [
+            "a",
+            "b",
+            "c",
+            "d",
+        ]
+        assert all(events[i][0] == "start" for i in range(0, len(events), 2))
+
+        # a and b are independent, so they overlap. c waits for both, and d
+        # for c.
+        for plan in (sp, _mk_siteplan_from_env_var_ssh_creds(AsyncSitePlanDeps)):
+            del events[:]
+            plan.max_parallel_steps = 4
+            plan.target_host_cfg = {}
+            if isinstance(plan, AsyncSitePlan):
+                asyncio.run(plan.install())
+            else:
+                plan.install()
+            assert {name for _, name in events[:2]} == {"a", "b"}
+            assert events[2][0] == "end" and events[3][0] == "end"
+            assert events[4:] == [
+                ("start", "c"),
+                ("end", "c"),
+                ("start", "d"),
+                ("end", "d"),
+            ]
+
+        # A failed step stops the steps that depend on it.
+        class WhiteprintFail(Whiteprint):
+            def _execute(self, mode: str):
+                self.exec("false")
+
+            def _validate(self, mode: str):
+                return None
+
+        sp.plan = [Step(WhiteprintFail, depends_on=[])] + mk_plan(WhiteprintSleep)
+        sp.plan[1].depends_on = ["a", "b", WhiteprintFail]
+        del events[:]
+        with self.assertRaises(RemoteExecError):
+            sp.install()
+        assert {name for _, name in events} == {"a", "b"}
+
+        sp.plan = [Step(WhiteprintSleep, depends_on=["missing"])]
+        with self.assertRaisesRegex(ValueError, "Unknown dependency"):
+            sp.install()
+        sp.plan = [
+            Step(WhiteprintSleep, alias="x", depends_on=["y"]),
+            Step(WhiteprintSleep, alias="y", depends_on=["x"]),
+        ]
+        with self.assertRaisesRegex(ValueError, "Circular dependencies"):
+            sp.install()
+
+    def test_siteplan_tasks(self):
+        path = temp_file_path()
+
+        class WhiteprintTasks(Whiteprint):
+            def _execute(self, mode: str):
+                self.once("reload", "echo reload >> %s" % path)
+                self.notify("restart", "echo restart >> %s" % path)
+                self.exec("echo %s >> %s" % (self.cfg["name"], path))
+
+            def _validate(self, mode: str):
+                return None
+
+        class AsyncWhiteprintTasks(AsyncWhiteprint):
+            async def _execute(self, mode: str):
+                assert not await self.once("reload", "echo reload >> %s" % path)
+                await self.notify("restart", "echo restart >> %s" % path)
+                await self.exec("echo %s >> %s" % (self.cfg["name"], path))
+
+            async def _validate(self, mode: str):
+                return None
+
+        class SitePlanTasks(AsyncSitePlan):
+            plan = [
+                Step(WhiteprintTasks, {"name": "a"}),
+                Step(AsyncWhiteprintTasks, {"name": "b"}),
+                Step(WhiteprintTasks, {"name": "c"}, depends_on=["x"]),
+                Step(WhiteprintTasks, {"name": "d"}, alias="x", depends_on=[]),
+            ]
+
+        def read_lines() -> List[str]:
+            with open(path, encoding="utf8") as f:
+                return f.read().split()
+
+        # Once per run, notified tasks at the end of the run.
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanTasks)
+        sp.target_host_cfg = {}
+        for _ in range(2):
+            asyncio.run(sp.install())
+            assert read_lines() == ["reload", "a", "b", "d", "c", "restart"]
+            os.remove(path)
+
+        # Parallel steps wait for a once task that's running.
+        sp.max_parallel_steps = 4
+        asyncio.run(sp.install())
+        lines = read_lines()
+        assert lines[0] == "reload" and lines[-1] == "restart"
+        assert sorted(lines[1:-1]) == ["a", "b", "c", "d"]
+        os.remove(path)
+
+        # Notified tasks don't run if a step fails.
+        class WhiteprintFail(Whiteprint):
+            def _execute(self, mode: str):
+                self.exec("false")
+
+            def _validate(self, mode: str):
+                return None
+
+        sp.max_parallel_steps = 1
+        sp.plan = sp.plan[:2] + [Step(WhiteprintFail)]
+        with self.assertRaises(RemoteExecError):
+            asyncio.run(sp.install())
+        assert read_lines() == ["reload", "a", "b"]
+        os.remove(path)
+
+        # A once task that's cancelled while it waits doesn't keep the lock.
+        async def cancel_once() -> None:
+            wp = AsyncWhiteprintTasks(
+                _mk_session_from_env_var_ssh_creds(), {"name": "e"}, site_plan=sp
+            )
+            lock = sp.tasks.lock("reload")
+            lock.acquire()
+            task = asyncio.ensure_future(wp.once("reload", "true"))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            lock.release()
+            await asyncio.sleep(0.1)
+            assert lock.acquire(timeout=1)
+            lock.release()
+            assert await asyncio.wait_for(wp.once("reload", "true"), 10)
+
+        sp.tasks = TaskRegistry()
+        asyncio.run(cancel_once())
+
+        # Without a site plan, tasks run right away, every time.
+        wp = WhiteprintTasks(_mk_session_from_env_var_ssh_creds(), {"name": "e"})
+        wp.execute("install")
+        wp.execute("install")
+        assert read_lines() == ["reload", "restart", "e"] * 2
+        os.remove(path)
+
     def test_whiteprint_validation_error(self):
         class WhiteprintInvalid(Whiteprint):
             def _execute(self, mode: str):
@@ -446,42 +1524,73 @@ class TestBasic(unittest.TestCase):
                 Step(WhiteprintPrefab),
             ]
 
+        install_cmd = "DEBIAN_FRONTEND=noninteractive apt install -y "
+
         # Test installation
-        res = ExecOutput(0, b"", b"")
-        with patch.object(Whiteprint, "exec", return_value=res) as mock_method:
+        exec_ = mock_exec({Apt.state_cmd: b"ii \tcurl\t7.58.0-2\n"})
+        with patch.object(Whiteprint, "exec", side_effect=exec_) as mock_method:
             sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanSimple)
             sp.target_host_cfg = {}
             assert sp.install() is None
-            mock_method.assert_called_once_with(
-                "DEBIAN_FRONTEND=noninteractive apt install -y python3 python3-dev"
-            )
+            assert mock_method.call_args_list == [
+                call(Apt.state_cmd),
+                call(install_cmd + "python3 python3-dev"),
+            ]
+
+        # Test installation of missing packages only
+        stdout = textwrap.dedent(
+            """\
+            ii \tpython3\t3.6.7-1~18.04
+            rc \tpython3-dev\t3.6.7-1~18.04
+            """
+        ).encode("utf-8")
+        exec_ = mock_exec({Apt.state_cmd: stdout})
+        with patch.object(Whiteprint, "exec", side_effect=exec_) as mock_method:
+            sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanSimple)
+            sp.target_host_cfg = {}
+            sp.install()
+            assert mock_method.call_args_list == [
+                call(Apt.state_cmd),
+                call(install_cmd + "python3-dev"),
+            ]
 
         # Test correct installation
         stdout = textwrap.dedent(
             """\
-            python3/bionic-updates 3.6.7-1~18.04 amd64 [upgradable from: 3.6.5-3ubuntu1]
-            python3-dev/bionic-updates 3.6.7-1~18.04 amd64 [upgradable from: 3.6.5-3ubuntu1]
+            ii \tpython3\t3.6.7-1~18.04
+            ii \tpython3-dev\t3.6.7-1~18.04
             """
         ).encode("utf-8")
-        res = ExecOutput(0, stdout, b"")
-        with patch.object(Whiteprint, "exec", return_value=res) as mock_method:
+        exec_ = mock_exec({Apt.state_cmd: stdout})
+        with patch.object(Whiteprint, "exec", side_effect=exec_) as mock_method:
             sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanSimple)
             sp.target_host_cfg = {}
             assert sp.validate("install") is None
-            mock_method.assert_called_once_with("apt -qq list python3 python3-dev")
+            # Nothing to install
+            sp.install()
+            assert mock_method.call_args_list == [call(Apt.state_cmd)] * 2
 
         # Try bad installation
         stdout = textwrap.dedent(
             """\
-            python3/bionic-updates 3.6.7-1~18.04 amd64 [upgradable from: 3.6.5-3ubuntu1]
+            ii \tpython3\t3.6.7-1~18.04
             """
         ).encode("utf-8")
-        res = ExecOutput(0, stdout, b"")
-        with patch.object(Whiteprint, "exec", return_value=res) as mock_method:
+        exec_ = mock_exec({Apt.state_cmd: stdout})
+        with patch.object(Whiteprint, "exec", side_effect=exec_) as mock_method:
             sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanSimple)
             sp.target_host_cfg = {}
             assert sp.validate("install") == "Apt package 'python3-dev' missing."
-            mock_method.assert_called_once_with("apt -qq list python3 python3-dev")
+            mock_method.assert_called_once_with(Apt.state_cmd)
+
+            WhiteprintPrefab.prefabs_head[0].cfg["packages"] = ["python3=3.6.5"]
+            assert sp.validate("install") == (
+                "Apt package 'python3' wrong version: '3.6.5' != '3.6.7-1~18.04'"
+            )
+            WhiteprintPrefab.prefabs_head[0].cfg["packages"] = [
+                "python3",
+                "python3-dev",
+            ]
 
     def test_prefab_pip3(self):
         class WhiteprintPrefab(Whiteprint):
@@ -501,43 +1610,127 @@ class TestBasic(unittest.TestCase):
             ]
 
         # Test installation
-        res = ExecOutput(0, b"", b"")
-        with patch.object(Whiteprint, "exec", return_value=res) as mock_method:
+        exec_ = mock_exec({Pip3.state_cmd: b"[]"})
+        with patch.object(Whiteprint, "exec", side_effect=exec_) as mock_method:
             sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanSimple)
             sp.target_host_cfg = {}
             assert sp.install() is None
-            mock_method.assert_called_once_with("pip3 install stone marchitect")
+            assert mock_method.call_args_list == [
+                call(Pip3.state_cmd),
+                call("pip3 install stone marchitect"),
+            ]
 
         # Test correct installation
-        stdout = textwrap.dedent(
-            """\
-            Name: stone
-            Version: 0.1
-            --
-            Name: marchitect
-            Version: 0.1
-            """
+        stdout = json.dumps(
+            [
+                {"name": "Stone", "version": "0.1"},
+                {"name": "marchitect", "version": "0.1"},
+            ]
         ).encode("utf-8")
-        res = ExecOutput(0, stdout, b"")
-        with patch.object(Whiteprint, "exec", return_value=res) as mock_method:
+        exec_ = mock_exec({Pip3.state_cmd: stdout})
+        with patch.object(Whiteprint, "exec", side_effect=exec_) as mock_method:
             sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanSimple)
             sp.target_host_cfg = {}
             assert sp.validate("install") is None
-            mock_method.assert_called_once_with("pip3 show stone marchitect")
+            mock_method.assert_called_once_with(Pip3.state_cmd)
 
         # Try bad installation
-        stdout = textwrap.dedent(
-            """\
-            Name: stone
-            Version: 0.1
-            """
-        ).encode("utf-8")
-        res = ExecOutput(0, stdout, b"")
-        with patch.object(Whiteprint, "exec", return_value=res) as mock_method:
+        stdout = json.dumps([{"name": "stone", "version": "0.1"}]).encode("utf-8")
+        exec_ = mock_exec({Pip3.state_cmd: stdout})
+        with patch.object(Whiteprint, "exec", side_effect=exec_) as mock_method:
             sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanSimple)
             sp.target_host_cfg = {}
             assert sp.validate("install") == "Pip3 package 'marchitect' missing."
-            mock_method.assert_called_once_with("pip3 show stone marchitect")
+            mock_method.assert_called_once_with(Pip3.state_cmd)
+
+            # A pinned package is installed if the version differs.
+            WhiteprintPrefab.prefabs_head[0].cfg["packages"] = ["stone==0.2"]
+            assert sp.validate("install") == (
+                "Pip3 package 'stone' wrong version: '0.2' != '0.1'"
+            )
+            sp.install()
+            assert mock_method.call_args_list[-1] == call("pip3 install stone==0.2")
+            WhiteprintPrefab.prefabs_head[0].cfg["packages"] = ["stone", "marchitect"]
+
+    def test_prefab_package_aggregation(self):
+        class WhiteprintWeb(Whiteprint):
+            prefabs_head = [
+                Prefab(Apt, {"packages": ["nginx", "python3"]}),
+                Prefab(Pip3, {"packages": ["flask"]}),
+            ]
+
+            def _execute(self, mode: str):
+                self.use_execute(mode, Apt, {"packages": ["python3", "curl"]})
+
+            def _validate(self, mode: str):
+                return None
+
+        class WhiteprintApi(Whiteprint):
+            prefabs_tail = [
+                Prefab(Apt, {"packages": ["python3", "nginx"]}),
+                Prefab(Pip3, {"packages": ["flask==2.0", "requests"]}),
+            ]
+
+            def _execute(self, mode: str):
+                pass
+
+            def _validate(self, mode: str):
+                return None
+
+        class SitePlanPackages(SitePlan):
+            plan = [
+                Step(WhiteprintWeb),
+                Step(WhiteprintApi),
+            ]
+
+        apt_install = "DEBIAN_FRONTEND=noninteractive apt install -y "
+        exec_ = mock_exec({Pip3.state_cmd: b"[]"})
+
+        def installs(mock_method) -> List[str]:
+            return [
+                c.args[0] for c in mock_method.call_args_list if "install" in c.args[0]
+            ]
+
+        # Each package is installed once per run. A pin over an unpinned
+        # install is installed again.
+        with patch.object(Whiteprint, "exec", side_effect=exec_) as mock_method:
+            sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanPackages)
+            sp.target_host_cfg = {}
+            sp.install()
+            assert installs(mock_method) == [
+                apt_install + "nginx python3",
+                "pip3 install flask",
+                apt_install + "curl",
+                "pip3 install flask==2.0 requests",
+            ]
+            assert sp.packages.installed["pip3"] == {"flask": "2.0", "requests": None}
+
+        # Aggregated up front, except for nested whiteprints.
+        with patch.object(Whiteprint, "exec", side_effect=exec_) as mock_method:
+            sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanPackages)
+            sp.target_host_cfg = {}
+            sp.aggregate_packages = True
+            sp.install()
+            assert installs(mock_method) == [
+                apt_install + "nginx python3",
+                "pip3 install flask==2.0 requests",
+                apt_install + "curl",
+            ]
+
+        # Conflicts are found before anything is installed.
+        WhiteprintWeb.prefabs_head[1].cfg["packages"] = ["Flask==1.0"]
+        with patch.object(Whiteprint, "exec", side_effect=exec_) as mock_method:
+            sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanPackages)
+            sp.target_host_cfg = {}
+            sp.aggregate_packages = True
+            with self.assertRaisesRegex(
+                PackageConflictError, r"pip3 package versions: flask \(1.0, 2.0\)"
+            ):
+                sp.install()
+            mock_method.assert_not_called()
+
+        package_maps = [{"a": None, "b": "1"}, {"a": "2", "c": None}]
+        assert merge_packages("apt", package_maps) == {"a": "2", "b": "1", "c": None}
 
     def test_prefab_folder_exists(self):
         path = temp_file_path()
@@ -748,6 +1941,384 @@ class TestBasic(unittest.TestCase):
         assert res.exit_status == 0
         assert res.stdout == b"hello world\n"
 
+    def test_async_whiteprint(self):
+        async def run():
+            wp = AsyncWhiteprint(_mk_session_from_env_var_ssh_creds())
+            res = await wp.exec("echo hello")
+            assert res.stdout == b"hello\n"
+
+            data = random_data().encode("ascii")
+            dest_temp_path = temp_file_path()
+            await wp.scp_up_from_bytes(data, dest_temp_path)
+            assert await wp.scp_down_to_bytes(dest_temp_path) == data
+            os.remove(dest_temp_path)
+
+            with self.assertRaises(RemoteExecError):
+                await wp.exec("exit 1")
+
+            # Sessions on a single event loop progress concurrently.
+            wps = [
+                AsyncWhiteprint(_mk_session_from_env_var_ssh_creds())
+                for _ in range(4)
+            ]
+            start = time.perf_counter()
+            await asyncio.gather(*[wp.exec("sleep 1") for wp in wps])
+            assert time.perf_counter() - start < 3
+
+        asyncio.run(run())
+
+    def test_async_siteplan(self):
+        path = temp_file_path()
+
+        class WhiteprintAsyncWrite(AsyncWhiteprint):
+            prefabs_head = [
+                Prefab(Folder, {"path": path}),
+            ]
+
+            async def _execute(self, mode: str):
+                if mode == "install":
+                    await self.scp_up_template_from_str(
+                        "{{ _target.user }}", os.path.join(path, "user")
+                    )
+
+            async def _validate(self, mode: str):
+                res = await self.exec("cat %s/user" % path, error_ok=True)
+                return None if res.stdout else "missing"
+
+        class SitePlanAsync(AsyncSitePlan):
+            plan = [
+                Step(WhiteprintAsyncWrite),
+            ]
+
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanAsync)
+        asyncio.run(sp.install())
+        assert asyncio.run(sp.validate("install")) is None
+        with open(os.path.join(path, "user"), encoding="utf8") as f:
+            assert f.read() == sp.user
+        os.remove(os.path.join(path, "user"))
+        asyncio.run(sp.clean())
+        assert not os.path.exists(path)
+
+        res = asyncio.run(sp.one_off_exec("echo hello world"))
+        assert res.stdout == b"hello world\n"
+
+    def test_fleet(self):
+        class WhiteprintSleep(Whiteprint):
+            def _execute(self, mode: str):
+                self.exec("sleep 1")
+                if self.cfg["_target"]["host"] == "bad":
+                    self.exec("exit 1")
+
+            def _validate(self, mode: str):
+                return "bad host" if self.cfg["_target"]["host"] == "bad" else None
+
+        class SitePlanSleep(SitePlan):
+            plan = [
+                Step(WhiteprintSleep),
+            ]
+
+        fleet = _mk_fleet_from_env_var_ssh_creds(
+            SitePlanSleep, ["h%d" % i for i in range(4)]
+        )
+        start = time.perf_counter()
+        results = fleet.execute("install", concurrency=4)
+        assert time.perf_counter() - start < 3.5
+        assert [r.hostname for r in results] == ["h0", "h1", "h2", "h3"]
+        assert all(r.ok and r.duration >= 1 for r in results)
+        assert "h3" in Fleet.format_results(results)
+
+        # Continue-on-error attempts every host.
+        fleet = _mk_fleet_from_env_var_ssh_creds(SitePlanSleep, ["bad", "h1", "h2"])
+        results = fleet.execute("install", concurrency=1)
+        assert [r.status for r in results] == ["failed", "ok", "ok"]
+        assert "exit 1" in results[0].error
+        results = fleet.validate("install")
+        assert [r.error for r in results] == ["bad host", None, None]
+
+        # Fail-fast stops starting new batches once a host fails.
+        results = fleet.execute("install", batch_size=1 / 3, fail_fast=True)
+        assert [r.status for r in results] == ["failed", "skipped", "skipped"]
+
+        # Hosts' sessions are disconnected once they're done, unless kept
+        # until the fleet is closed.
+        assert all(sp.session_pool.idle_count == 0 for sp in fleet.site_plans)
+        with _mk_fleet_from_env_var_ssh_creds(SitePlanSleep, ["h0", "h1"]) as fleet:
+            fleet.keep_sessions = True
+            fleet.validate("install")
+            assert [sp.session_pool.idle_count for sp in fleet.site_plans] == [1, 1]
+            fleet.validate("install")
+            assert all(sp.session_pool.hits == 1 for sp in fleet.site_plans)
+        assert all(sp.session_pool.idle_count == 0 for sp in fleet.site_plans)
+
+    def test_session_pool(self):
+        class SitePlanSimple(SitePlan):
+            plan = [
+                Step(WhiteprintSimple),
+            ]
+
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanSimple)
+        with sp:
+            pool = sp.session_pool
+            sp.install()
+            sp.validate("install")
+            for _ in range(3):
+                assert sp.one_off_exec("echo hi").stdout == b"hi\n"
+            assert (pool.misses, pool.hits) == (1, 4)
+
+            # A failure discards the session rather than pooling it.
+            with self.assertRaises(RemoteExecError):
+                sp.one_off_exec("exit 1")
+            sp.one_off_exec("true")
+            assert (pool.misses, pool.hits) == (2, 5)
+
+            # A session closed by the peer fails the health check.
+            key = (sp.user, sp.hostname)
+            session = pool.acquire(key, sp.connect_func)
+            session.sock.shutdown(socket.SHUT_RDWR)
+            pool.release(key, session)
+            sp.one_off_exec("true")
+            assert (pool.misses, pool.hits) == (3, 6)
+        with self.assertRaises(AssertionError):
+            pool.acquire(key, sp.connect_func)
+
+        # Pools can be shared, and idle sessions expire.
+        with SessionPool(idle_timeout=0.1) as pool:
+            sp1 = _mk_siteplan_from_env_var_ssh_creds(SitePlanSimple)
+            sp2 = _mk_siteplan_from_env_var_ssh_creds(SitePlanSimple)
+            sp1.session_pool = sp2.session_pool = pool
+            sp1.one_off_exec("true")
+            sp2.one_off_exec("true")
+            assert (pool.misses, pool.hits) == (1, 1)
+            time.sleep(0.2)
+            sp1.one_off_exec("true")
+            assert (pool.misses, pool.hits) == (2, 1)
+    def test_template_cache(self):
+        dest_path = temp_file_path()
+
+        class WhiteprintWeb(Whiteprint):
+            name = "web"
+
+            def _execute(self, mode: str):
+                self.scp_up_template("site.conf", dest_path)
+
+            def _validate(self, mode: str):
+                return None
+
+        class SitePlanWeb(SitePlan):
+            plan = [
+                Step(WhiteprintWeb),
+            ]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            rsrc1 = Path(tmp) / "rsrc1"
+            rsrc2 = Path(tmp) / "rsrc2"
+            (rsrc1 / "web").mkdir(parents=True)
+            (rsrc2 / "common").mkdir(parents=True)
+            site_conf = rsrc1 / "web" / "site.conf"
+            site_conf.write_text('{% include "common/header.conf" %}\nserver a')
+            (rsrc2 / "common" / "header.conf").write_text("# {{ _target.user }}\n")
+
+            cache = TemplateCache([rsrc1, rsrc2], bytecode_cache_dir=Path(tmp))
+            for _ in range(2):
+                sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanWeb)
+                sp.rsrc_paths = [rsrc1, rsrc2]
+                sp.template_cache = cache
+                sp.install()
+                with open(dest_path, encoding="utf8") as f:
+                    assert f.read() == "# {}\nserver a".format(sp.user)
+            assert (cache.misses, cache.hits) == (1, 1)
+
+            # Editing the template invalidates it.
+            site_conf.write_text('{% include "common/header.conf" %}\nserver b')
+            os.utime(site_conf, ns=(0, 0))
+            sp.install()
+            with open(dest_path, encoding="utf8") as f:
+                assert f.read() == "# {}\nserver b".format(sp.user)
+            assert (cache.misses, cache.hits) == (2, 1)
+
+            # A new process reuses bytecode from disk.
+            cache = TemplateCache([rsrc1, rsrc2], bytecode_cache_dir=Path(tmp))
+            with patch.object(cache.env, "compile") as compile_mock:
+                cache.from_path(site_conf)
+            compile_mock.assert_not_called()
+        os.remove(dest_path)
+
+        assert Whiteprint.render_template("{{ a }}", {"a": 1}) == "1"
+        assert Whiteprint.render_template("{{ a }}", {"a": 2}) == "2"
+
+    def test_prefab_file_skip_unchanged(self):
+        dest_path1 = temp_file_path()
+        dest_path2 = temp_file_path()
+        src_path = temp_file_path()
+        with open(src_path, "w", encoding="utf8") as f:
+            f.write("from path {{ x }}")
+
+        class SitePlanFiles(SitePlan):
+            plan = [
+                Step(
+                    FileFromString,
+                    {"contents": "{{ x }}", "dest_path": dest_path1, "mode": 0o600},
+                ),
+                Step(FileFromPath, {"src_path": src_path, "dest_path": dest_path2}),
+            ]
+
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanFiles)
+        sp.cfg = {FileFromString: {"cfg": {"x": 1}}, FileFromPath: {"cfg": {"x": 2}}}
+        sp.install()
+        assert (sp.stats["files_uploaded"], sp.stats["files_skipped"]) == (2, 0)
+        with open(dest_path2, encoding="utf8") as f:
+            assert f.read() == "from path 2"
+
+        # Mode is reconciled even when the contents are unchanged.
+        os.chmod(dest_path1, 0o644)
+        sp.install()
+        assert (sp.stats["files_uploaded"], sp.stats["files_skipped"]) == (0, 2)
+        assert os.stat(dest_path1).st_mode & 0o777 == 0o600
+        assert sp.validate("install") is None
+
+        sp.cfg[FileFromString]["cfg"]["x"] = 3
+        sp.install()
+        assert (sp.stats["files_uploaded"], sp.stats["files_skipped"]) == (1, 1)
+        with open(dest_path1, encoding="utf8") as f:
+            assert f.read() == "3"
+
+        sp.clean()
+        assert not os.path.exists(dest_path1)
+        assert not os.path.exists(dest_path2)
+        os.remove(src_path)
+
+    def test_sync_tree(self):
+        local_dir = temp_file_path()
+        remote_dir = temp_file_path()
+        os.makedirs(os.path.join(local_dir, "a", "b"))
+        os.makedirs(os.path.join(local_dir, "empty"))
+        files = {
+            "top.txt": b"top",
+            "a/one.txt": b"one",
+            "a/b/two.bin": os.urandom(100_000),
+            "-dash": b"",
+        }
+        for path, data in files.items():
+            with open(os.path.join(local_dir, path), "wb") as f:
+                f.write(data)
+
+        def assert_same_tree():
+            for path, data in files.items():
+                with open(os.path.join(remote_dir, path), "rb") as f:
+                    assert f.read() == data, path
+                assert (
+                    os.stat(os.path.join(remote_dir, path)).st_mode
+                    == os.stat(os.path.join(local_dir, path)).st_mode
+                )
+            assert os.path.isdir(os.path.join(remote_dir, "empty"))
+
+        wp = create_blank_whiteprint()
+        diff = wp.sync_tree(local_dir, remote_dir)
+        assert sorted(diff.uploads) == sorted(files)
+        assert diff.mkdirs == ["a", "a/b", "empty"]
+        assert_same_tree()
+
+        # Unchanged tree: nothing but the manifest command is run.
+        exec_collect_op = wp._exec_collect_op  # pylint: disable=W0212
+        with patch.object(
+            Whiteprint, "_exec_collect_op", wraps=exec_collect_op
+        ) as mock_method:
+            diff = wp.sync_tree(local_dir, remote_dir)
+            assert mock_method.call_count == 1
+        assert not diff.changed
+        assert diff.unchanged == len(files)
+        assert wp.diff_tree(local_dir, remote_dir).changed is False
+
+        # Changed, added, and chmod'ed files, and an extra remote file
+        files["a/one.txt"] = b"uno"
+        files["a/new.txt"] = b"new"
+        for path in ("a/one.txt", "a/new.txt"):
+            with open(os.path.join(local_dir, path), "wb") as f:
+                f.write(files[path])
+        os.chmod(os.path.join(local_dir, "top.txt"), 0o600)
+        with open(os.path.join(remote_dir, "extra.txt"), "wb") as f:
+            f.write(b"extra")
+        diff = wp.diff_tree(local_dir, remote_dir)
+        assert diff.uploads == ["a/new.txt", "a/one.txt"]
+        assert diff.chmods == {"top.txt": 0o600}
+        assert diff.removals == []
+        wp.sync_tree(local_dir, remote_dir)
+        assert_same_tree()
+        assert os.path.exists(os.path.join(remote_dir, "extra.txt"))
+
+        # A remote dir where there's a local file is always replaced.
+        os.remove(os.path.join(remote_dir, "top.txt"))
+        os.makedirs(os.path.join(remote_dir, "top.txt", "x"))
+        diff = wp.sync_tree(local_dir, remote_dir, delete=True)
+        assert diff.removals == ["extra.txt", "top.txt"]
+        assert diff.uploads == ["top.txt"]
+        assert_same_tree()
+        assert not os.path.exists(os.path.join(remote_dir, "extra.txt"))
+
+        shutil.rmtree(local_dir)
+        shutil.rmtree(remote_dir)
+
+    def test_tar_up(self):
+        local_dir = temp_file_path()
+        os.makedirs(os.path.join(local_dir, "a", "b"))
+        os.makedirs(os.path.join(local_dir, "empty"))
+        files = {
+            "top.txt": b"top\n" * 1000,
+            "a/b/rand.bin": os.urandom(1_000_000),
+            "a/" + "long" * 40: b"long name",
+        }
+        for path, data in files.items():
+            with open(os.path.join(local_dir, path), "wb") as f:
+                f.write(data)
+        os.chmod(os.path.join(local_dir, "top.txt"), 0o600)
+        os.symlink("b/rand.bin", os.path.join(local_dir, "a", "link"))
+
+        wp = create_blank_whiteprint()
+        for compression in ("gzip", "bzip2", "xz", None):
+            remote_dir = temp_file_path()
+            wp.tar_up(local_dir, remote_dir, compression, compression_level=1)
+            for path, data in files.items():
+                with open(os.path.join(remote_dir, path), "rb") as f:
+                    assert f.read() == data, (compression, path)
+            assert os.stat(os.path.join(remote_dir, "top.txt")).st_mode & 0o777 == 0o600
+            assert os.readlink(os.path.join(remote_dir, "a", "link")) == "b/rand.bin"
+            assert os.path.isdir(os.path.join(remote_dir, "empty"))
+            shutil.rmtree(remote_dir)
+        shutil.rmtree(local_dir)
+
+    def test_prefab_directory_from_path(self):
+        local_dir = temp_file_path()
+        remote_dir = temp_file_path()
+        os.makedirs(os.path.join(local_dir, "sub"))
+        with open(os.path.join(local_dir, "sub", "file.txt"), "wb") as f:
+            f.write(b"data")
+
+        class SitePlanDir(SitePlan):
+            plan = [
+                Step(
+                    DirectoryFromPath,
+                    {"src_path": local_dir, "dest_path": remote_dir, "delete": True},
+                )
+            ]
+
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanDir)
+        assert sp.validate("install") is not None
+        sp.install()
+        assert sp.stats["files_uploaded"] == 1
+        assert sp.validate("install") is None
+        sp.install()
+        assert (sp.stats["files_uploaded"], sp.stats["files_skipped"]) == (0, 1)
+
+        with open(os.path.join(remote_dir, "extra.txt"), "wb") as f:
+            f.write(b"extra")
+        assert "1 to remove" in sp.validate("install")
+        sp.install()
+        assert not os.path.exists(os.path.join(remote_dir, "extra.txt"))
+
+        sp.clean()
+        assert not os.path.exists(remote_dir)
+        shutil.rmtree(local_dir)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,593 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks run against the same SSH target as test_basic.py.
+
+These are slow and move a lot of data, so they only run when the
+MARCHITECT_BENCH env var is set. MARCHITECT_BENCH_MAX_MB caps the largest
+payload (default: 1024).
+"""
+
+import contextlib
+import copy
+import os
+from pathlib import Path
+import queue
+import shutil
+import socket
+import threading
+import time
+import tracemalloc
+from typing import Iterator, Tuple
+import unittest
+from unittest.mock import patch
+
+import jinja2
+
+from marchitect.prefab import Apt, Folder
+from marchitect.site_plan import SitePlan, Step
+from marchitect.template import MostlyStrictUndefined, TemplateCache
+from marchitect.util import dict_deep_update
+from marchitect.whiteprint import Prefab, Reactor, Whiteprint, _ValidatedCfgCache
+from test.test_basic import (
+    WhiteprintSimple,
+    _mk_session_from_env_var_ssh_creds,
+    _mk_siteplan_from_env_var_ssh_creds,
+    create_blank_whiteprint,
+    temp_file_path,
+)
+
+BENCH_ENABLED = bool(os.getenv("MARCHITECT_BENCH"))
+BENCH_MAX_MB = int(os.getenv("MARCHITECT_BENCH_MAX_MB", "1024"))
+
+
+def bench_sizes_mb(*sizes: int) -> list:
+    return [size for size in sizes if size <= BENCH_MAX_MB]
+
+
+def _delay_pipe(src: socket.socket, dest: socket.socket, delay: float) -> None:
+    """Forwards data from src to dest, delivering each read delay secs late."""
+    pending: "queue.Queue[Tuple[float, bytes]]" = queue.Queue()
+
+    def deliver() -> None:
+        while True:
+            due, data = pending.get()
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            if not data:
+                with contextlib.suppress(OSError):
+                    dest.shutdown(socket.SHUT_WR)
+                return
+            with contextlib.suppress(OSError):
+                dest.sendall(data)
+
+    threading.Thread(target=deliver, daemon=True).start()
+    while True:
+        try:
+            data = src.recv(256 * 1024)
+        except OSError:
+            data = b""
+        pending.put((time.monotonic() + delay, data))
+        if not data:
+            return
+
+
+@contextlib.contextmanager
+def delay_proxy(rtt: float) -> Iterator[Tuple[str, int]]:
+    """
+    Runs a TCP proxy to the SSH target that adds rtt secs of round-trip
+    latency (half in each direction). Yields the (host, port) to connect to.
+    """
+    target = (os.environ["SSH_HOST"], int(os.getenv("SSH_PORT", "22")))
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+
+    def serve() -> None:
+        while True:
+            try:
+                client, _ = listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(target)
+            for a, b in ((client, upstream), (upstream, client)):
+                threading.Thread(
+                    target=_delay_pipe, args=(a, b, rtt / 2), daemon=True
+                ).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    try:
+        yield listener.getsockname()
+    finally:
+        listener.close()
+
+
+@unittest.skipUnless(BENCH_ENABLED, "MARCHITECT_BENCH not set")
+class TestBench(unittest.TestCase):
+    def test_exec_output_throughput(self):
+        wp = create_blank_whiteprint()
+        secs_per_mb = {}
+        for size_mb in bench_sizes_mb(10, 100, 1024):
+            start = time.perf_counter()
+            res = wp.exec("head -c %d /dev/zero" % (size_mb * 1024 * 1024))
+            elapsed = time.perf_counter() - start
+            assert len(res.stdout) == size_mb * 1024 * 1024
+            del res
+            secs_per_mb[size_mb] = elapsed / size_mb
+            print(
+                "exec output {} MB: {:.2f}s ({:.1f} MB/s)".format(
+                    size_mb, elapsed, size_mb / elapsed
+                )
+            )
+        # Linear buffering means the per-MB cost of the largest payload stays
+        # within a small factor of the smallest one. Quadratic buffering blows
+        # through this bound by orders of magnitude.
+        smallest, largest = min(secs_per_mb), max(secs_per_mb)
+        assert secs_per_mb[largest] < 3 * secs_per_mb[smallest], secs_per_mb
+
+    def test_scp_up_throughput(self):
+        wp = create_blank_whiteprint()
+        for size_mb in bench_sizes_mb(1, 100, 1024):
+            src_path = temp_file_path()
+            dest_path = temp_file_path()
+            with open(src_path, "wb") as f:
+                f.write(os.urandom(1024 * 1024) * size_mb)
+            try:
+                start = time.perf_counter()
+                wp.scp_up(src_path, dest_path)
+                elapsed = time.perf_counter() - start
+                assert os.path.getsize(dest_path) == size_mb * 1024 * 1024
+            finally:
+                os.remove(src_path)
+                if os.path.exists(dest_path):
+                    os.remove(dest_path)
+            print(
+                "scp_up {} MB: {:.2f}s ({:.1f} MB/s)".format(
+                    size_mb, elapsed, size_mb / elapsed
+                )
+            )
+
+    def test_exec_stdin_throughput(self):
+        wp = create_blank_whiteprint()
+        for size_mb in bench_sizes_mb(10, 100, 1024):
+            src_path = temp_file_path()
+            with open(src_path, "wb") as f:
+                f.write(os.urandom(1024 * 1024) * size_mb)
+            try:
+                tracemalloc.start()
+                start = time.perf_counter()
+                res = wp.exec("wc -c", stdin=Path(src_path))
+                elapsed = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                assert int(res.stdout) == size_mb * 1024 * 1024
+            finally:
+                os.remove(src_path)
+            print(
+                "exec stdin {} MB: {:.2f}s ({:.1f} MB/s), peak {:.1f} MB".format(
+                    size_mb, elapsed, size_mb / elapsed, peak / 1e6
+                )
+            )
+            # Streamed, not loaded into memory
+            assert peak < 10 * 1024 * 1024
+
+    def test_template_render_per_host(self):
+        source = "\n".join(
+            "server {{ host }}:%d {%% if tls %%}ssl{%% endif %%};" % i
+            for i in range(500)
+        )
+        cfg = {"host": "example.com", "tls": True}
+        hosts = 50
+
+        start = time.perf_counter()
+        for _ in range(hosts):
+            jinja2.Template(source, undefined=MostlyStrictUndefined).render(cfg)
+        uncached = time.perf_counter() - start
+
+        cache = TemplateCache()
+        start = time.perf_counter()
+        for _ in range(hosts):
+            cache.from_str(source).render(cfg)
+        cached = time.perf_counter() - start
+        print(
+            "template render x{}: uncached {:.2f}s, cached {:.2f}s".format(
+                hosts, uncached, cached
+            )
+        )
+        assert cached < uncached / 5
+
+    def test_step_cfg_cost(self):
+        session = _mk_session_from_env_var_ssh_creds()
+        reactor = Reactor(session)
+        step = Step(WhiteprintSimple, {"port": 80})
+        steps = 1000
+        timings = {}
+        for size in (100, 100_000):
+            default_cfg = {"k%d" % i: {"v": [i]} for i in range(size)}
+
+            class SitePlanBig(SitePlan):
+                pass
+
+            SitePlanBig.default_cfg = default_cfg
+            sp = SitePlanBig(
+                "user", "host", lambda: session, {"web": {"tls": {"on": True}}}, []
+            )
+            step.alias = "web"
+
+            start = time.perf_counter()
+            for _ in range(steps):
+                wp = sp._mk_whiteprint(  # pylint: disable=W0212
+                    step, session, reactor, {}
+                )
+                wp.render_template("{{ port }} {{ tls.on }} {{ k7.v }}", wp.cfg)
+            layered = (time.perf_counter() - start) / steps
+
+            # What the same config cost to build by copying and merging.
+            start = time.perf_counter()
+            for _ in range(10):
+                site_cfg = copy.deepcopy(default_cfg)
+                dict_deep_update(site_cfg, step.cfg)
+                dict_deep_update(site_cfg, sp.cfg["web"])
+            copied = (time.perf_counter() - start) / 10
+            timings[size] = layered
+            print(
+                "step cfg with {} untouched keys: layered {:.1f}us, "
+                "deepcopy {:.1f}us".format(size, layered * 1e6, copied * 1e6)
+            )
+
+        # Reading from a large nested map (e.g. per-host settings) copies
+        # the dicts on the way, shallowly, rather than the whole map.
+        SitePlanBig.default_cfg = {
+            "hosts": {"h%d" % i: {"ips": ["10.0.0.1"]} for i in range(100_000)}
+        }
+        sp = SitePlanBig("user", "host", lambda: session, {}, [])
+        start = time.perf_counter()
+        for _ in range(100):
+            wp = sp._mk_whiteprint(step, session, reactor, {})  # pylint: disable=W0212
+            wp.render_template("{{ hosts.h7.ips[0] }}", wp.cfg)
+        layered = (time.perf_counter() - start) / 100
+        start = time.perf_counter()
+        copy.deepcopy(SitePlanBig.default_cfg)
+        copied = time.perf_counter() - start
+        print(
+            "step cfg reading a nested map of 100000 keys: layered {:.1f}us, "
+            "deepcopy {:.1f}us".format(layered * 1e6, copied * 1e6)
+        )
+        reactor.close()
+        assert timings[100_000] < timings[100] * 3
+        assert layered < copied / 20
+
+    def test_prefab_cfg_validation_per_host(self):
+        session = _mk_session_from_env_var_ssh_creds()
+        cfg = {"packages": ["pkg%d" % i for i in range(50)]}
+        hosts = 500
+
+        with patch("marchitect.whiteprint._validated_cfgs", _ValidatedCfgCache(0)):
+            start = time.perf_counter()
+            for _ in range(hosts):
+                Apt(session, cfg)
+            uncached = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(hosts):
+            Apt(session, cfg)
+        memoized = time.perf_counter() - start
+        print(
+            "Apt cfg validation x{}: uncached {:.3f}s, memoized {:.3f}s".format(
+                hosts, uncached, memoized
+            )
+        )
+        assert memoized < uncached / 3
+
+    def test_journal_redeploy(self):
+        class WhiteprintSlow(Whiteprint):
+            def _execute(self, mode: str):
+                self.exec("sleep 0.1")
+
+            def _validate(self, mode: str):
+                return None
+
+        class SitePlanSlow(SitePlan):
+            skip_unchanged_steps = True
+            journal_path = temp_file_path()
+            plan = [Step(WhiteprintSlow, {"i": i}) for i in range(40)]
+
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanSlow)
+        sp.target_host_cfg = {}
+        timings = []
+        for force in (True, False):
+            start = time.perf_counter()
+            sp.install(force=force)
+            timings.append(time.perf_counter() - start)
+        print("40-step install: applied {:.2f}s, unchanged {:.2f}s".format(*timings))
+        os.remove(SitePlanSlow.journal_path)
+        assert timings[1] < timings[0] / 5
+
+    def test_parallel_steps(self):
+        class WhiteprintSlow(Whiteprint):
+            def _execute(self, mode: str):
+                self.exec("sleep 0.2")
+
+            def _validate(self, mode: str):
+                return None
+
+        class SitePlanWide(SitePlan):
+            plan = [Step(WhiteprintSlow, {"i": i}, depends_on=[]) for i in range(20)]
+
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanWide)
+        sp.target_host_cfg = {}
+        timings = []
+        for max_parallel_steps in (1, 8):
+            sp.max_parallel_steps = max_parallel_steps
+            # Warm up the session pool so that connecting isn't measured.
+            sp.install()
+            start = time.perf_counter()
+            sp.install()
+            timings.append(time.perf_counter() - start)
+        print("20 steps: sequential {:.2f}s, 8 in parallel {:.2f}s".format(*timings))
+        assert timings[1] < timings[0] / 3
+
+    def test_package_validation(self):
+        wp = create_blank_whiteprint()
+        names = sorted(Apt(wp.session, {"packages": []}).installed_packages())[:200]
+
+        class WhiteprintPackages(Whiteprint):
+            def _execute(self, mode: str):
+                pass
+
+            def _validate(self, mode: str):
+                return None
+
+        class SitePlanPackages(SitePlan):
+            plan = [
+                Step(
+                    type(
+                        "WhiteprintPackages{}".format(i),
+                        (WhiteprintPackages,),
+                        {"prefabs_head": [Prefab(Apt, {"packages": names[i::20]})]},
+                    )
+                )
+                for i in range(20)
+            ]
+
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanPackages)
+        sp.target_host_cfg = {}
+        sp.validate("install")
+        exec_orig = Whiteprint.exec
+        cmds = []
+
+        def recording_exec(self, cmd, *args, **kwargs):
+            cmds.append(cmd)
+            return exec_orig(self, cmd, *args, **kwargs)
+
+        with patch.object(Whiteprint, "exec", recording_exec):
+            start = time.perf_counter()
+            assert sp.validate("install") is None
+            shared = time.perf_counter() - start
+            shared_cmds = len(cmds)
+            # Each prefab on its own queries the host itself.
+            start = time.perf_counter()
+            for step in SitePlanPackages.plan:
+                for prefab in step.whiteprint_cls.prefabs_head:
+                    assert Apt(wp.session, prefab.cfg).validate("install") is None
+            unshared = time.perf_counter() - start
+        print(
+            "Validating 200 packages in 20 prefabs: {} cmd(s) in {:.3f}s shared, "
+            "{} in {:.3f}s unshared".format(
+                shared_cmds, shared, len(cmds) - shared_cmds, unshared
+            )
+        )
+        assert shared_cmds == 1
+
+    def test_exec_batch(self):
+        paths = [temp_file_path() for _ in range(50)]
+        cmds = ["mkdir -p {}".format(path) for path in paths]
+        try:
+            with delay_proxy(0.06) as (host, port):
+                env = {"SSH_HOST": host, "SSH_PORT": str(port)}
+                with patch.dict(os.environ, env):
+                    wp = Whiteprint(_mk_session_from_env_var_ssh_creds())
+                start = time.perf_counter()
+                for cmd in cmds:
+                    wp.exec(cmd)
+                one_by_one = time.perf_counter() - start
+                start = time.perf_counter()
+                wp.exec_batch(cmds)
+                batched = time.perf_counter() - start
+        finally:
+            for path in paths:
+                os.rmdir(path)
+        print(
+            "50 commands at 60ms RTT: {:.2f}s one by one, {:.2f}s batched".format(
+                one_by_one, batched
+            )
+        )
+        assert batched < one_by_one / 10
+
+    def test_persistent_shell(self):
+        with delay_proxy(0.02) as (host, port):
+            env = {"SSH_HOST": host, "SSH_PORT": str(port)}
+            with patch.dict(os.environ, env):
+                wp = Whiteprint(_mk_session_from_env_var_ssh_creds())
+            timings = []
+            for persistent_shell in (False, True):
+                wp.persistent_shell = persistent_shell
+                # Start the shell so that it isn't measured.
+                wp.exec("true")
+                start = time.perf_counter()
+                for _ in range(50):
+                    wp.exec("test -f /etc/passwd")
+                timings.append(time.perf_counter() - start)
+            wp.reactor.close()
+        print(
+            "50 commands at 20ms RTT: {:.2f}s in channels, "
+            "{:.2f}s in a persistent shell".format(*timings)
+        )
+        assert timings[1] < timings[0] / 3
+
+    def test_agent(self):
+        with delay_proxy(0.02) as (host, port):
+            env = {"SSH_HOST": host, "SSH_PORT": str(port)}
+            with patch.dict(os.environ, env):
+                wp = Whiteprint(_mk_session_from_env_var_ssh_creds())
+            timings = []
+            for use_agent in (False, True):
+                wp.use_agent = use_agent
+                # Start the agent so that it isn't measured.
+                wp.exec("true")
+                start = time.perf_counter()
+                for _ in range(25):
+                    wp.exec("test -f /etc/passwd")
+                    wp.stat_many(["/etc/passwd"], digest=True)
+                timings.append(time.perf_counter() - start)
+            wp.reactor.close()
+        print(
+            "50 commands and stats at 20ms RTT: {:.2f}s in channels, "
+            "{:.2f}s with the agent".format(*timings)
+        )
+        assert timings[1] < timings[0] / 3
+
+    def test_folder_validation(self):
+        paths = [temp_file_path() for _ in range(50)]
+
+        class WhiteprintFolders(Whiteprint):
+            prefabs_head = [Prefab(Folder, {"path": path}) for path in paths]
+
+            def _execute(self, mode: str):
+                pass
+
+            def _validate(self, mode: str):
+                return None
+
+        class SitePlanFolders(SitePlan):
+            plan = [Step(WhiteprintFolders)]
+
+        sp = _mk_siteplan_from_env_var_ssh_creds(SitePlanFolders)
+        sp.target_host_cfg = {}
+        sp.install()
+        try:
+            with delay_proxy(0.02) as (host, port):
+                env = {"SSH_HOST": host, "SSH_PORT": str(port)}
+                with patch.dict(os.environ, env):
+                    sp_delayed = _mk_siteplan_from_env_var_ssh_creds(SitePlanFolders)
+                    session = _mk_session_from_env_var_ssh_creds()
+                sp_delayed.target_host_cfg = {}
+                start = time.perf_counter()
+                assert sp_delayed.validate("install") is None
+                batched = time.perf_counter() - start
+                # Each prefab on its own stats its folder itself.
+                start = time.perf_counter()
+                for path in paths:
+                    assert Folder(session, {"path": path}).validate("install") is None
+                unbatched = time.perf_counter() - start
+        finally:
+            sp.clean()
+        print(
+            "Validating 50 folders at 20ms RTT: {:.3f}s batched, "
+            "{:.3f}s one stat each".format(batched, unbatched)
+        )
+        assert batched < unbatched / 5
+
+    def test_sftp_vs_scp_latency(self):
+        size_mb = min(BENCH_MAX_MB, 64)
+        src_path = temp_file_path()
+        dest_path = temp_file_path()
+        with open(src_path, "wb") as f:
+            f.write(os.urandom(1024 * 1024) * size_mb)
+        try:
+            for rtt in (0.001, 0.050):
+                with delay_proxy(rtt) as (host, port):
+                    env = {"SSH_HOST": host, "SSH_PORT": str(port)}
+                    with patch.dict(os.environ, env):
+                        wp = Whiteprint(_mk_session_from_env_var_ssh_creds())
+                    rates = {}
+                    for transport in ("scp", "sftp"):
+                        wp.transport = transport
+                        start = time.perf_counter()
+                        wp.scp_up(src_path, dest_path)
+                        up_elapsed = time.perf_counter() - start
+                        start = time.perf_counter()
+                        data = wp.scp_down_to_bytes(dest_path)
+                        down_elapsed = time.perf_counter() - start
+                        assert len(data) == size_mb * 1024 * 1024
+                        del data
+                        os.remove(dest_path)
+                        rates[transport] = (
+                            size_mb / up_elapsed,
+                            size_mb / down_elapsed,
+                        )
+                    wp.session.disconnect()
+                print(
+                    "{} MB at {:.0f}ms RTT (up/down MB/s): scp {:.1f}/{:.1f}, "
+                    "sftp {:.1f}/{:.1f}".format(
+                        size_mb, rtt * 1000, *rates["scp"], *rates["sftp"]
+                    )
+                )
+                # Pipelined reads aren't bound by round trips.
+                if rtt >= 0.05:
+                    assert rates["sftp"][1] > rates["scp"][1], rates
+        finally:
+            os.remove(src_path)
+
+    def test_tar_up_vs_scp(self):
+        # A text-heavy tree, like config and code
+        local_dir = temp_file_path()
+        n_files = 300
+        for i in range(n_files):
+            path = os.path.join(local_dir, "dir{}".format(i % 10), "f{}.conf".format(i))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf8") as f:
+                for j in range(200):
+                    f.write(
+                        "option_{j} = value_{i}_{j}  # setting {j}\n".format(i=i, j=j)
+                    )
+        try:
+            for rtt in (0.001, 0.050):
+                with delay_proxy(rtt) as (host, port):
+                    env = {"SSH_HOST": host, "SSH_PORT": str(port)}
+                    with patch.dict(os.environ, env):
+                        wp = Whiteprint(_mk_session_from_env_var_ssh_creds())
+                    timings = {}
+
+                    remote_dir = temp_file_path()
+                    start = time.perf_counter()
+                    for dirpath, _, filenames in os.walk(local_dir):
+                        rel_dir = os.path.relpath(dirpath, local_dir)
+                        wp.exec("mkdir -p " + os.path.join(remote_dir, rel_dir))
+                        for filename in filenames:
+                            wp.scp_up(
+                                os.path.join(dirpath, filename),
+                                os.path.join(remote_dir, rel_dir, filename),
+                            )
+                    timings["scp per file"] = time.perf_counter() - start
+                    shutil.rmtree(remote_dir)
+
+                    start = time.perf_counter()
+                    wp.sync_tree(local_dir, remote_dir)
+                    timings["sync_tree"] = time.perf_counter() - start
+                    shutil.rmtree(remote_dir)
+
+                    for compression in ("gzip", "xz"):
+                        start = time.perf_counter()
+                        wp.tar_up(local_dir, remote_dir, compression)
+                        timings["tar_up " + compression] = time.perf_counter() - start
+                        shutil.rmtree(remote_dir)
+                    wp.session.disconnect()
+                print(
+                    "{} files at {:.0f}ms RTT: {}".format(
+                        n_files,
+                        rtt * 1000,
+                        ", ".join(
+                            "{} {:.2f}s".format(label, elapsed)
+                            for label, elapsed in timings.items()
+                        ),
+                    )
+                )
+                assert timings["tar_up gzip"] < timings["scp per file"]
+        finally:
+            shutil.rmtree(local_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()